@@ -0,0 +1,248 @@
+"""Нагрузочный замер конвейера: разбор ответа -> группировка -> вывод -> снимок -> сравнение снимков.
+
+Ответы cheapestTours генерируются синтетически: число отелей растет медленнее числа туров,
+популярные отели встречаются намного чаще (распределение Парето), цены округлены и повторяются.
+
+Пример:
+    python benchmark.py --sizes 100,10000,1000000 --output bench.json
+    python benchmark.py --baseline bench.json  # ненулевой код выхода при замедлении
+"""
+import argparse
+import gc
+import json
+import logging
+import random
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+from typing import Callable, Dict, List, Tuple
+
+import main
+from main import SearchResult, TravelataBot, decode_payload
+
+DEFAULT_SIZES = "100,1000,10000,100000"
+DEFAULT_REPEAT = 5
+DEFAULT_TOLERANCE = 0.2  # допустимое замедление относительно базового замера
+REGRESSION_FLOOR = 0.0005  # разница меньше полумиллисекунды - шум, а не замедление
+BENCH_TOKEN = "123456:" + "A" * 35  # бот не подключается к Telegram, токен только проходит проверку формата
+
+STAGES = ("decode", "group", "render", "snapshot", "diff")
+
+def generate_tours(count: int, seed: int) -> List[dict]:
+    """Синтетический список туров с перекосом по отелям и повторяющимися ценами"""
+    rng = random.Random(seed)
+    hotels = max(10, int(count ** 0.6))
+    first_day = date(2025, 6, 1)
+    tours = []
+    for index in range(count):
+        # Парето: несколько отелей дают большую часть туров, как в реальных ответах
+        hotel = int(rng.paretovariate(1.1)) % hotels + 1
+        day = first_day + timedelta(days=rng.randrange(30))
+        tours.append({
+            "hotelId": hotel,
+            "hotelName": f"Hotel {hotel}",
+            "hotelCategoryName": f"{hotel % 5 + 1}*",
+            "hotelRating": f"{3 + hotel % 20 / 10:.1f}",
+            "price": 40_000 + hotel % 50 * 1_000 + rng.randrange(0, 60) * 500,
+            "nights": rng.randint(6, 14),
+            "checkinDate": day.isoformat(),
+            "mealId": rng.randint(1, 7),
+            "tourPageUrl": f"https://travelata.ru/tour/{seed}-{index}"
+        })
+    return tours
+
+def mutate_tours(tours: List[dict], seed: int) -> List[dict]:
+    """Следующая проверка мониторинга: часть цен изменилась, часть туров исчезла, появились новые отели"""
+    rng = random.Random(seed + 1)
+    mutated = []
+    for tour in tours:
+        roll = rng.random()
+        if roll < 0.02:
+            continue
+        if roll < 0.07:
+            tour = dict(tour, price=int(tour["price"] * rng.choice((0.8, 0.9, 1.1, 1.25))))
+        mutated.append(tour)
+    max_hotel = max((tour["hotelId"] for tour in tours), default=0)
+    for offset in range(1, max(2, len(tours) // 1000) + 1):
+        mutated.append(dict(tours[0] if tours else generate_tours(1, seed)[0],
+                            hotelId=max_hotel + offset, hotelName=f"Hotel {max_hotel + offset}",
+                            tourPageUrl=f"https://travelata.ru/tour/new-{offset}"))
+    return mutated
+
+def encode_payload(tours: List[dict]) -> bytes:
+    return json.dumps({"success": True, "data": tours}, ensure_ascii=False).encode("utf-8")
+
+def build_pipeline(bot: TravelataBot, body: bytes,
+                   next_body: bytes) -> Tuple[List[Tuple[str, Callable]], Callable, Dict[str, object]]:
+    """Стадии конвейера; каждая получает результат предыдущей через общий словарь"""
+    state: Dict[str, object] = {}
+
+    def decode():
+        state["data"] = decode_payload(body)
+
+    def group():
+        state["result"] = SearchResult.from_tours(state["data"]["data"])
+
+    def render():
+        state["page"] = bot.parse_json_to_hotels_list(state["result"])
+
+    def snapshot():
+        state["snapshot"] = bot._create_hotels_snapshot_from_content(state["result"])
+
+    def diff():
+        # Новый снимок строится вне замера: сравнивается готовое с готовым, как в мониторинге
+        state["changes"] = bot._compare_hotels_snapshots(state["snapshot"], state["next_snapshot"])
+
+    def prepare_next():
+        next_result = SearchResult.from_tours(decode_payload(next_body)["data"])
+        state["next_snapshot"] = bot._create_hotels_snapshot_from_content(next_result)
+
+    return [
+        ("decode", decode), ("group", group), ("render", render),
+        ("snapshot", snapshot), ("diff", diff)
+    ], prepare_next, state
+
+def time_stages(stages, prepare_next, repeat: int) -> Dict[str, List[float]]:
+    """Время каждой стадии по повторам (без tracemalloc, чтобы не искажать скорость)"""
+    prepare_next()
+    timings = {name: [] for name, _ in stages}
+    for _ in range(repeat):
+        for name, stage in stages:
+            gc.collect()
+            started = time.perf_counter()
+            stage()
+            timings[name].append(time.perf_counter() - started)
+    return timings
+
+def trace_stages(stages, prepare_next) -> Dict[str, Dict[str, int]]:
+    """Пиковая память и прирост живых блоков памяти на каждой стадии (отдельный прогон)"""
+    prepare_next()
+    memory = {}
+    tracemalloc.start()
+    try:
+        for name, stage in stages:
+            gc.collect()
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            blocks_before = sys.getallocatedblocks()
+            stage()
+            _, peak = tracemalloc.get_traced_memory()
+            # Это не число выделений, а прирост живых блоков: выделенные стадией и не освобожденные к ее концу
+            # (результат и кэши). Снимки tracemalloc на миллионе туров считаются минутами, счетчик - мгновенно
+            memory[name] = {"peak_bytes": peak - base, "live_blocks_delta": sys.getallocatedblocks() - blocks_before}
+    finally:
+        tracemalloc.stop()
+    return memory
+
+def run_size(bot: TravelataBot, count: int, repeat: int, seed: int) -> dict:
+    """Замер всех стадий на ответе из count туров"""
+    tours = generate_tours(count, seed)
+    body = encode_payload(tours)
+    next_body = encode_payload(mutate_tours(tours, seed))
+    del tours
+
+    stages, prepare_next, state = build_pipeline(bot, body, next_body)
+    timings = time_stages(stages, prepare_next, repeat)
+    memory = trace_stages(stages, prepare_next)
+
+    report = {
+        "tours": count,
+        "hotels": state["result"].hotels_count,
+        "payload_bytes": len(body),
+        "changes": len(state["changes"]),
+        "stages": {}
+    }
+    total = 0.0
+    for name in STAGES:
+        best = min(timings[name])
+        median = sorted(timings[name])[len(timings[name]) // 2]
+        total += median
+        report["stages"][name] = {
+            "best_seconds": best,
+            "median_seconds": median,
+            "tours_per_second": count / median if median else None,
+            **memory[name]
+        }
+    report["end_to_end"] = {
+        "median_seconds": total,
+        "tours_per_second": count / total if total else None,
+        "peak_bytes": max(stage["peak_bytes"] for stage in report["stages"].values())
+    }
+    return report
+
+def compare_with_baseline(results: List[dict], baseline: dict, tolerance: float) -> List[str]:
+    """Стадии, которые стали медленнее базового замера больше чем на tolerance (по лучшему времени)"""
+    previous = {run["tours"]: run for run in baseline.get("runs", [])}
+    regressions = []
+    for run in results:
+        old = previous.get(run["tours"])
+        if old is None:
+            continue
+        for name in STAGES:
+            old_seconds = old["stages"].get(name, {}).get("best_seconds")
+            new_seconds = run["stages"][name]["best_seconds"]
+            if old_seconds and new_seconds > old_seconds * (1 + tolerance) \
+                    and new_seconds - old_seconds > REGRESSION_FLOOR:
+                regressions.append(
+                    f"{run['tours']} туров, {name}: {old_seconds * 1000:.2f} -> {new_seconds * 1000:.2f} мс"
+                )
+    return regressions
+
+def print_summary(results: List[dict]) -> None:
+    """Краткая таблица для человека (в stderr, чтобы не мешать JSON)"""
+    header = f"{'туров':>9} {'отелей':>7} " + " ".join(f"{name:>10}" for name in STAGES) + f" {'всего':>10} {'пик МБ':>8}"
+    print(header, file=sys.stderr)
+    for run in results:
+        stages = " ".join(f"{run['stages'][name]['median_seconds'] * 1000:>8.2f}мс" for name in STAGES)
+        print(
+            f"{run['tours']:>9} {run['hotels']:>7} {stages} "
+            f"{run['end_to_end']['median_seconds'] * 1000:>8.2f}мс "
+            f"{run['end_to_end']['peak_bytes'] / 1024 / 1024:>8.1f}",
+            file=sys.stderr
+        )
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(description="Замер конвейера обработки ответа cheapestTours")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="размеры ответа в турах через запятую")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="повторов на каждую стадию")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл для JSON-отчета (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="JSON-отчет прошлого замера для поиска замедлений")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    # Логи бота (по строке на каждый разбор) не нужны в замере
+    logging.getLogger(main.__name__).setLevel(logging.WARNING)
+    bot = TravelataBot(BENCH_TOKEN)
+
+    results = []
+    for count in (int(size) for size in args.sizes.split(",") if size.strip()):
+        results.append(run_size(bot, count, max(1, args.repeat), args.seed))
+
+    report = {
+        "python": sys.version.split()[0],
+        "orjson": main.orjson is not None,
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "runs": results
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    print_summary(results)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"Замедление: {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,30 +1,47 @@
 import asyncio
 import logging
 import json
-import requests
-from datetime import datetime
-from typing import Dict, List, Optional, Tuple
-from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from dataclasses import dataclass, asdict, replace
 import time
-import re
-import os
-
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
-from aiogram.filters import Command, StateFilter
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-
-# Импорты для Selenium
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, WebDriverException
-import chromedriver_autoinstaller
+# Отсчет до импорта тяжелых модулей (aiogram, numpy, aiohttp), чтобы отчет о готовности включал и их
+_process_started = time.monotonic()
+import re  # noqa: E402
+import os  # noqa: E402
+import socket  # noqa: E402
+import heapq  # noqa: E402
+import random  # noqa: E402
+import sqlite3  # noqa: E402
+import hashlib  # noqa: E402
+import hmac  # noqa: E402
+import secrets  # noqa: E402
+import signal  # noqa: E402
+import sys  # noqa: E402
+import threading  # noqa: E402
+import zlib  # noqa: E402
+import multiprocessing  # noqa: E402
+from collections import Counter, OrderedDict, defaultdict, deque  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+from contextlib import asynccontextmanager  # noqa: E402
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+import numpy as np  # noqa: E402
+try:
+    import orjson  # noqa: E402 - быстрый декодер JSON, если установлен
+except ImportError:
+    orjson = None
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F  # noqa: E402
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, TelegramObject, Update  # noqa: E402
+from aiogram.filters import Command, StateFilter  # noqa: E402
+from aiogram.fsm.context import FSMContext  # noqa: E402
+from aiogram.fsm.state import State, StatesGroup  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey  # noqa: E402
+from aiogram.exceptions import TelegramRetryAfter  # noqa: E402
+
+# Selenium и chromedriver_autoinstaller импортируются только при запуске браузера
 
 # Настройка логирования
 logging.basicConfig(
@@ -33,229 +50,2937 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Состояния диалога
-class UserStates(StatesGroup):
-    COUNTRY = State()
-    DEPARTURE_CITY = State()
-    RESORTS = State()
-    MEALS = State()
-    ADULTS = State()
-    CHILDREN = State()
-    INFANTS = State()
-    NIGHTS = State()
-    HOTEL_CATEGORY = State()
-    DATES = State()
 
-# Структура для хранения параметров пользователя
-@dataclass
-class UserParams:
-    countries: List[str] = None
-    departure_city: str = None
-    night_range_from: str = None
-    night_range_to: str = None
-    resorts: List[str] = None
-    meals: List[str] = None
-    tourist_group_adults: str = None
-    tourist_group_kids: str = None
-    tourist_group_infants: str = None
-    hotel_categories: List[str] = None
-    check_in_date_range_from: str = None
-    check_in_date_range_to: str = None
-
-# Словари для сопоставления названий с ID
-COUNTRIES = {
-    "абхазия": "1", "австрия": "3", "андорра": "4", "армения": "6",
-    "бахрейн": "10", "беларусь": "11", "бельгия": "12", "болгария": "13",
-    "бразилия": "16", "великобритания": "19", "венгрия": "20", "вьетнам": "22",
-    "германия": "24", "греция": "26", "дания": "27", "доминикана": "28",
-    "египет": "29", "израиль": "32", "индия": "33", "индонезия": "34",
-    "иордания": "35", "ирландия": "36", "испания": "38", "италия": "39",
-    "камбоджа": "41", "кипр": "43", "китай": "44", "коста-рика": "47",
-    "куба": "48", "кыргызстан": "49", "латвия": "50", "литва": "52",
-    "маврикий": "53", "малайзия": "55", "мальдивы": "56", "мальта": "57",
-    "марокко": "59", "мексика": "60", "нидерланды": "65", "норвегия": "67",
-    "оаэ": "68", "оман": "69", "польша": "74", "португалия": "75",
-    "россия": "76", "румыния": "77", "сейшелы": "78", "сербия": "81",
-    "сингапур": "82", "словакия": "83", "словения": "84", "сша": "85",
-    "таиланд": "87", "танзания": "88", "тунис": "91", "турция": "92",
-    "узбекистан": "94", "филиппины": "97", "финляндия": "98", "франция": "99",
-    "хорватия": "101", "черногория": "104", "чехия": "105", "швейцария": "107",
-    "швеция": "108", "шри-ланка": "110", "эстония": "113", "юар": "115",
-    "южная корея": "116", "ямайка": "117", "япония": "118", "азербайджан": "119",
-    "албания": "120", "грузия": "129", "катар": "135", "казахстан": "156",
-    "гамбия": "157", "саудовская аравия": "260", "туркменистан": "293",
-    "таджикистан": "294", "сан-марино": "224"
-}
-
-DEPARTURE_CITIES = {
-    "абакан": "90", "архангельск": "8", "астрахань": "10", "барнаул": "12",
-    "белгород": "13", "благовещенск": "15", "брянск": "18", "владивосток": "19",
-    "владикавказ": "20", "волгоград": "21", "воронеж": "22", "екатеринбург": "25",
-    "иркутск": "28", "казань": "29", "калининград": "30", "кемерово": "32",
-    "краснодар": "36", "красноярск": "37", "курган": "38", "курск": "39",
-    "липецк": "91", "магадан": "42", "магнитогорск": "43", "махачкала": "92",
-    "минеральные воды": "44", "москва": "2", "мурманск": "46", "нальчик": "47",
-    "нижневартовск": "48", "нижний новгород": "50", "новокузнецк": "51",
-    "новороссийск": "52", "новосибирск": "53", "омск": "56", "оренбург": "57",
-    "пенза": "60", "пермь": "61", "петропавловск-камчатский": "62",
-    "ростов-на-дону": "63", "самара": "64", "санкт-петербург": "1", "саратов": "65",
-    "симферополь": "66", "сочи": "67", "ставрополь": "93", "сургут": "68",
-    "сыктывкар": "70", "тольятти": "71", "томск": "72", "тюмень": "74",
-    "улан-удэ": "75", "ульяновск": "76", "уфа": "79", "хабаровск": "80",
-    "ханты-мансийск": "81", "чебоксары": "83", "челябинск": "84", "чита": "85",
-    "южно-сахалинск": "87", "якутск": "88"
-}
-
-RESORTS_LIST = {
-    "гагра": "1", "сухум": "6", "пицунда": "5", "гудаута": "2", "новый афон": "3",
-    "очамчыра": "4", "цандрипш": "3899", "венa": "33", "зальцбург": "36",
-    "майрхофен": "50", "зёльден": "40", "ишгль": "43", "каринтия": "44",
-    "капрун": "2806", "целль-ам-зе": "2821", "андорра ла велла": "60",
-    "эскальдес": "2832", "пас де ла каса": "2829", "ла массана": "3030",
-    "гранд валира": "62", "ереван": "103", "джульфа": "101", "цакхадзор": "105",
-    "раздан": "102", "албена": "175", "банско": "181", "боровец": "185",
-    "золотые пески": "200", "несебр": "215", "солнечный берег": "241",
-    "св. константин и елена": "235", "святой влас": "236", "поморие": "223",
-    "елините": "199", "фантхьет": "428", "муйне": "428", "ньячанг": "417",
-    "фукуок": "429", "дананг": "405", "ханой": "432", "хошимин": "434",
-    "сапа": "424", "хюэ": "435", "халонг": "431", "крит": "3163", "афины": "468",
-    "салоники": "529", "корфу": "497", "родос": "509", "закинф": "489",
-    "кос": "498", "санторини": "530", "халкидики": "3164", "пунта кана": "571",
-    "ла романа": "566", "пуэрто плата": "572", "самана": "573", "баваро": "571",
-    "кабарете": "563", "шарм-эль-шейх": "598", "хургада": "597", "марса алам": "592",
-    "таба": "596", "дахаб": "586", "эль гуна": "599", "сома бей": "595",
-    "макади": "591", "сафага": "594", "нувейба": "593", "барселона": "747",
-    "мадрид": "786", "коста брава": "770", "коста дель соль": "773",
-    "коста бланка": "769", "коста дорада": "774", "майорка": "787", "тенерифе": "763",
-    "ибица": "795", "льорет де мар": "782", "рим": "880", "милан": "863",
-    "венеция": "842", "флоренция": "892", "неаполь": "866", "римини": "881",
-    "сицилия": "868", "сардиния": "885", "капри": "851", "исачия": "867",
-    "айя-напа": "919", "протарас": "926", "ларнака": "920", "лимассол": "922",
-    "пафос": "2869", "полис": "925", "варадеро": "1001", "гавана": "1004",
-    "кайо коко": "1011", "кайо ларго": "1012", "кайо гильермо": "1010",
-    "кайо санта мария": "1014", "ольгин": "1016", "сантьяго де куба": "1020",
-    "мале": "1142", "северный мале атолл": "1148", "южный мале атолл": "1152",
-    "ари атолл": "1136", "баа атолл": "1137", "раа атолл": "1146", "даалу атолл": "1139",
-    "лавиани атолл": "1141", "дубай": "1379", "абу даби": "1377", "шарджа": "1385",
-    "аджман": "1378", "рас-эль-хайма": "1381", "фуджейра": "1384", "ум аль кувейн": "1383",
-    "сочи": "3097", "адлер": "1545", "лазаревское": "1704", "хоста": "3124",
-    "дагомыс": "1620", "алушта": "2202", "ялта": "2280", "симферополь": "2255",
-    "евпатория": "2253", "феодосия": "2265", "судак": "2258", "керчь": "2224",
-    "севастополь": "2253", "анапа": "3974", "геленджик": "1610", "туапсе": "1868",
-    "паттайя": "2100", "пхукет": "4191", "самуи": "2098", "пхи-пхи": "2112",
-    "краби": "2103", "чанг": "2099", "бангкок": "2084", "ча-ам": "2126",
-    "хуа хин": "2125", "као лак": "2086", "джерба": "2142", "сусс": "2150",
-    "хаммамет": "2155", "монастир": "2147", "махдия": "2146", "анталья": "2161",
-    "кемер": "3839", "белек": "2162", "сиде": "3828", "алания": "2159",
-    "мармарис": "2178", "бодрум": "2163", "кушадасы": "2177", "фетхие": "2190",
-    "даламан": "2167", "измир": "2169", "стамбул": "2185", "каппадокия": "2172",
-    "памуккале": "2182", "будва": "3011", "котор": "3020", "тиват": "2514",
-    "петровац": "3015", "свети стефан": "3018", "бечичи": "3010", "герцег нови": "3050",
-    "прага": "2535", "карловы вары": "2521", "марианские лазне": "2528",
-    "коломбо": "2673", "бентота": "2652", "негомбо": "2681", "хиккадува": "2698",
-    "мирисса": "2680", "унаватуна": "2695", "галле": "2658", "тринкомали": "2694",
-    "нувара элия": "2683", "канди": "2668", "батуми": "2968", "тбилиси": "2976",
-    "кутаиси": "2973", "боржоми": "3234", "бакуриани": "2967", "гудauri": "2970",
-    "кобулети": "2972", "алматы": "3244", "астана": "3245", "актау": "3242",
-    "атырау": "3246", "ташкент": "2199", "самарканд": "2198", "бухара": "2197",
-    "хива": "2200"
-}
-
-MEALS_MAPPING = {
-    "RO": "1", "BB": "2", "HB": "3", "FB": "4", "AI": "5", "UAI": "6", "AI(NOALC)": "7"
-}
+# Состояния диалога
+class UserStates(StatesGroup):
+    COUNTRY = State()
+    DEPARTURE_CITY = State()
+    RESORTS = State()
+    MEALS = State()
+    ADULTS = State()
+    CHILDREN = State()
+    INFANTS = State()
+    NIGHTS = State()
+    HOTEL_CATEGORY = State()
+    DATES = State()
+
+# Структура для хранения параметров пользователя
+class UserParams:
+    """Параметры поиска пользователя в компактном виде: без __dict__, списки хранятся кортежами"""
+    
+    __slots__ = (
+        'countries', 'departure_city', 'night_range_from', 'night_range_to', 'resorts', 'meals',
+        'tourist_group_adults', 'tourist_group_kids', 'tourist_group_infants', 'hotel_categories',
+        'check_in_date_range_from', 'check_in_date_range_to'
+    )
+    
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+    
+    def __setattr__(self, name: str, value):
+        # ID и короткие значения повторяются у тысяч пользователей - храним по одному экземпляру строки
+        if isinstance(value, str):
+            value = sys.intern(value)
+        elif isinstance(value, (list, tuple)):
+            value = tuple(sys.intern(item) if isinstance(item, str) else item for item in value)
+        object.__setattr__(self, name, value)
+    
+    def to_dict(self) -> dict:
+        """Заполненные поля в виде, пригодном для JSON"""
+        fields = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                fields[name] = list(value) if isinstance(value, tuple) else value
+        return fields
+    
+    def size_bytes(self) -> int:
+        """Оценка занимаемой памяти (общие строки не учитываются)"""
+        size = sys.getsizeof(self)
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, tuple):
+                size += sys.getsizeof(value)
+        return size
+
+def _sorted_ids(values) -> Tuple[str, ...]:
+    """Упорядоченный набор ID без повторов"""
+    return tuple(sorted(set(values or ()), key=lambda value: (len(value), value)))
+
+# Канонический поисковый запрос: одинаковые параметры дают один и тот же ключ
+@dataclass(frozen=True)
+class SearchQuery:
+    countries: Tuple[str, ...] = ()
+    departure_city: Optional[str] = None
+    night_range_from: Optional[str] = None
+    night_range_to: Optional[str] = None
+    resorts: Tuple[str, ...] = ()
+    meals: Tuple[str, ...] = ()
+    tourist_group_adults: Optional[str] = None
+    tourist_group_kids: Optional[str] = None
+    tourist_group_infants: Optional[str] = None
+    hotel_categories: Tuple[str, ...] = ()
+    check_in_date_range_from: Optional[str] = None
+    check_in_date_range_to: Optional[str] = None
+    
+    @classmethod
+    def from_params(cls, params: UserParams) -> "SearchQuery":
+        """Построение запроса из параметров пользователя"""
+        return cls(
+            countries=_sorted_ids(params.countries),
+            departure_city=params.departure_city,
+            night_range_from=params.night_range_from,
+            night_range_to=params.night_range_to,
+            resorts=_sorted_ids(params.resorts),
+            meals=_sorted_ids(params.meals),
+            tourist_group_adults=params.tourist_group_adults,
+            tourist_group_kids=params.tourist_group_kids,
+            tourist_group_infants=params.tourist_group_infants,
+            hotel_categories=_sorted_ids(params.hotel_categories),
+            check_in_date_range_from=params.check_in_date_range_from,
+            check_in_date_range_to=params.check_in_date_range_to
+        )
+    
+    def to_url(self, base_url: str = None) -> str:
+        """Формирование URL запроса к API"""
+        url = base_url or f"{TRAVELATA_API_URL}{CHEAPEST_TOURS_PATH}"
+        
+        query_params = [f"countries[]={country}" for country in self.countries]
+        
+        if self.departure_city:
+            query_params.append(f"departureCity={self.departure_city}")
+        
+        if self.night_range_from:
+            query_params.append(f"nightRange[from]={self.night_range_from}")
+        
+        if self.night_range_to:
+            query_params.append(f"nightRange[to]={self.night_range_to}")
+        
+        query_params.extend(f"resorts[]={resort}" for resort in self.resorts)
+        query_params.extend(f"meals[]={meal}" for meal in self.meals)
+        
+        if self.tourist_group_adults:
+            query_params.append(f"touristGroup[adults]={self.tourist_group_adults}")
+        
+        if self.tourist_group_kids:
+            query_params.append(f"touristGroup[kids]={self.tourist_group_kids}")
+        
+        if self.tourist_group_infants:
+            query_params.append(f"touristGroup[infants]={self.tourist_group_infants}")
+        
+        query_params.extend(f"hotelCategories[]={category}" for category in self.hotel_categories)
+        
+        if self.check_in_date_range_from:
+            query_params.append(f"checkInDateRange[from]={self.check_in_date_range_from}")
+        
+        if self.check_in_date_range_to:
+            query_params.append(f"checkInDateRange[to]={self.check_in_date_range_to}")
+        
+        return f"{url}?{'&'.join(query_params)}"
+    
+    def to_json(self) -> str:
+        """Сериализация запроса для хранения"""
+        return json.dumps(asdict(self), ensure_ascii=False)
+    
+    @classmethod
+    def from_json(cls, text: str) -> "SearchQuery":
+        """Восстановление запроса из сохраненного вида"""
+        fields = json.loads(text)
+        return cls(**{
+            name: tuple(value) if isinstance(value, list) else value
+            for name, value in fields.items()
+        })
+
+def normalize_name(text: str) -> str:
+    """Приведение названия к виду для сравнения"""
+    return " ".join(text.lower().replace("ё", "е").split())
+
+class ReferenceIndex:
+    """Индекс справочника: прямой и обратный словари и триграммный поиск похожих названий"""
+    
+    def __init__(self, names_to_ids: Dict[str, str]):
+        self.names: List[str] = list(names_to_ids)
+        self.by_name: Dict[str, str] = {}
+        self.by_id: Dict[str, str] = {}
+        for name, item_id in names_to_ids.items():
+            self.by_name[normalize_name(name)] = item_id
+            # При нескольких названиях одного ID показываем первое
+            self.by_id.setdefault(item_id, name)
+        
+        # Триграмма -> номера названий, в которых она встречается
+        postings: Dict[str, List[int]] = defaultdict(list)
+        self.gram_counts: List[int] = []
+        for index, name in enumerate(self.names):
+            grams = self._trigrams(normalize_name(name))
+            self.gram_counts.append(len(grams))
+            for gram in grams:
+                postings[gram].append(index)
+        # Готовый индекс не меняется - кортежи занимают меньше памяти, чем растущие списки
+        self.postings: Dict[str, Tuple[int, ...]] = {gram: tuple(indexes) for gram, indexes in postings.items()}
+        
+        # Самое длинное название в словах - окно для разбора многословных курортов
+        self.max_words = max((len(name.split()) for name in self.by_name), default=1)
+    
+    @staticmethod
+    def _trigrams(text: str) -> set:
+        padded = f"  {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+    
+    def get(self, name: str) -> Optional[str]:
+        """ID по названию"""
+        return self.by_name.get(normalize_name(name))
+    
+    def name_of(self, item_id: str) -> Optional[str]:
+        """Название по ID"""
+        return self.by_id.get(item_id)
+    
+    def names_of(self, item_ids) -> List[str]:
+        """Названия по списку ID (неизвестные ID пропускаются)"""
+        return [self.by_id[item_id] for item_id in item_ids if item_id in self.by_id]
+    
+    def suggest(self, text: str, limit: int = 3, min_score: float = 0.3) -> List[str]:
+        """Похожие названия по убыванию сходства (коэффициент Дайса по триграммам)"""
+        text = normalize_name(text)
+        grams = self._trigrams(text)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        
+        scored = []
+        for index, common in shared.items():
+            score = 2 * common / (len(grams) + self.gram_counts[index])
+            # Ввод, являющийся частью названия, - хороший кандидат даже при низком сходстве
+            if text and text in normalize_name(self.names[index]):
+                score += 0.5
+            if score >= min_score:
+                scored.append((-score, self.names[index]))
+        
+        return [name for _, name in sorted(scored)[:limit]]
+    
+    def parse_list(self, text: str) -> Tuple[List[str], List[str], List[str]]:
+        """Разбор перечня названий с учетом многословных; возвращает ID, найденные и ненайденные названия"""
+        ids, found, unknown = [], [], []
+        for chunk in re.split(r"[,;\n]+", text):
+            words = normalize_name(chunk).split()
+            pending = []
+            i = 0
+            while i < len(words):
+                # Самое длинное совпадение, начинающееся с текущего слова
+                for size in range(min(self.max_words, len(words) - i), 0, -1):
+                    phrase = " ".join(words[i:i + size])
+                    if phrase in self.by_name:
+                        break
+                else:
+                    pending.append(words[i])
+                    i += 1
+                    continue
+                
+                if pending:
+                    unknown.append(" ".join(pending))
+                    pending = []
+                ids.append(self.by_name[phrase])
+                found.append(phrase)
+                i += size
+            
+            if pending:
+                unknown.append(" ".join(pending))
+        return ids, found, unknown
+
+# Справочники стран, городов вылета, курортов и питания хранятся в отдельном файле
+DICTIONARIES_PATH = os.getenv(
+    "DICTIONARIES_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "dictionaries.json")
+)
+DICTIONARIES_URL = os.getenv("DICTIONARIES_URL")  # источник обновлений; без него справочники не обновляются
+DICTIONARIES_REFRESH_INTERVAL = int(os.getenv("DICTIONARIES_REFRESH_INTERVAL", "3600"))
+
+class ReferenceData:
+    """Набор справочников одной версии; после создания не меняется"""
+    
+    __slots__ = ('version', 'countries', 'departure_cities', 'resorts', 'meals')
+    
+    def __init__(self, version: int, countries: ReferenceIndex, departure_cities: ReferenceIndex,
+                 resorts: ReferenceIndex, meals: Dict[str, str]):
+        self.version = version
+        self.countries = countries
+        self.departure_cities = departure_cities
+        self.resorts = resorts
+        self.meals = meals
+    
+    @classmethod
+    def from_payload(cls, payload: dict) -> "ReferenceData":
+        """Проверка содержимого файла справочников и построение индексов"""
+        sections = {}
+        for section in ('countries', 'departure_cities', 'resorts', 'meals'):
+            items = payload.get(section)
+            if not isinstance(items, dict) or not items:
+                raise ValueError(f"В справочниках нет раздела {section}")
+            # ID повторяются во многих записях - храним по одному экземпляру строки
+            sections[section] = {str(name): sys.intern(str(item_id)) for name, item_id in items.items()}
+        
+        return cls(
+            version=int(payload.get('version', 0)),
+            countries=ReferenceIndex(sections['countries']),
+            departure_cities=ReferenceIndex(sections['departure_cities']),
+            resorts=ReferenceIndex(sections['resorts']),
+            meals=sections['meals']
+        )
+
+def load_reference_data(path: str = DICTIONARIES_PATH) -> ReferenceData:
+    """Чтение справочников из файла"""
+    with open(path, 'rb') as f:
+        data = ReferenceData.from_payload(json.loads(f.read()))
+    logger.info(f"Загружены справочники версии {data.version} из {path}")
+    return data
+
+_reference_data: Optional[ReferenceData] = None
+
+def reference_data() -> ReferenceData:
+    """Текущие справочники; файл читается при первом обращении"""
+    global _reference_data
+    if _reference_data is None:
+        _reference_data = load_reference_data()
+    return _reference_data
+
+def replace_reference_data(data: ReferenceData):
+    """Атомарная подмена справочников: обработчики видят либо старую, либо новую версию целиком"""
+    global _reference_data
+    _reference_data = data
+
+# Количество параллельных сессий Chrome в пуле
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "2"))
+BROWSER_WARMUP = os.getenv("BROWSER_WARMUP", "0") == "1"  # запускать Chrome в фоне сразу после старта
+# Сторож браузеров: плановый перезапуск сессий и проверка, что они живы
+BROWSER_MAX_NAVIGATIONS = int(os.getenv("BROWSER_MAX_NAVIGATIONS", "200"))
+BROWSER_MAX_RSS_MB = int(os.getenv("BROWSER_MAX_RSS_MB", "1024"))  # память Chrome со всеми дочерними процессами
+BROWSER_PROBE_INTERVAL = 60  # как часто проверяются простаивающие сессии (секунды)
+BROWSER_PROBE_TIMEOUT = 5
+# Готовый chromedriver; без него путь определяется один раз и запоминается в файле
+CHROMEDRIVER_PATH = os.getenv("CHROMEDRIVER_PATH")
+CHROMEDRIVER_CACHE_FILE = os.getenv("CHROMEDRIVER_CACHE_FILE", ".chromedriver_path")
+# Облегченный режим браузера: без картинок, шрифтов, стилей и счетчиков, с повторным использованием вкладки
+BROWSER_LEAN = os.getenv("BROWSER_LEAN", "1") == "1"
+BROWSER_BLOCKED_URLS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.css",
+    "*google-analytics.com*", "*googletagmanager.com*", "*mc.yandex.ru*", "*doubleclick.net*"
+]
+
+# Режим шардов: запросы к API и их разбор выполняют отдельные процессы со своими браузерами
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))  # 0 - все в одном процессе
+SHARD_BROWSER_POOL_SIZE = int(os.getenv("SHARD_BROWSER_POOL_SIZE", "1"))
+
+# Получение обновлений: polling или webhook (Telegram сам присылает обновления на наш HTTP-сервер)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес сервера, например https://example.herokuapp.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # без него секрет выводится из токена, одинаковый во всех процессах
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_MAX_CONCURRENT = int(os.getenv("WEBHOOK_MAX_CONCURRENT", "64"))  # одновременно обрабатываемых обновлений
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "1024"))  # принятых, но еще не обработанных обновлений
+
+# Разбиение широких поисков на подзапросы
+SEARCH_FANOUT_MAX = int(os.getenv("SEARCH_FANOUT_MAX", "8"))  # не больше подзапросов на один поиск
+SEARCH_FANOUT_CONCURRENCY = int(os.getenv("SEARCH_FANOUT_CONCURRENCY", "4"))  # одновременно выполняемых подзапросов
+
+# Адрес API поиска туров (можно подменить на локальный stub-сервер)
+TRAVELATA_API_URL = os.getenv("TRAVELATA_API_URL", "https://api-gateway.travelata.ru")
+CHEAPEST_TOURS_PATH = "/statistic/cheapestTours"
+
+# Настройки HTTP-клиента
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "20"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+# Общий кэш ответов API
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "300"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+
+# Настройки мониторинга
+MONITORING_INTERVAL = 600  # начальная задержка 10 минут
+MONITORING_MAX_INTERVAL = 3600  # максимальная задержка 1 час
+MONITORING_WORKERS = int(os.getenv("MONITORING_WORKERS", "4"))
+MONITORING_JITTER = 0.1  # случайный разброс времени проверки (доля от задержки)
+MONITORING_DB_PATH = os.getenv("MONITORING_DB_PATH", "monitoring.db")
+MONITORING_FLUSH_INTERVAL = 1.0  # как часто накопленные записи сбрасываются в базу (секунды)
+# Подписку проверяет один процесс-владелец; брошенные подписки упавших процессов подбирают остальные
+MONITORING_LEASE_TTL = 180  # через сколько секунд без продления подписка считается брошенной
+MONITORING_LEASE_RENEW = 60  # как часто процесс продлевает свои подписки и подбирает брошенные
+MONITORING_OFFER_TTL = int(os.getenv("MONITORING_OFFER_TTL", str(24 * 3600)))  # сколько хранится поиск без мониторинга
+
+# Лимиты Telegram на исходящие сообщения
+TELEGRAM_GLOBAL_RATE = 30  # сообщений в секунду на бота
+TELEGRAM_CHAT_RATE = 1  # сообщений в секунду в один чат
+TELEGRAM_CHAT_BURST = 3  # сколько сообщений подряд можно отправить в чат без паузы
+TELEGRAM_MAX_IN_FLIGHT = 30  # одновременных запросов sendMessage
+
+# Ограничение частоты входящих запросов от одного пользователя
+THROTTLE_RATE = 0.5  # запросов в секунду в среднем
+THROTTLE_BURST = 5  # сколько запросов подряд проходит без ограничения
+THROTTLE_IDLE_TTL = 600  # через сколько секунд простоя ведро пользователя забывается
+THROTTLE_MAX_USERS = 100_000
+
+# Постраничный вывод результатов поиска
+HOTELS_PER_PAGE = 10
+SEARCH_SESSION_TTL = 3600  # сколько хранится результат для листания (секунды)
+SEARCH_SESSION_LIMIT = 10_000
+SEARCH_SESSION_MAX_HOTELS = int(os.getenv("SEARCH_SESSION_MAX_HOTELS", "100"))  # сколько отелей можно пролистать
+SEARCH_SESSION_MAX_BYTES = int(os.getenv("SEARCH_SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+TELEGRAM_MESSAGE_LIMIT = 4096  # предел длины текста сообщения (в UTF-16 символах)
+
+# Кэш результатов по отдельным дням заезда: пересекающиеся диапазоны дат запрашивают только недостающие дни
+DAY_SLICE_CACHE_SIZE = int(os.getenv("DAY_SLICE_CACHE_SIZE", "4096"))
+DAY_SLICE_MAX_DAYS = 62  # более широкие диапазоны запрашиваются целиком
+
+# Параметры поиска пользователей
+USER_SESSION_TTL = int(os.getenv("USER_SESSION_TTL", str(7 * 24 * 3600)))  # сколько хранятся после последнего обращения
+USER_SESSION_LIMIT = int(os.getenv("USER_SESSION_LIMIT", "50000"))
+
+# Счетчики кэшей, очередей и ограничений: /metrics в режиме webhook и периодически в лог
+STATS_LOG_INTERVAL = int(os.getenv("STATS_LOG_INTERVAL", "600"))  # 0 - не писать в лог
+
+# Общее хранилище диалогов для нескольких процессов бота; без пути состояние живет в памяти процесса
+FSM_STORAGE_PATH = os.getenv("FSM_STORAGE_PATH")
+FSM_STORAGE_POOL_SIZE = int(os.getenv("FSM_STORAGE_POOL_SIZE", "4"))
+USER_PARAMS_DESTINY = "user_params"  # параметры поиска лежат в хранилище рядом с состоянием диалога
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+# Измерения, по которым широкий запрос делится на подзапросы; курорты точнее стран,
+# поэтому при делении по курортам страны не делятся (иначе появятся пары страна-чужой курорт)
+FANOUT_DIMENSIONS = (('resorts', 'countries'), ('meals',), ('hotel_categories',))
+
+def plan_queries(query: SearchQuery, max_queries: int = SEARCH_FANOUT_MAX) -> List[SearchQuery]:
+    """Разбиение запроса с несколькими значениями фильтров на подзапросы по одному значению"""
+    queries = [query]
+    for alternatives in FANOUT_DIMENSIONS:
+        for field in alternatives:
+            values = getattr(query, field)
+            if len(values) > 1:
+                break
+        else:
+            continue
+        if len(queries) * len(values) > max_queries:
+            continue
+        queries = [replace(sub_query, **{field: (value,)}) for sub_query in queries for value in values]
+    return queries
+
+def check_in_days(query: SearchQuery) -> Optional[List[str]]:
+    """Дни заезда из диапазона запроса; None, если диапазон не задан или слишком широк"""
+    if not query.check_in_date_range_from or not query.check_in_date_range_to:
+        return None
+    try:
+        first = datetime.strptime(query.check_in_date_range_from, "%Y-%m-%d")
+        last = datetime.strptime(query.check_in_date_range_to, "%Y-%m-%d")
+    except ValueError:
+        return None
+    count = (last - first).days + 1
+    if count < 1 or count > DAY_SLICE_MAX_DAYS:
+        return None
+    return [(first + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range(count)]
+
+def contiguous_runs(days: List[str], missing: set) -> List[List[str]]:
+    """Недостающие дни, собранные в непрерывные отрезки (по запросу к API на отрезок)"""
+    runs = []
+    current: List[str] = []
+    for day in days:
+        if day in missing:
+            current.append(day)
+        elif current:
+            runs.append(current)
+            current = []
+    if current:
+        runs.append(current)
+    return runs
+
+class TTLCache:
+    """Кэш с временем жизни записей и LRU-вытеснением по размеру"""
+    
+    def __init__(self, ttl: float, max_size: int, max_bytes: Optional[int] = None,
+                 size_of: Optional[Callable[[Any], int]] = None):
+        self.ttl = ttl
+        self.max_size = max_size
+        # Необязательный предел по памяти: size_of(value) оценивает размер записи в байтах
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.bytes = 0
+        self._data: OrderedDict = OrderedDict()  # ключ -> (время истечения, значение, размер)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key, default=None):
+        """Получение значения, если запись еще не устарела"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        
+        expires_at, value, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return default
+        
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value):
+        """Сохранение значения с вытеснением самых старых записей"""
+        size = self.size_of(value) if self.size_of else 0
+        self._remove(key)
+        self._data[key] = (time.monotonic() + self.ttl, value, size)
+        self.bytes += size
+        # Последняя запись остается, даже если одна превышает предел по памяти
+        while len(self._data) > self.max_size or (
+            self.max_bytes is not None and self.bytes > self.max_bytes and len(self._data) > 1
+        ):
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+    
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+        return entry
+    
+    def pop(self, key, default=None):
+        """Удаление записи"""
+        entry = self._remove(key)
+        return entry[1] if entry else default
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def values(self):
+        """Значения всех записей, включая еще не удаленные устаревшие"""
+        return [entry[1] for entry in self._data.values()]
+    
+    def purge(self, limit: int = 100) -> int:
+        """Удаление устаревших записей из начала очереди; возвращает их количество"""
+        now = time.monotonic()
+        removed = 0
+        while self._data and removed < limit:
+            key, (expires_at, _, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            self._remove(key)
+            removed += 1
+        self.evictions += removed
+        return removed
+    
+    def stats(self) -> Dict[str, int]:
+        """Счетчики попаданий и промахов"""
+        return {
+            'size': len(self._data),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+class SessionStore:
+    """Параметры поиска пользователей с вытеснением простаивающих и самых давних сессий"""
+    
+    def __init__(self, ttl: float = USER_SESSION_TTL, max_size: int = USER_SESSION_LIMIT):
+        self.sessions = TTLCache(ttl, max_size)
+    
+    def get(self, user_id: int) -> Optional[UserParams]:
+        """Параметры пользователя, если сессия жива; обращение продлевает ее"""
+        params = self.sessions.get(user_id)
+        if params is not None:
+            self.sessions.set(user_id, params)
+        return params
+    
+    def params(self, user_id: int) -> UserParams:
+        """Параметры пользователя; для нового или забытого пользователя создаются пустые"""
+        params = self.get(user_id)
+        if params is None:
+            params = self.reset(user_id)
+        return params
+    
+    def put(self, user_id: int, params: Optional[UserParams]) -> None:
+        """Подмена параметров загруженными из общего хранилища"""
+        if params is None:
+            self.sessions.pop(user_id)
+        else:
+            self.sessions.set(user_id, params)
+    
+    def reset(self, user_id: int) -> UserParams:
+        """Начало новой сессии с пустыми параметрами"""
+        # Продление сессии переносит ее в конец очереди, поэтому в начале - самые давние
+        self.sessions.purge()
+        params = UserParams()
+        self.sessions.set(user_id, params)
+        return params
+    
+    def __len__(self) -> int:
+        return len(self.sessions)
+    
+    def stats(self) -> Dict[str, int]:
+        """Количество сессий и оценка занимаемой ими памяти"""
+        stats = self.sessions.stats()
+        stats['estimated_bytes'] = sum(params.size_bytes() for params in self.sessions.values())
+        return stats
+
+class SingleFlight:
+    """Объединение одинаковых одновременных запросов в один"""
+    
+    def __init__(self):
+        self.in_flight: Dict = {}
+        self.shared = 0  # сколько вызовов дождались чужого запроса
+    
+    async def do(self, key, func):
+        """Выполнение func() один раз для всех одновременных вызовов с ключом key"""
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            task = asyncio.ensure_future(func())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+class MonitoringScheduler:
+    """Центральный планировщик проверок мониторинга с ограниченным пулом воркеров"""
+    
+    def __init__(self, check: Callable[[int], Awaitable[Optional[float]]],
+                 workers: int = MONITORING_WORKERS, jitter: float = MONITORING_JITTER,
+                 partitions: int = 1, partition_of: Optional[Callable[[object], int]] = None):
+        # check(user_id) выполняет проверку и возвращает задержку до следующей (None - снять с мониторинга)
+        self.check = check
+        self.jitter = jitter
+        # Раздел - шард поиска: у каждого свои воркеры и очередь, медленный шард не задерживает остальные
+        self.partitions = max(1, partitions)
+        self.partition_of = partition_of or (lambda key: 0)
+        self.workers = max(1, workers // self.partitions)
+        self.heap: List[Tuple[float, int, int]] = []  # (время проверки, номер записи, user_id)
+        self.entries: Dict[int, Tuple[int, object]] = {}  # user_id -> (номер записи, ключ запроса)
+        self.running: Dict[int, asyncio.Task] = {}  # user_id -> выполняющаяся проверка
+        self.jobs = [asyncio.Queue(maxsize=self.workers * 2) for _ in range(self.partitions)]
+        self.tasks: List[asyncio.Task] = []
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self.checks_done = 0
+    
+    def schedule(self, user_id: int, key, delay: float) -> None:
+        """Постановка (или перепостановка) проверки пользователя"""
+        self._seq += 1
+        # Старая запись пользователя становится неактуальной - повторное включение не создает дубликат
+        self.entries[user_id] = (self._seq, key)
+        due = time.monotonic() + self._with_jitter(delay)
+        heapq.heappush(self.heap, (due, self._seq, user_id))
+        self._wakeup.set()
+    
+    def unschedule(self, user_id: int) -> None:
+        """Снятие пользователя с мониторинга и отмена текущей проверки"""
+        self.entries.pop(user_id, None)
+        task = self.running.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+    
+    def _with_jitter(self, delay: float) -> float:
+        """Разброс времени, чтобы проверки не срабатывали одновременно"""
+        return max(0.0, delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    async def start(self):
+        """Запуск диспетчера и воркеров"""
+        if self.tasks:
+            return
+        self.tasks.append(asyncio.create_task(self._dispatch()))
+        for jobs in self.jobs:
+            for _ in range(self.workers):
+                self.tasks.append(asyncio.create_task(self._worker(jobs)))
+        logger.info(
+            f"Планировщик мониторинга запущен, разделов: {self.partitions}, воркеров в разделе: {self.workers}"
+        )
+    
+    async def stop(self):
+        """Остановка планировщика"""
+        for task in list(self.running.values()) + self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+        self.running.clear()
+    
+    def _pop_due(self) -> Dict[object, List[int]]:
+        """Извлечение наступивших проверок, сгруппированных по ключу запроса"""
+        now = time.monotonic()
+        groups = defaultdict(list)
+        while self.heap and self.heap[0][0] <= now:
+            _, seq, user_id = heapq.heappop(self.heap)
+            entry = self.entries.get(user_id)
+            # Пропускаем отмененные и замененные записи
+            if entry is None or entry[0] != seq:
+                continue
+            if user_id in self.running:
+                # Предыдущая проверка еще идет - откладываем, не запуская вторую параллельно
+                heapq.heappush(self.heap, (now + 1, seq, user_id))
+                continue
+            groups[entry[1]].append(user_id)
+        return groups
+    
+    async def _dispatch(self):
+        """Передача наступивших проверок воркерам"""
+        while True:
+            self._wakeup.clear()
+            for key, user_ids in self._pop_due().items():
+                # Очереди ограничены: при занятых воркерах раздела проверки откладываются, темп запросов
+                # предсказуем, а проверки остальных разделов не ждут
+                try:
+                    self.jobs[self.partition_of(key)].put_nowait(user_ids)
+                except asyncio.QueueFull:
+                    self._defer(user_ids, 1.0)
+            
+            timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    def _defer(self, user_ids: List[int], delay: float) -> None:
+        """Перенос уже извлеченных проверок на delay секунд с сохранением их записей"""
+        due = time.monotonic() + delay
+        for user_id in user_ids:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                heapq.heappush(self.heap, (due, entry[0], user_id))
+    
+    async def _worker(self, jobs: asyncio.Queue):
+        """Выполнение проверок; пользователи с одним запросом проверяются подряд и делят один ответ API"""
+        while True:
+            user_ids = await jobs.get()
+            try:
+                for user_id in user_ids:
+                    await self._run_check(user_id)
+            finally:
+                jobs.task_done()
+    
+    async def _run_check(self, user_id: int):
+        """Одна проверка пользователя и перепостановка по ее результату"""
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return
+        
+        task = asyncio.create_task(self.check(user_id))
+        self.running[user_id] = task
+        try:
+            delay = await task
+        except asyncio.CancelledError:
+            # unschedule() убирает проверку из running до отмены; иначе отменяют сам воркер (остановка)
+            if not task.cancelled() or self.running.get(user_id) is task:
+                raise
+            return
+        except Exception as e:
+            logger.error(f"Ошибка при проверке мониторинга: {e}")
+            delay = MONITORING_INTERVAL
+        finally:
+            if self.running.get(user_id) is task:
+                del self.running[user_id]
+            self.checks_done += 1
+        
+        # Перепланируем, только если за время проверки пользователь не отписался и не перезапустил мониторинг
+        if self.entries.get(user_id) is entry:
+            if delay is None:
+                del self.entries[user_id]
+            else:
+                self.schedule(user_id, entry[1], delay)
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, запас не больше capacity"""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def reserve(self, now: float = None) -> float:
+        """Резерв токена в долг; возвращает, сколько секунд ждать до его появления"""
+        self._refill(time.monotonic() if now is None else now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+    
+    def try_acquire(self, now: float = None) -> bool:
+        """Взятие токена без ожидания; False, если токенов нет"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничение частоты запросов пользователя без задержки обработчиков"""
+    
+    def __init__(self, rate: float = THROTTLE_RATE, burst: int = THROTTLE_BURST,
+                 idle_ttl: float = THROTTLE_IDLE_TTL, max_users: int = THROTTLE_MAX_USERS):
+        self.rate = rate
+        self.burst = burst
+        # Ведра простаивающих пользователей вытесняются по времени и по размеру
+        self.buckets = TTLCache(ttl=idle_ttl, max_size=max_users)
+        self.throttled = 0
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        
+        bucket = self.buckets.get(user.id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+        self.buckets.set(user.id, bucket)
+        
+        if bucket.try_acquire():
+            return await handler(event, data)
+        
+        # Лишний запрос отбрасывается сразу; на нажатие кнопки отвечаем, чтобы не висели "часики"
+        self.throttled += 1
+        if isinstance(event, CallbackQuery):
+            await event.answer("⏳ Слишком много запросов, подождите немного")
+        return None
+
+class OutgoingMessage:
+    """Сообщение в очереди отправки"""
+    
+    __slots__ = ('chat_id', 'text', 'kwargs', 'priority', 'future', 'message_id', 'seq')
+    
+    def __init__(self, chat_id: int, text: str, kwargs: dict, priority: int, future: asyncio.Future,
+                 message_id: Optional[int] = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.message_id = message_id  # задан - редактирование этого сообщения вместо отправки нового
+        self.seq = 0  # порядковый номер постановки; сохраняется при повторе
+
+class OutboundQueue:
+    """Очередь исходящих сообщений с глобальным и по-чатовыми лимитами Telegram"""
+    
+    # Полосы приоритета: ответы пользователю идут раньше уведомлений мониторинга
+    INTERACTIVE = 0
+    MONITORING = 1
+    
+    def __init__(self, bot: Bot, global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 chat_rate: float = TELEGRAM_CHAT_RATE, chat_burst: int = TELEGRAM_CHAT_BURST,
+                 max_in_flight: int = TELEGRAM_MAX_IN_FLIGHT):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        # Ведро простаивающего чата полное, его можно забыть и создать заново
+        self.chat_buckets = TTLCache(ttl=60, max_size=100_000)
+        self.ready: List[Tuple[int, int, OutgoingMessage]] = []  # (приоритет, номер, сообщение)
+        self.delayed: List[Tuple[float, int, OutgoingMessage]] = []  # (когда можно отправить, номер, сообщение)
+        # Очереди чатов: в ready/delayed или в отправке только первое сообщение чата, остальные ждут его
+        self.chats: Dict[int, deque] = {}
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.paused_until = 0.0  # пауза после RetryAfter от Telegram
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+    
+    def start(self) -> None:
+        """Запуск диспетчера отправки"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+    
+    async def stop(self) -> None:
+        """Остановка диспетчера"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    def send_message(self, chat_id: int, text: str, priority: int = INTERACTIVE, **kwargs) -> asyncio.Future:
+        """Постановка сообщения в очередь; результат - отправленное сообщение"""
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(OutgoingMessage(chat_id, text, kwargs, priority, future))
+        return future
+    
+    def edit_message(self, chat_id: int, message_id: int, text: str,
+                     priority: int = INTERACTIVE, **kwargs) -> asyncio.Future:
+        """Постановка в очередь редактирования сообщения; в чате соблюдается общий порядок с отправкой"""
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(OutgoingMessage(chat_id, text, kwargs, priority, future, message_id))
+        return future
+    
+    def _enqueue(self, item: OutgoingMessage) -> None:
+        self.start()
+        self._seq += 1
+        item.seq = self._seq
+        waiting = self.chats.get(item.chat_id)
+        if waiting is not None:
+            # Предыдущее сообщение чата еще не доставлено - это встанет за ним
+            waiting.append(item)
+            return
+        self.chats[item.chat_id] = deque()
+        self._push(item)
+    
+    def _advance(self, chat_id: int) -> None:
+        """Сообщение чата доставлено (или окончательно не доставлено) - в очередь идет следующее"""
+        waiting = self.chats.get(chat_id)
+        if waiting:
+            self._push(waiting.popleft())
+        else:
+            self.chats.pop(chat_id, None)
+    
+    def _push(self, item: OutgoingMessage, not_before: float = 0.0) -> None:
+        """Резерв места в лимите чата и постановка в нужную очередь"""
+        now = time.monotonic()
+        bucket = self.chat_buckets.get(item.chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        self.chat_buckets.set(item.chat_id, bucket)
+        
+        ready_at = max(now + bucket.reserve(now), not_before)
+        if ready_at <= now:
+            heapq.heappush(self.ready, (item.priority, item.seq, item))
+        else:
+            heapq.heappush(self.delayed, (ready_at, item.seq, item))
+        self._wakeup.set()
+    
+    async def _dispatch(self):
+        """Отправка сообщений в темпе, разрешенном Telegram"""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                _, seq, item = heapq.heappop(self.delayed)
+                heapq.heappush(self.ready, (item.priority, seq, item))
+            
+            if not self.ready:
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            wait = max(self.global_bucket.reserve(now), self.paused_until - now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                # За время ожидания могли появиться более приоритетные сообщения
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, seq, item = heapq.heappop(self.delayed)
+                    heapq.heappush(self.ready, (item.priority, seq, item))
+            
+            _, _, item = heapq.heappop(self.ready)
+            await self.in_flight.acquire()
+            asyncio.create_task(self._deliver(item))
+    
+    async def _deliver(self, item: OutgoingMessage):
+        """Отправка одного сообщения с обработкой RetryAfter"""
+        try:
+            if item.message_id is None:
+                result = await self.bot.send_message(item.chat_id, item.text, **item.kwargs)
+            else:
+                result = await self.bot.edit_message_text(
+                    item.text, chat_id=item.chat_id, message_id=item.message_id, **item.kwargs
+                )
+        except TelegramRetryAfter as e:
+            # Flood control: ставим на паузу всю отправку и повторяем сообщение позже.
+            # Сообщение остается первым в своем чате, следующие сообщения чата не обгонят его
+            self.retries += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            logger.warning(f"Telegram просит подождать {e.retry_after} с, сообщение отложено")
+            self._push(item, not_before=self.paused_until)
+        except Exception as e:
+            self.failed += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+            self._advance(item.chat_id)
+        else:
+            self.sent += 1
+            if not item.future.done():
+                item.future.set_result(result)
+            self._advance(item.chat_id)
+        finally:
+            self.in_flight.release()
+    
+    def stats(self) -> Dict[str, int]:
+        """Глубина очереди по полосам и счетчики отправки"""
+        queued = [item for _, _, item in self.ready] + [item for _, _, item in self.delayed]
+        waiting = [item for items in self.chats.values() for item in items]
+        queued += waiting
+        return {
+            'interactive': sum(1 for item in queued if item.priority == self.INTERACTIVE),
+            'monitoring': sum(1 for item in queued if item.priority == self.MONITORING),
+            'delayed': len(self.delayed),
+            'waiting': len(waiting),
+            'sent': self.sent,
+            'retries': self.retries,
+            'failed': self.failed
+        }
+
+class FetchError(Exception):
+    """Ошибка получения данных от системы поиска"""
+
+class FetchBlockedError(FetchError):
+    """Прямой HTTP-запрос заблокирован на стороне сервера"""
+
+def decode_payload(body: bytes) -> dict:
+    """Однократный разбор тела ответа API"""
+    try:
+        data = orjson.loads(body) if orjson else json.loads(body)
+    except ValueError as e:
+        logger.error(f"Ошибка декодирования JSON: {e}")
+        raise FetchError("Ошибка: Неверный формат данных от сервера")
+    
+    if not isinstance(data, dict) or not data.get('success') or 'data' not in data:
+        raise FetchError("Ошибка получения данных от системы поиска")
+    return data
+
+class TourTable:
+    """Колоночное представление туров: числовые массивы и словарное кодирование строк"""
+    
+    __slots__ = ('hotel_id', 'price', 'nights', 'meal_id', 'date_code', 'info_code', 'dates', 'infos', 'urls')
+    
+    def __init__(self, hotel_id, price, nights, meal_id, date_code, info_code,
+                 dates: List[str], infos: List[Tuple[str, str, float]], urls: List[str]):
+        self.hotel_id = hotel_id  # np.int64
+        self.price = price  # np.int64
+        self.nights = nights  # np.int32
+        self.meal_id = meal_id  # np.int32
+        self.date_code = date_code  # np.int32, индекс в dates
+        self.info_code = info_code  # np.int32, индекс в infos
+        self.dates = dates  # уникальные даты заезда
+        self.infos = infos  # уникальные (название, категория, рейтинг) отелей
+        self.urls = urls  # ссылки на туры (уникальны для каждой строки)
+    
+    @classmethod
+    def from_tours(cls, tours: List[dict]) -> "TourTable":
+        """Построение таблицы из списка туров ответа API"""
+        dates: Dict[str, int] = {}
+        infos: Dict[Tuple[str, str, float], int] = {}
+        date_codes = []
+        info_codes = []
+        for tour in tours:
+            date_codes.append(dates.setdefault(tour['checkinDate'], len(dates)))
+            info = (tour['hotelName'], tour['hotelCategoryName'], float(tour['hotelRating']))
+            info_codes.append(infos.setdefault(info, len(infos)))
+        
+        # Цены округляются явно: дробная цена не должна молча обрезаться приведением к целому
+        price = np.rint(np.fromiter((tour['price'] for tour in tours), dtype=np.float64, count=len(tours)))
+        return cls(
+            hotel_id=np.fromiter((tour['hotelId'] for tour in tours), dtype=np.int64, count=len(tours)),
+            price=price.astype(np.int64),
+            nights=np.fromiter((tour['nights'] for tour in tours), dtype=np.int32, count=len(tours)),
+            meal_id=np.fromiter((tour['mealId'] for tour in tours), dtype=np.int32, count=len(tours)),
+            date_code=np.array(date_codes, dtype=np.int32),
+            info_code=np.array(info_codes, dtype=np.int32),
+            dates=list(dates),
+            infos=list(infos),
+            urls=[tour['tourPageUrl'] for tour in tours]
+        )
+    
+    @classmethod
+    def concat(cls, tables: List["TourTable"]) -> "TourTable":
+        """Объединение таблиц с перекодированием словарей дат и отелей в общие"""
+        if len(tables) == 1:
+            return tables[0]
+        dates: Dict[str, int] = {}
+        infos: Dict[Tuple[str, str, float], int] = {}
+        date_codes = []
+        info_codes = []
+        for table in tables:
+            date_map = np.array([dates.setdefault(date, len(dates)) for date in table.dates], dtype=np.int32)
+            info_map = np.array([infos.setdefault(info, len(infos)) for info in table.infos], dtype=np.int32)
+            date_codes.append(date_map[table.date_code])
+            info_codes.append(info_map[table.info_code])
+        
+        def column(name: str, dtype):
+            return np.concatenate([getattr(table, name) for table in tables] or [np.empty(0, dtype=dtype)])
+        
+        return cls(
+            hotel_id=column('hotel_id', np.int64),
+            price=column('price', np.int64),
+            nights=column('nights', np.int32),
+            meal_id=column('meal_id', np.int32),
+            date_code=np.concatenate(date_codes or [np.empty(0, dtype=np.int32)]).astype(np.int32),
+            info_code=np.concatenate(info_codes or [np.empty(0, dtype=np.int32)]).astype(np.int32),
+            dates=list(dates),
+            infos=list(infos),
+            urls=[url for table in tables for url in table.urls]
+        )
+    
+    def take(self, rows) -> "TourTable":
+        """Подтаблица из строк rows; в словарях дат и отелей остаются только ее значения"""
+        rows = np.asarray(rows, dtype=np.int64)
+        date_used, date_code = np.unique(self.date_code[rows], return_inverse=True)
+        info_used, info_code = np.unique(self.info_code[rows], return_inverse=True)
+        return TourTable(
+            hotel_id=self.hotel_id[rows],
+            price=self.price[rows],
+            nights=self.nights[rows],
+            meal_id=self.meal_id[rows],
+            date_code=date_code.astype(np.int32),
+            info_code=info_code.astype(np.int32),
+            dates=[self.dates[code] for code in date_used.tolist()],
+            infos=[self.infos[code] for code in info_used.tolist()],
+            urls=[self.urls[row] for row in rows.tolist()]
+        )
+    
+    def split_by_day(self, days: List[str]) -> Dict[str, "TourTable"]:
+        """Раскладка туров по дням заезда; для дней без туров - пустые таблицы"""
+        position = {day: index for index, day in enumerate(days)}
+        # Дата может прийти со временем - день определяем по первым 10 символам
+        code_day = np.array([position.get(str(date)[:10], -1) for date in self.dates], dtype=np.int64)
+        row_day = code_day[self.date_code]
+        order = np.argsort(row_day, kind='stable')
+        bounds = np.searchsorted(row_day[order], np.arange(len(days) + 1)).tolist()
+        return {day: self.take(order[bounds[index]:bounds[index + 1]]) for index, day in enumerate(days)}
+    
+    def __len__(self) -> int:
+        return len(self.price)
+    
+    def group_by_hotel(self) -> "HotelGroups":
+        """Векторная группировка по отелям"""
+        return HotelGroups(self)
+
+def merge_tables(tables: List[TourTable]) -> TourTable:
+    """Слияние таблиц по возрастанию цены; повторы убираются только между таблицами, а не внутри одной"""
+    merged = TourTable.concat(tables)
+    if not len(merged):
+        return merged
+    # Номер исходной таблицы для каждой строки: ответ API может честно содержать одинаковые туры
+    # (разные операторы), и "Всего туров" не должно зависеть от того, был ли запрос разбит на части
+    source = np.repeat(np.arange(len(tables)), [len(table) for table in tables])
+    # Ключ тура - (отель, дата заезда, ночи, питание); внутри ключа строки по цене, затем по таблице
+    order = np.lexsort((source, merged.price, merged.meal_id, merged.nights, merged.date_code, merged.hotel_id))
+    keys = np.column_stack((merged.hotel_id, merged.date_code, merged.nights, merged.meal_id))[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+    # Для пересекающихся ключей оставляем строки одной таблицы - той, где тур дешевле
+    group = np.cumsum(first) - 1
+    winner = source[order][first]
+    rows = order[source[order] == winner[group]]
+    return merged.take(rows[np.lexsort((rows, merged.price[rows]))])
+
+class HotelGroups:
+    """Агрегаты по отелям в виде массивов (порядок - первое появление отеля в ответе)"""
+    
+    __slots__ = (
+        'table', 'hotel_id', 'first_row', 'cheapest_row', 'min_price', 'max_price',
+        'min_nights', 'max_nights', 'tours_count', 'row_group', '_date_pairs', '_meal_pairs', '_meal_base'
+    )
+    
+    def __init__(self, table: TourTable):
+        self.table = table
+        if not len(table):
+            empty = np.empty(0, dtype=np.int64)
+            self.hotel_id = self.first_row = self.cheapest_row = self.tours_count = self.row_group = empty
+            self.min_price = self.max_price = self.min_nights = self.max_nights = empty
+            self._date_pairs = self._meal_pairs = (empty, empty)
+            self._meal_base = 0
+            return
+        
+        hotel_ids, first_row, inverse, counts = np.unique(
+            table.hotel_id, return_index=True, return_inverse=True, return_counts=True
+        )
+        # Сортировка по отелю, внутри отеля - по цене (lexsort устойчив: при равной цене первым идет ранний тур)
+        order = np.lexsort((table.price, inverse))
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        prices = table.price[order]
+        nights = table.nights[order]
+        
+        # Переставляем группы в порядок первого появления отеля
+        appearance = np.argsort(first_row, kind='stable')
+        self.hotel_id = hotel_ids[appearance]
+        self.first_row = first_row[appearance]
+        self.cheapest_row = order[starts][appearance]
+        self.min_price = prices[starts][appearance]
+        self.max_price = np.maximum.reduceat(prices, starts)[appearance]
+        self.min_nights = np.minimum.reduceat(nights, starts)[appearance]
+        self.max_nights = np.maximum.reduceat(nights, starts)[appearance]
+        self.tours_count = counts[appearance]
+        
+        # Уникальные пары (отель, дата) и (отель, питание) для множеств дат и питания
+        rank = np.empty_like(appearance)
+        rank[appearance] = np.arange(len(appearance))
+        group = rank[inverse]
+        self.row_group = group  # номер группы (отеля) для каждой строки таблицы
+        self._date_pairs = self._unique_pairs(group, table.date_code, len(table.dates))
+        self._meal_base = int(table.meal_id.min())
+        meal_span = int(table.meal_id.max()) - self._meal_base + 1
+        self._meal_pairs = self._unique_pairs(group, table.meal_id.astype(np.int64) - self._meal_base, meal_span)
+    
+    @staticmethod
+    def _unique_pairs(group, values, cardinality: int):
+        """Уникальные пары (группа, значение), упорядоченные по группе"""
+        keys = np.unique(group.astype(np.int64) * cardinality + values)
+        return keys // cardinality, keys % cardinality
+    
+    def __len__(self) -> int:
+        return len(self.hotel_id)
+    
+    def _values_of(self, pairs, index: int):
+        """Значения пар, относящиеся к группе index"""
+        groups, values = pairs
+        lo, hi = np.searchsorted(groups, (index, index + 1))
+        return values[lo:hi]
+    
+    def top_k(self, k: int):
+        """Индексы k самых дешевых отелей по возрастанию цены"""
+        count = len(self)
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        if k < count:
+            # argpartition находит k-ю цену за O(n); отели с такой же ценой тоже берем,
+            # чтобы порядок совпадал с полной устойчивой сортировкой
+            threshold = self.min_price[np.argpartition(self.min_price, k - 1)[k - 1]]
+            candidates = np.flatnonzero(self.min_price <= threshold)
+        else:
+            candidates = np.arange(count)
+        ordered = candidates[np.lexsort((candidates, self.min_price[candidates]))]
+        return ordered[:k]
+    
+    def hotel(self, index: int) -> "HotelAggregate":
+        """Сводка по одному отелю"""
+        table = self.table
+        name, category, rating = table.infos[table.info_code[self.first_row[index]]]
+        return HotelAggregate(
+            hotel_id=int(self.hotel_id[index]),
+            name=name,
+            category=category,
+            rating=rating,
+            min_price=int(self.min_price[index]),
+            max_price=int(self.max_price[index]),
+            min_nights=int(self.min_nights[index]),
+            max_nights=int(self.max_nights[index]),
+            checkin_dates={table.dates[code] for code in self._values_of(self._date_pairs, index)},
+            meal_ids={int(code) + self._meal_base for code in self._values_of(self._meal_pairs, index)},
+            tours_count=int(self.tours_count[index]),
+            cheapest_url=table.urls[self.cheapest_row[index]]
+        )
+
+class HotelAggregate:
+    """Сводка по одному отелю"""
+    
+    __slots__ = (
+        'hotel_id', 'name', 'category', 'rating', 'min_price', 'max_price',
+        'min_nights', 'max_nights', 'checkin_dates', 'meal_ids', 'tours_count', 'cheapest_url'
+    )
+    
+    def __init__(self, hotel_id, name, category, rating, min_price, max_price,
+                 min_nights, max_nights, checkin_dates, meal_ids, tours_count, cheapest_url):
+        self.hotel_id = hotel_id
+        self.name = name
+        self.category = category
+        self.rating = rating
+        self.min_price = min_price
+        self.max_price = max_price
+        self.min_nights = min_nights
+        self.max_nights = max_nights
+        self.checkin_dates = checkin_dates
+        self.meal_ids = meal_ids
+        self.tours_count = tours_count
+        self.cheapest_url = cheapest_url
+
+class SearchResult:
+    """Результат поиска в колоночном виде; общий для выдачи, статистики и мониторинга"""
+    
+    __slots__ = ('table', 'groups')
+    
+    def __init__(self, table: TourTable):
+        self.table = table
+        self.groups = table.group_by_hotel()
+    
+    @classmethod
+    def from_tours(cls, tours: List[dict]) -> "SearchResult":
+        """Построение результата из списка туров ответа API"""
+        return cls(TourTable.from_tours(tours))
+    
+    @property
+    def tours_count(self) -> int:
+        return len(self.table)
+    
+    @property
+    def hotels_count(self) -> int:
+        return len(self.groups)
+    
+    def hotels_page(self, offset: int, limit: int) -> List[HotelAggregate]:
+        """Отели по возрастанию цены с offset по offset + limit; сводки строятся только для них"""
+        return [self.groups.hotel(index) for index in self.groups.top_k(offset + limit)[offset:]]
+    
+    def min_price(self) -> int:
+        """Минимальная цена среди всех туров"""
+        return int(self.table.price.min())
+    
+    def avg_rating(self) -> float:
+        """Средний рейтинг отелей"""
+        table = self.table
+        ratings = np.fromiter((info[2] for info in table.infos), dtype=np.float64, count=len(table.infos))
+        return float(ratings[table.info_code[self.groups.first_row]].mean())
+
+class PagedResult:
+    """Выдача для листания: итоги поиска и сводки самых дешевых отелей, без таблицы туров"""
+    
+    __slots__ = ('hotels_count', 'tours_count', 'cheapest', 'rating', 'hotels')
+    
+    def __init__(self, hotels_count: int, tours_count: int, cheapest: int, rating: float,
+                 hotels: List[HotelAggregate]):
+        self.hotels_count = hotels_count
+        self.tours_count = tours_count
+        self.cheapest = cheapest
+        self.rating = rating
+        self.hotels = hotels  # по возрастанию цены, не больше SEARCH_SESSION_MAX_HOTELS
+    
+    @classmethod
+    def from_result(cls, result: SearchResult, max_hotels: int = None) -> "PagedResult":
+        """Сводки только тех отелей, которые можно пролистать; сами туры не сохраняются"""
+        if not result.tours_count:
+            return cls(0, 0, 0, 0.0, [])
+        limit = SEARCH_SESSION_MAX_HOTELS if max_hotels is None else max_hotels
+        return cls(result.hotels_count, result.tours_count, result.min_price(), result.avg_rating(),
+                   result.hotels_page(0, limit))
+    
+    def hotels_page(self, offset: int, limit: int) -> List[HotelAggregate]:
+        return self.hotels[offset:offset + limit]
+    
+    def min_price(self) -> int:
+        return self.cheapest
+    
+    def avg_rating(self) -> float:
+        return self.rating
+    
+    def size_bytes(self) -> int:
+        """Оценка занимаемой памяти"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.hotels)
+        for hotel in self.hotels:
+            size += (
+                sys.getsizeof(hotel) + sys.getsizeof(hotel.name) + sys.getsizeof(hotel.category)
+                + sys.getsizeof(hotel.cheapest_url) + sys.getsizeof(hotel.checkin_dates)
+                + sum(sys.getsizeof(date) for date in hotel.checkin_dates) + sys.getsizeof(hotel.meal_ids)
+            )
+        return size
+    
+    def to_bytes(self) -> bytes:
+        """Сжатый JSON для общей базы"""
+        hotels = [
+            [sorted(value) if isinstance(value, set) else value
+             for value in (getattr(hotel, name) for name in HotelAggregate.__slots__)]
+            for hotel in self.hotels
+        ]
+        data = [self.hotels_count, self.tours_count, self.cheapest, self.rating, hotels]
+        return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode())
+    
+    @classmethod
+    def from_bytes(cls, blob: bytes) -> "PagedResult":
+        hotels_count, tours_count, cheapest, rating, rows = json.loads(zlib.decompress(blob))
+        hotels = []
+        for row in rows:
+            hotel = HotelAggregate(*row)
+            hotel.checkin_dates = set(hotel.checkin_dates)
+            hotel.meal_ids = set(hotel.meal_ids)
+            hotels.append(hotel)
+        return cls(hotels_count, tours_count, cheapest, rating, hotels)
+
+class HotelSnapshot:
+    """Компактный снимок отеля: отпечаток содержимого и упакованные туры"""
+    
+    __slots__ = ('name', 'min_price', 'tours_count', 'fingerprint', 'tours_blob')
+    
+    def __init__(self, name: str, min_price: int, tours_count: int,
+                 fingerprint: Optional[int] = None, tours_blob: Optional[bytes] = None):
+        self.name = name
+        self.min_price = min_price
+        self.tours_count = tours_count
+        self.fingerprint = fingerprint
+        # Туры упакованы строками int32: (дата заезда YYYYMMDD, ночи, питание, цена)
+        self.tours_blob = tours_blob
+    
+    def tours(self) -> Dict[Tuple[int, int, int], int]:
+        """Распаковка туров: (дата заезда, ночи, питание) -> цена"""
+        rows = np.frombuffer(self.tours_blob, dtype=np.int32).reshape(-1, 4)
+        return {(date, nights, meal): price for date, nights, meal, price in rows.tolist()}
+
+def _fingerprint(blob: bytes) -> int:
+    """Отпечаток содержимого отеля (помещается в INTEGER SQLite)"""
+    return int.from_bytes(hashlib.blake2b(blob, digest_size=8).digest(), 'big', signed=True)
+
+def build_hotel_snapshots(result: SearchResult) -> Dict[int, HotelSnapshot]:
+    """Снимок отелей с турами, ключ тура - (отель, дата заезда, ночи, питание)"""
+    table = result.table
+    groups = result.groups
+    if not len(table):
+        return {}
+    
+    # Дата может прийти с временем (2025-06-01T00:00:00) - берем только день, как split_by_day
+    date_values = np.fromiter(
+        (int(str(date)[:10].replace('-', '')) for date in table.dates), dtype=np.int64, count=len(table.dates)
+    )
+    dates = date_values[table.date_code]
+    order = np.lexsort((table.price, table.meal_id, table.nights, dates, groups.row_group))
+    rows = np.column_stack((
+        groups.row_group[order], dates[order], table.nights[order], table.meal_id[order], table.price[order]
+    )).astype(np.int64)
+    
+    # Повторы одного ключа оставляем с минимальной ценой (строки уже отсортированы по цене)
+    keep = np.ones(len(rows), dtype=bool)
+    keep[1:] = np.any(rows[1:, :4] != rows[:-1, :4], axis=1)
+    rows = rows[keep]
+    
+    bounds = np.searchsorted(rows[:, 0], np.arange(len(groups) + 1)).tolist()
+    packed = np.ascontiguousarray(rows[:, 1:], dtype=np.int32)
+    names = [table.infos[code][0] for code in table.info_code[groups.first_row].tolist()]
+    
+    snapshots = {}
+    for index, (hotel_id, min_price) in enumerate(zip(groups.hotel_id.tolist(), groups.min_price.tolist())):
+        start, end = bounds[index], bounds[index + 1]
+        blob = packed[start:end].tobytes()
+        snapshots[hotel_id] = HotelSnapshot(names[index], min_price, end - start, _fingerprint(blob), blob)
+    return snapshots
+
+# Событие изменения, найденное при сравнении снимков
+@dataclass
+class ChangeEvent:
+    kind: str
+    hotel_id: int
+    hotel_name: str
+    old_price: Optional[int] = None
+    new_price: Optional[int] = None
+    count: int = 0  # сколько туров добавлено/удалено/изменили цену
+    total: int = 0  # сколько туров у отеля после изменения
+    
+    PRICE_DOWN = "price_down"
+    PRICE_UP = "price_up"
+    TOURS_REPRICED = "tours_repriced"
+    TOURS_ADDED = "tours_added"
+    TOURS_REMOVED = "tours_removed"
+    HOTEL_ADDED = "hotel_added"
+    HOTEL_REMOVED = "hotel_removed"
+
+class SnapshotDiff:
+    """Результат сравнения снимков: события и отели, о которых сообщено и которые нужно перезаписать"""
+    
+    __slots__ = ('events', 'changed', 'removed')
+    
+    def __init__(self):
+        self.events: List[ChangeEvent] = []
+        self.changed: Dict[int, HotelSnapshot] = {}
+        self.removed: List[int] = []
+
+def _repriced_tours(old_tours: Dict[Tuple[int, int, int], int], new_tours: Dict[Tuple[int, int, int], int],
+                    price_threshold: float) -> List[Tuple[int, int]]:
+    """Пары (старая, новая цена) туров, чья цена изменилась более чем на price_threshold процентов"""
+    repriced = []
+    for key in old_tours.keys() & new_tours.keys():
+        old_price, new_price = old_tours[key], new_tours[key]
+        if old_price and abs(new_price - old_price) / old_price * 100 > price_threshold:
+            repriced.append((old_price, new_price))
+    return repriced
+
+def diff_snapshots(old_snapshot: Dict[int, HotelSnapshot], new_snapshot: Dict[int, HotelSnapshot],
+                   price_threshold: float = 10.0) -> SnapshotDiff:
+    """Сравнение с последним показанным пользователю снимком; разбираются только отели с другим отпечатком"""
+    diff = SnapshotDiff()
+    new_ids = new_snapshot.keys()
+    old_ids = old_snapshot.keys()
+    # Разности ключей считаются на уровне множеств; из общих отелей дальше идут только изменившиеся
+    changed_ids = sorted(
+        hotel_id for hotel_id in new_ids & old_ids
+        if old_snapshot[hotel_id].fingerprint is None
+        or old_snapshot[hotel_id].fingerprint != new_snapshot[hotel_id].fingerprint
+    )
+    
+    for hotel_id in changed_ids:
+        old_hotel = old_snapshot[hotel_id]
+        new_hotel = new_snapshot[hotel_id]
+        events_before = len(diff.events)
+        
+        # Изменение минимальной цены более чем на price_threshold процентов
+        old_price = old_hotel.min_price
+        new_price = new_hotel.min_price
+        change_percent = (new_price - old_price) / old_price * 100 if old_price else 0
+        if change_percent < -price_threshold:
+            diff.events.append(ChangeEvent(ChangeEvent.PRICE_DOWN, hotel_id, old_hotel.name, old_price, new_price))
+        elif change_percent > price_threshold:
+            diff.events.append(ChangeEvent(ChangeEvent.PRICE_UP, hotel_id, old_hotel.name, old_price, new_price))
+        
+        # Сравнение на уровне туров: замена одного тура другим и цена отдельного тура тоже видны
+        if old_hotel.tours_blob is not None:
+            old_tours = old_hotel.tours()
+            new_tours = new_hotel.tours()
+            added = len(new_tours.keys() - old_tours.keys())
+            removed = len(old_tours.keys() - new_tours.keys())
+            repriced = _repriced_tours(old_tours, new_tours, price_threshold)
+            if repriced:
+                # В уведомлении - тур с самым сильным изменением цены
+                old_price, new_price = max(repriced, key=lambda prices: abs(prices[1] - prices[0]) / prices[0])
+                diff.events.append(ChangeEvent(
+                    ChangeEvent.TOURS_REPRICED, hotel_id, old_hotel.name, old_price, new_price,
+                    count=len(repriced), total=new_hotel.tours_count
+                ))
+        else:
+            # Снимок старого формата: только количество туров
+            added = max(new_hotel.tours_count - old_hotel.tours_count, 0)
+            removed = max(old_hotel.tours_count - new_hotel.tours_count, 0)
+        
+        if added:
+            diff.events.append(ChangeEvent(
+                ChangeEvent.TOURS_ADDED, hotel_id, old_hotel.name, count=added, total=new_hotel.tours_count
+            ))
+        if removed:
+            diff.events.append(ChangeEvent(
+                ChangeEvent.TOURS_REMOVED, hotel_id, old_hotel.name, count=removed, total=new_hotel.tours_count
+            ))
+        
+        # Базой для следующего сравнения отель становится, только когда о нем сообщили:
+        # изменения ниже порога накапливаются и будут замечены, когда в сумме превысят его
+        if len(diff.events) > events_before:
+            diff.changed[hotel_id] = new_hotel
+    
+    for hotel_id in sorted(new_ids - old_ids):
+        new_hotel = new_snapshot[hotel_id]
+        diff.events.append(ChangeEvent(
+            ChangeEvent.HOTEL_ADDED, hotel_id, new_hotel.name,
+            new_price=new_hotel.min_price, total=new_hotel.tours_count
+        ))
+        diff.changed[hotel_id] = new_hotel
+    
+    for hotel_id in sorted(old_ids - new_ids):
+        old_hotel = old_snapshot[hotel_id]
+        diff.events.append(ChangeEvent(
+            ChangeEvent.HOTEL_REMOVED, hotel_id, old_hotel.name, total=old_hotel.tours_count
+        ))
+        diff.removed.append(hotel_id)
+    
+    return diff
+
+# Подписка пользователя на мониторинг
+@dataclass
+class Subscription:
+    user_id: int
+    chat_id: int
+    query: SearchQuery
+    active: bool
+    delay: float
+    next_check_at: Optional[float] = None
+    owner: Optional[str] = None  # процесс, который проверяет подписку
+
+class MonitoringStore:
+    """Хранилище подписок и снимков мониторинга в SQLite (режим WAL)"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            query TEXT NOT NULL,
+            active INTEGER NOT NULL DEFAULT 0,
+            delay REAL NOT NULL,
+            created_at REAL NOT NULL,
+            last_check_at REAL,
+            last_change_at REAL,
+            next_check_at REAL,
+            owner TEXT,
+            lease_until REAL
+        );
+        CREATE TABLE IF NOT EXISTS snapshots (
+            user_id INTEGER NOT NULL,
+            hotel_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            min_price INTEGER NOT NULL,
+            tours_count INTEGER NOT NULL,
+            fingerprint INTEGER,
+            tours BLOB,
+            PRIMARY KEY (user_id, hotel_id)
+        ) WITHOUT ROWID;
+    """
+    
+    def __init__(self, path: str = MONITORING_DB_PATH, flush_interval: float = MONITORING_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        # Одно соединение и один поток: SQLite не блокирует event loop, запросы выполняются по очереди
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.conn: Optional[sqlite3.Connection] = None
+        # Блокировка нужна только для ленивого открытия: одновременные первые запросы не откроют два соединения
+        self._conn_lock = threading.Lock()
+        # Идентификатор процесса-владельца подписок; новый при каждом запуске
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self._pending: List[Tuple[str, list]] = []  # накопленные операции (sql, список параметров)
+        self._pending_users: set = set()
+        self._flush_task: Optional[asyncio.Task] = None
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(self.SCHEMA)
+        # Базы, созданные до появления отпечатков туров
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(snapshots)")}
+        if 'fingerprint' not in columns:
+            conn.execute("ALTER TABLE snapshots ADD COLUMN fingerprint INTEGER")
+            conn.execute("ALTER TABLE snapshots ADD COLUMN tours BLOB")
+        # Базы, созданные до разделения подписок между процессами
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(subscriptions)")}
+        if 'owner' not in columns:
+            conn.execute("ALTER TABLE subscriptions ADD COLUMN owner TEXT")
+            conn.execute("ALTER TABLE subscriptions ADD COLUMN lease_until REAL")
+        return conn
+    
+    def _ensure_connection(self) -> None:
+        with self._conn_lock:
+            if self.conn is None:
+                self.conn = self._connect()
+    
+    async def _run(self, func, *args):
+        """Выполнение операции с базой в отдельном потоке"""
+        loop = asyncio.get_running_loop()
+        if self.conn is None:
+            await loop.run_in_executor(self.executor, self._ensure_connection)
+        return await loop.run_in_executor(self.executor, func, *args)
+    
+    def _enqueue(self, user_id: int, sql: str, rows: list) -> None:
+        """Постановка записи в пакет; пакет сбрасывается одной транзакцией"""
+        self._pending.append((sql, rows))
+        self._pending_users.add(user_id)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+    
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+    
+    def _write_batch(self, batch: List[Tuple[str, list]]) -> None:
+        with self.conn:
+            for sql, rows in batch:
+                self.conn.executemany(sql, rows)
+    
+    async def flush(self) -> None:
+        """Запись всех накопленных изменений одной транзакцией"""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        self._pending_users = set()
+        await self._run(self._write_batch, batch)
+    
+    async def _flush_for(self, user_id: int) -> None:
+        """Чтение видит собственные несброшенные записи"""
+        if user_id in self._pending_users:
+            await self.flush()
+    
+    def save_search(self, user_id: int, chat_id: int, query: SearchQuery, snapshot: dict) -> None:
+        """Сохранение результата поиска для возможного запуска мониторинга (удаляется через MONITORING_OFFER_TTL)"""
+        # Для невключенного мониторинга created_at - время последнего поиска, от него отсчитывается срок хранения
+        self._enqueue(user_id, """
+            INSERT INTO subscriptions (user_id, chat_id, query, active, delay, created_at)
+            VALUES (?, ?, ?, 0, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                chat_id = excluded.chat_id, query = excluded.query,
+                created_at = CASE WHEN subscriptions.active THEN subscriptions.created_at ELSE excluded.created_at END
+        """, [(user_id, chat_id, query.to_json(), MONITORING_INTERVAL, time.time())])
+        self.save_snapshot(user_id, snapshot)
+    
+    def save_snapshot(self, user_id: int, snapshot: Dict[int, HotelSnapshot]) -> None:
+        """Замена снимка отелей пользователя"""
+        self._enqueue(user_id, "DELETE FROM snapshots WHERE user_id = ?", [(user_id,)])
+        self.update_snapshot(user_id, snapshot, [])
+    
+    def update_snapshot(self, user_id: int, changed: Dict[int, HotelSnapshot], removed: List[int]) -> None:
+        """Перезапись только изменившихся отелей снимка"""
+        if removed:
+            self._enqueue(user_id, "DELETE FROM snapshots WHERE user_id = ? AND hotel_id = ?", [
+                (user_id, hotel_id) for hotel_id in removed
+            ])
+        if changed:
+            self._enqueue(user_id, """
+                INSERT OR REPLACE INTO snapshots (user_id, hotel_id, name, min_price, tours_count, fingerprint, tours)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, [
+                (user_id, hotel_id, hotel.name, hotel.min_price, hotel.tours_count, hotel.fingerprint, hotel.tours_blob)
+                for hotel_id, hotel in changed.items()
+            ])
+    
+    def record_check(self, user_id: int, delay: float, changed: bool) -> None:
+        """Сохранение метаданных последней проверки"""
+        now = time.time()
+        self._enqueue(user_id, """
+            UPDATE subscriptions
+            SET delay = ?, last_check_at = ?, next_check_at = ?,
+                last_change_at = CASE WHEN ? THEN ? ELSE last_change_at END
+            WHERE user_id = ? AND owner = ?
+        """, [(delay, now, now + delay, changed, now, user_id, self.owner)])
+    
+    def activate(self, user_id: int) -> None:
+        """Включение мониторинга; владельцем становится процесс, принявший команду"""
+        now = time.time()
+        self._enqueue(user_id, """
+            UPDATE subscriptions SET active = 1, delay = ?, next_check_at = ?, owner = ?, lease_until = ?
+            WHERE user_id = ?
+        """, [(MONITORING_INTERVAL, now + MONITORING_INTERVAL, self.owner, now + MONITORING_LEASE_TTL, user_id)])
+    
+    def delete(self, user_id: int) -> None:
+        """Удаление подписки и снимка"""
+        self._enqueue(user_id, "DELETE FROM snapshots WHERE user_id = ?", [(user_id,)])
+        self._enqueue(user_id, "DELETE FROM subscriptions WHERE user_id = ?", [(user_id,)])
+    
+    @staticmethod
+    def _to_subscription(row) -> Subscription:
+        user_id, chat_id, query, active, delay, next_check_at, owner = row
+        return Subscription(user_id, chat_id, SearchQuery.from_json(query), bool(active), delay, next_check_at, owner)
+    
+    def _select_subscription(self, user_id: int):
+        return self.conn.execute("""
+            SELECT user_id, chat_id, query, active, delay, next_check_at, owner FROM subscriptions WHERE user_id = ?
+        """, (user_id,)).fetchone()
+    
+    async def load(self, user_id: int) -> Optional[Subscription]:
+        """Чтение подписки пользователя"""
+        await self._flush_for(user_id)
+        row = await self._run(self._select_subscription, user_id)
+        return self._to_subscription(row) if row else None
+    
+    def _select_snapshot(self, user_id: int):
+        return self.conn.execute("""
+            SELECT hotel_id, name, min_price, tours_count, fingerprint, tours FROM snapshots WHERE user_id = ?
+        """, (user_id,)).fetchall()
+    
+    async def load_snapshot(self, user_id: int) -> Dict[int, HotelSnapshot]:
+        """Чтение снимка отелей пользователя"""
+        await self._flush_for(user_id)
+        rows = await self._run(self._select_snapshot, user_id)
+        return {hotel_id: HotelSnapshot(*fields) for hotel_id, *fields in rows}
+    
+    def _claim(self):
+        now = time.time()
+        with self.conn:
+            # Продление своих подписок и захват брошенных; UPDATE атомарен, один владелец на подписку
+            self.conn.execute("""
+                UPDATE subscriptions SET owner = ?, lease_until = ?
+                WHERE active = 1 AND (owner = ? OR owner IS NULL OR lease_until IS NULL OR lease_until < ?)
+            """, (self.owner, now + MONITORING_LEASE_TTL, self.owner, now))
+            return self.conn.execute("""
+                SELECT user_id, chat_id, query, active, delay, next_check_at, owner FROM subscriptions
+                WHERE active = 1 AND owner = ?
+            """, (self.owner,)).fetchall()
+    
+    async def claim_subscriptions(self) -> List[Subscription]:
+        """Активные подписки этого процесса: свои с продленной арендой и подобранные брошенные"""
+        await self.flush()
+        rows = await self._run(self._claim)
+        return [self._to_subscription(row) for row in rows]
+    
+    def _purge_offers(self, older_than: float) -> int:
+        with self.conn:
+            self.conn.execute("""
+                DELETE FROM snapshots WHERE user_id IN (
+                    SELECT user_id FROM subscriptions WHERE active = 0 AND created_at < ?
+                )
+            """, (older_than,))
+            return self.conn.execute(
+                "DELETE FROM subscriptions WHERE active = 0 AND created_at < ?", (older_than,)
+            ).rowcount
+    
+    async def purge_offers(self, ttl: float = MONITORING_OFFER_TTL) -> int:
+        """Удаление сохраненных поисков, по которым мониторинг так и не включили"""
+        await self.flush()
+        return await self._run(self._purge_offers, time.time() - ttl)
+    
+    def _release(self):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE subscriptions SET owner = NULL, lease_until = NULL WHERE owner = ?", (self.owner,)
+            )
+    
+    async def close(self) -> None:
+        """Сброс накопленных записей, освобождение подписок и закрытие базы"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+        if self.conn is not None:
+            # Подписки сразу подберут другие процессы, не дожидаясь истечения аренды
+            await self._run(self._release)
+            await self._run(self.conn.close)
+            self.conn = None
+        self.executor.shutdown(wait=False)
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище состояний FSM в файле SQLite, общее для нескольких процессов бота"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS results (
+            user_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            result BLOB NOT NULL,
+            PRIMARY KEY (user_id, message_id)
+        );
+        CREATE INDEX IF NOT EXISTS results_expires_at ON results (expires_at);
+    """
+    
+    def __init__(self, path: str, pool_size: int = FSM_STORAGE_POOL_SIZE):
+        self.path = path
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # Пул соединений: у каждого потока исполнителя свое соединение
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="fsm")
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[Callable, tuple, asyncio.Future]] = []
+        self._flush_scheduled = False
+        self._flushes: set = set()  # пакеты, выполняющиеся в исполнителе
+        self.batches = 0
+        self.operations = 0
+    
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Транзакциями управляем сами, чтобы чтение и запись пакета шли в одной
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")  # другой процесс может держать запись
+            conn.executescript(self.SCHEMA)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+    
+    def _execute(self, batch: List[Tuple[Callable, tuple, asyncio.Future]]) -> list:
+        """Выполнение пакета операций одной транзакцией"""
+        conn = self._connection()
+        writes = any(op is not self._read and op is not self._read_result for op, _, _ in batch)
+        conn.execute("BEGIN IMMEDIATE" if writes else "BEGIN")
+        try:
+            results = [op(conn, *args) for op, args, _ in batch]
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return results
+    
+    def _submit(self, op: Callable, *args) -> asyncio.Future:
+        """Постановка операции в пакет; все операции одного шага event loop уходят в базу вместе"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((op, args, future))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._start_flush)
+        return future
+    
+    def _start_flush(self) -> None:
+        task = asyncio.ensure_future(self._flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+    
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        self._flush_scheduled = False
+        self.batches += 1
+        self.operations += len(batch)
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self._execute, batch)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+    
+    @staticmethod
+    def _read(conn: sqlite3.Connection, key: str) -> Tuple[Optional[str], Optional[str]]:
+        row = conn.execute("SELECT state, data FROM fsm WHERE key = ?", (key,)).fetchone()
+        return row if row else (None, None)
+    
+    @staticmethod
+    def _drop_empty(conn: sqlite3.Connection, key: str) -> None:
+        # Завершенные диалоги не оставляют пустых строк
+        conn.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data IS NULL", (key,))
+    
+    @classmethod
+    def _write_state(cls, conn: sqlite3.Connection, key: str, state: Optional[str]) -> None:
+        conn.execute("""
+            INSERT INTO fsm (key, state) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET state = excluded.state
+        """, (key, state))
+        cls._drop_empty(conn, key)
+    
+    @classmethod
+    def _write_data(cls, conn: sqlite3.Connection, key: str, data: Optional[str]) -> None:
+        conn.execute("""
+            INSERT INTO fsm (key, data) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET data = excluded.data
+        """, (key, data))
+        cls._drop_empty(conn, key)
+    
+    @classmethod
+    def _merge_data(cls, conn: sqlite3.Connection, key: str, patch: dict) -> dict:
+        # Чтение и запись в одной транзакции: параллельный процесс не потеряет свои изменения
+        _, data = cls._read(conn, key)
+        merged = json.loads(data) if data else {}
+        merged.update(patch)
+        cls._write_data(conn, key, json.dumps(merged, ensure_ascii=False))
+        return merged
+    
+    @staticmethod
+    def _write_result(conn: sqlite3.Connection, user_id: int, message_id: int, expires_at: float, blob: bytes) -> None:
+        conn.execute("DELETE FROM results WHERE expires_at < ?", (time.time(),))
+        conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (user_id, message_id, expires_at, blob))
+    
+    @staticmethod
+    def _read_result(conn: sqlite3.Connection, user_id: int, message_id: int) -> Optional[bytes]:
+        row = conn.execute("""
+            SELECT result FROM results WHERE user_id = ? AND message_id = ? AND expires_at >= ?
+        """, (user_id, message_id, time.time())).fetchone()
+        return row[0] if row else None
+    
+    async def save_result(self, user_id: int, message_id: int, blob: bytes, ttl: float) -> None:
+        """Сохранение результата поиска для листания из любого процесса"""
+        await self._submit(self._write_result, user_id, message_id, time.time() + ttl, blob)
+    
+    async def load_result(self, user_id: int, message_id: int) -> Optional[bytes]:
+        return await self._submit(self._read_result, user_id, message_id)
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._submit(self._write_state, self.key_builder.build(key), value)
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._submit(self._read, self.key_builder.build(key))
+        return state
+    
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._submit(self._write_data, self.key_builder.build(key),
+                           json.dumps(data, ensure_ascii=False) if data else None)
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._submit(self._read, self.key_builder.build(key))
+        return json.loads(data) if data else {}
+    
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        merged = await self._submit(self._merge_data, self.key_builder.build(key), dict(data))
+        return merged.copy()
+    
+    def _close_connections(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+    
+    async def close(self) -> None:
+        """Ожидание незавершенных операций и закрытие соединений"""
+        while self._pending or self._flush_scheduled or self._flushes:
+            if self._flushes:
+                await asyncio.gather(*self._flushes, return_exceptions=True)
+            else:
+                await asyncio.sleep(0)
+        # Закрытие с контрольной точкой WAL блокирует - выполняем в исполнителе, как и остальные операции
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._close_connections)
+        self.executor.shutdown(wait=False)
+
+class SharedSessionMiddleware(BaseMiddleware):
+    """Загрузка параметров поиска из общего хранилища до обработчика и сохранение после"""
+    
+    def __init__(self, sessions: SessionStore, storage: BaseStorage):
+        self.sessions = sessions
+        self.storage = storage
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        
+        # Параметры принадлежат пользователю, а не чату
+        key = StorageKey(bot_id=data["bot"].id, chat_id=user.id, user_id=user.id, destiny=USER_PARAMS_DESTINY)
+        fields = await self.storage.get_data(key)
+        # Источник правды - общее хранилище: предыдущий шаг диалога мог обработать другой процесс
+        self.sessions.put(user.id, UserParams(**fields) if fields else None)
+        
+        try:
+            return await handler(event, data)
+        finally:
+            params = self.sessions.get(user.id)
+            new_fields = params.to_dict() if params is not None else {}
+            if new_fields != fields:
+                await self.storage.set_data(key, new_fields)
+
+class ResultSessions:
+    """Выдачи для листания, по одной на сообщение с результатами"""
+    
+    def __init__(self, storage: Optional[SQLiteStorage] = None, ttl: float = SEARCH_SESSION_TTL,
+                 max_size: int = SEARCH_SESSION_LIMIT, max_bytes: int = SEARCH_SESSION_MAX_BYTES):
+        self.ttl = ttl
+        # Локальная копия избавляет от чтения базы при листании в том же процессе;
+        # хранятся только сводки отелей, и их общий объем ограничен
+        self.local = TTLCache(ttl, max_size, max_bytes, PagedResult.size_bytes)
+        self.storage = storage
+        self.shared_hits = 0
+    
+    async def put(self, user_id: int, message_id: int, result: SearchResult) -> None:
+        paged = PagedResult.from_result(result)
+        self.local.set((user_id, message_id), paged)
+        if self.storage is not None:
+            await self.storage.save_result(user_id, message_id, paged.to_bytes(), self.ttl)
+    
+    async def get(self, user_id: int, message_id: int) -> Optional[PagedResult]:
+        result = self.local.get((user_id, message_id))
+        if result is not None or self.storage is None:
+            return result
+        # Поиск выполнял другой процесс
+        blob = await self.storage.load_result(user_id, message_id)
+        if blob is None:
+            return None
+        self.shared_hits += 1
+        result = PagedResult.from_bytes(blob)
+        self.local.set((user_id, message_id), result)
+        return result
+
+_chromedriver_lock = threading.Lock()
+_chromedriver_path: Optional[str] = None
+
+def resolve_chromedriver(refresh: bool = False) -> str:
+    """Путь к chromedriver: из окружения, из кэша или после однократной установки"""
+    global _chromedriver_path
+    if CHROMEDRIVER_PATH:
+        return CHROMEDRIVER_PATH
+    
+    # Сессии пула запускаются параллельно - установка выполняется только одной из них
+    with _chromedriver_lock:
+        if _chromedriver_path and not refresh:
+            return _chromedriver_path
+        
+        path = None
+        if not refresh:
+            try:
+                with open(CHROMEDRIVER_CACHE_FILE) as f:
+                    path = f.read().strip()
+            except OSError:
+                pass
+            if path and not (os.path.isfile(path) and os.access(path, os.X_OK)):
+                path = None
+        
+        if not path:
+            import chromedriver_autoinstaller
+            started = time.monotonic()
+            path = chromedriver_autoinstaller.install()
+            if not path:
+                raise RuntimeError("Не удалось установить chromedriver")
+            logger.info(f"chromedriver установлен за {time.monotonic() - started:.1f} с: {path}")
+            try:
+                tmp_path = f"{CHROMEDRIVER_CACHE_FILE}.tmp"
+                with open(tmp_path, 'w') as f:
+                    f.write(path)
+                os.replace(tmp_path, CHROMEDRIVER_CACHE_FILE)
+            except OSError as e:
+                logger.warning(f"Не удалось сохранить путь к chromedriver: {e}")
+        
+        _chromedriver_path = path
+        return path
+
+class WebDriverManager:
+    """Менеджер для работы с Selenium WebDriver"""
+    
+    def __init__(self):
+        self.driver = None
+        self.navigations = 0
+        self.suspect = False  # после ошибки сессию нужно проверить, прежде чем отдавать снова
+        self.setup_driver()
+    
+    def setup_driver(self):
+        """Настройка Chrome WebDriver"""
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.chrome.service import Service
+        from selenium.common.exceptions import WebDriverException
+        
+        try:
+            # Настройка опций Chrome
+            chrome_options = Options()
+            chrome_options.add_argument("--headless=new")  # Новый headless режим
+            chrome_options.add_argument("--no-sandbox")
+            chrome_options.add_argument("--disable-dev-shm-usage")
+            chrome_options.add_argument("--disable-gpu")
+            chrome_options.add_argument("--disable-blink-features=AutomationControlled")
+            chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
+            chrome_options.add_argument(f"--user-agent={USER_AGENT}")
+            if BROWSER_LEAN:
+                # Ответ API - JSON: окно, картинки и расширения ему не нужны, а память Chrome съедают
+                chrome_options.add_argument("--window-size=800,600")
+                chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+                chrome_options.add_argument("--disable-extensions")
+                chrome_options.add_argument("--mute-audio")
+                # Не ждем подресурсов: документ готов, как только разобран
+                chrome_options.page_load_strategy = "eager"
+            else:
+                chrome_options.add_argument("--window-size=1920,1080")
+            
+            try:
+                self.driver = webdriver.Chrome(
+                    service=Service(executable_path=resolve_chromedriver()), options=chrome_options
+                )
+            except WebDriverException:
+                if CHROMEDRIVER_PATH:
+                    raise
+                # Chrome обновился, а запомненный драйвер остался от старой версии
+                logger.warning("Запомненный chromedriver не подошел, устанавливаю заново")
+                self.driver = webdriver.Chrome(
+                    service=Service(executable_path=resolve_chromedriver(refresh=True)), options=chrome_options
+                )
+            self.driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+            self.driver.set_page_load_timeout(30)
+            self.driver.set_script_timeout(30)
+            if BROWSER_LEAN:
+                # Блокировка подресурсов через DevTools: запросы отклоняются до отправки в сеть
+                self.driver.execute_cdp_cmd("Network.enable", {})
+                self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BROWSER_BLOCKED_URLS})
+            logger.info("Chrome WebDriver успешно запущен")
+            
+        except Exception as e:
+            logger.error(f"Ошибка при запуске WebDriver: {e}")
+            raise
+    
+    # JSON-ответ Chrome показывает в <pre>: забираем текст узла, а не весь HTML страницы
+    RESPONSE_BODY_SCRIPT = """
+        const pre = document.querySelector('pre');
+        return pre ? pre.textContent : document.body.innerText;
+    """
+    
+    # JSON готов, как только документ разобран и в нем появился <pre> или текст
+    JSON_READY_SCRIPT = """
+        return document.readyState !== 'loading'
+            && !!(document.querySelector('pre') || (document.body && document.body.innerText));
+    """
+    
+    # Запрос из уже открытой вкладки API: без навигации, с ее cookies и прогретым соединением
+    IN_PAGE_FETCH_SCRIPT = """
+        const [url, done] = arguments;
+        fetch(url, {credentials: 'include', headers: {'Accept': 'application/json'}})
+            .then(response => response.text().then(body => done({status: response.status, body: body})))
+            .catch(error => done({error: String(error)}));
+    """
+    
+    def _same_origin(self, url: str) -> bool:
+        """Открыта ли во вкладке страница того же сайта, что и url"""
+        current = self.driver.current_url or ""
+        origin = "/".join(url.split("/", 3)[:3])
+        return current.startswith(origin + "/") or current == origin
+    
+    def _fetch_in_tab(self, url: str) -> Optional[str]:
+        """Тело ответа через fetch() в текущей вкладке; None, если так получить не удалось"""
+        result = self.driver.execute_async_script(self.IN_PAGE_FETCH_SCRIPT, url) or {}
+        if result.get("error") or result.get("status") != 200:
+            logger.warning(f"Запрос из вкладки не удался ({result.get('error') or result.get('status')}), перехожу по URL")
+            return None
+        return result.get("body")
+    
+    def get_response_body(self, url: str) -> bytes:
+        """Получение тела ответа API через браузер"""
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException
+        
+        self.navigations += 1
+        try:
+            body = None
+            if BROWSER_LEAN and self._same_origin(url):
+                body = self._fetch_in_tab(url)
+            
+            if body is None:
+                logger.info(f"Перехожу по URL: {url}")
+                self.driver.get(url)
+                
+                # Ждем загрузки страницы
+                if BROWSER_LEAN:
+                    WebDriverWait(self.driver, 10, poll_frequency=0.05).until(
+                        lambda driver: driver.execute_script(self.JSON_READY_SCRIPT)
+                    )
+                else:
+                    WebDriverWait(self.driver, 10).until(
+                        EC.presence_of_element_located((By.TAG_NAME, "body"))
+                    )
+                
+                body = self.driver.execute_script(self.RESPONSE_BODY_SCRIPT) or ""
+            logger.info(f"Успешно получен ответ через браузер, длина: {len(body)} символов")
+            return body.encode("utf-8")
+            
+        except TimeoutException:
+            error_msg = "Таймаут при загрузке страницы"
+            logger.error(error_msg)
+            raise FetchError(error_msg)
+        except Exception as e:
+            error_msg = f"Ошибка при получении содержимого страницы: {str(e)}"
+            logger.error(error_msg)
+            raise FetchError(error_msg)
+    
+    def is_alive(self) -> bool:
+        """Отвечает ли браузер на простейшую команду"""
+        try:
+            return self.driver.execute_script("return 1") == 1
+        except Exception:
+            return False
+    
+    def _browser_pids(self) -> List[int]:
+        """chromedriver и все его потомки (Chrome, рендереры, GPU)"""
+        pids = [self.driver.service.process.pid]
+        index = 0
+        while index < len(pids):
+            pid = pids[index]
+            index += 1
+            try:
+                with open(f"/proc/{pid}/task/{pid}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except OSError:
+                continue
+        return pids
+    
+    def rss_bytes(self) -> Optional[int]:
+        """Суммарная резидентная память процессов браузера; None, если /proc недоступен"""
+        total = 0
+        try:
+            pids = self._browser_pids()
+        except Exception:
+            return None
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/statm") as f:
+                    total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            except (OSError, ValueError, IndexError):
+                if pid == pids[0]:
+                    return None
+        return total
+    
+    def kill(self):
+        """Принудительное завершение зависшего браузера вместе с chromedriver"""
+        try:
+            # Сначала потомки: после смерти chromedriver их уже не найти через /proc
+            for pid in reversed(self._browser_pids()):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        except Exception as e:
+            logger.error(f"Не удалось завершить процессы браузера: {e}")
+    
+    def close(self):
+        """Закрытие драйвера"""
+        if self.driver:
+            try:
+                self.driver.quit()
+            except Exception as e:
+                # Упавший браузер не отвечает на quit - добиваем процесс драйвера
+                logger.error(f"Ошибка при закрытии WebDriver: {e}")
+                self.kill()
+            logger.info("WebDriver закрыт")
+
+class HttpFetcher:
+    """Прямые запросы к API через общий keep-alive пул соединений"""
+    
+    # Статусы, которыми API отвечает на подозрительные запросы
+    BLOCKED_STATUSES = {401, 403, 429, 451}
+    
+    def __init__(self, limit: int = HTTP_POOL_LIMIT, timeout: float = HTTP_TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Ленивое создание сессии с пулом соединений"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={
+                    "User-Agent": USER_AGENT,
+                    "Accept": "application/json",
+                    "Accept-Encoding": "gzip, deflate"
+                }
+            )
+        return self.session
+    
+    async def fetch(self, url: str) -> bytes:
+        """Получение тела ответа API без браузера"""
+        session = self._get_session()
+        try:
+            async with session.get(url) as response:
+                if response.status in self.BLOCKED_STATUSES:
+                    raise FetchBlockedError(f"Сервер отклонил запрос: HTTP {response.status}")
+                if response.status >= 400:
+                    raise FetchError(f"Ошибка при получении данных: HTTP {response.status}")
+                
+                # Вместо JSON пришла страница (капча, заглушка) - считаем запрос заблокированным
+                if "json" not in response.content_type:
+                    raise FetchBlockedError(f"Неожиданный тип ответа: {response.content_type}")
+                
+                # Сырые байты уходят прямо в декодер, без промежуточной строки
+                body = await response.read()
+                logger.info(f"Получен ответ API, длина: {len(body)} байт")
+                return body
+        except asyncio.TimeoutError:
+            raise FetchError("Таймаут при загрузке страницы")
+        except aiohttp.ClientError as e:
+            raise FetchError(f"Ошибка при получении содержимого страницы: {e}")
+    
+    async def close(self):
+        """Закрытие пула соединений"""
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+class DictionaryRefresher:
+    """Фоновое обновление справочников с сервера условными запросами"""
+    
+    def __init__(self, url: str, interval: float = DICTIONARIES_REFRESH_INTERVAL,
+                 path: str = DICTIONARIES_PATH):
+        self.url = url
+        self.interval = interval
+        self.path = path
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+        self.updates = 0
+        self.not_modified = 0
+        self.failures = 0
+    
+    async def refresh(self) -> bool:
+        """Одна проверка источника; True, если справочники заменены"""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+                headers={"User-Agent": USER_AGENT, "Accept": "application/json"}
+            )
+        
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        
+        async with self.session.get(self.url, headers=headers) as response:
+            if response.status == 304:
+                self.not_modified += 1
+                return False
+            if response.status >= 400:
+                raise FetchError(f"Ошибка при получении справочников: HTTP {response.status}")
+            body = await response.read()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+        
+        # Индексы строятся до подмены: обработчики не видят наполовину готовых справочников
+        data = ReferenceData.from_payload(json.loads(body))
+        self.etag, self.last_modified = etag, last_modified
+        
+        current = reference_data()
+        if data.version <= current.version:
+            self.not_modified += 1
+            return False
+        
+        replace_reference_data(data)
+        await asyncio.get_running_loop().run_in_executor(None, self._save, body)
+        self.updates += 1
+        logger.info(f"Справочники обновлены до версии {data.version}")
+        return True
+    
+    def _save(self, body: bytes):
+        """Сохранение новой версии рядом со старой и атомарная замена файла"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, self.path)
+    
+    async def _loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"Не удалось обновить справочники: {e}")
+            await asyncio.sleep(self.interval)
+    
+    def start(self):
+        """Запуск периодического обновления"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        """Остановка обновления и закрытие HTTP-сессии"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+class BrowserPool:
+    """Пул сессий WebDriver, работающий вне event loop, с присмотром за их здоровьем"""
+    
+    def __init__(self, size: int = BROWSER_POOL_SIZE, max_navigations: int = BROWSER_MAX_NAVIGATIONS,
+                 max_rss_mb: int = BROWSER_MAX_RSS_MB, probe_interval: float = BROWSER_PROBE_INTERVAL):
+        self.size = max(1, size)
+        self.max_navigations = max_navigations
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.probe_interval = probe_interval
+        # Отдельный поток на каждую сессию и еще один для запуска замен и проверок
+        self.executor = ThreadPoolExecutor(max_workers=self.size + 1, thread_name_prefix="browser")
+        self.managers: List[WebDriverManager] = []
+        # Свободные места пула: сессия или None, если ее нужно запустить при следующей аренде
+        self.idle: asyncio.Queue = asyncio.Queue()
+        # Общий запуск: все, кто ждет пул, получают его результат или ошибку
+        self._start_task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[asyncio.Task] = None
+        self._background: set = set()
+        self.state = "idle"  # idle -> starting -> ready, или failed при неудаче
+        self.startup_seconds: Optional[float] = None
+        # Счетчики сторожа
+        self.recycles = 0  # плановые перезапуски по числу переходов или памяти
+        self.crashes = 0  # замены упавших или зависших сессий
+        self.launch_failures = 0
+        self.probes = 0
+    
+    async def start(self):
+        """Запуск всех сессий пула; одновременные вызовы ждут один общий запуск"""
+        if self._start_task is None:
+            self._start_task = asyncio.create_task(self._start())
+        task = self._start_task
+        try:
+            # shield: отмена одного ожидающего не прерывает запуск для остальных
+            await asyncio.shield(task)
+        except Exception:
+            # Неудачный запуск можно повторить следующим вызовом
+            if self._start_task is task:
+                self._start_task = None
+            raise
+    
+    async def _start(self):
+        self.state = "starting"
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        # Запускаем Chrome параллельно, каждый в своем потоке
+        results = await asyncio.gather(
+            *(loop.run_in_executor(self.executor, WebDriverManager) for _ in range(self.size)),
+            return_exceptions=True
+        )
+        errors = []
+        for result in results:
+            if isinstance(result, WebDriverManager):
+                self.managers.append(result)
+                self.idle.put_nowait(result)
+            else:
+                self.launch_failures += 1
+                errors.append(result)
+
+        if not self.managers:
+            self.state = "failed"
+            raise FetchError(f"Не удалось запустить ни одной сессии WebDriver: {errors[0]}")
+        # Места неподнявшихся сессий займут сессии, запущенные при аренде
+        for _ in range(self.size - len(self.managers)):
+            self.idle.put_nowait(None)
+        self.state = "ready"
+        self.startup_seconds = time.monotonic() - started
+        if self.probe_interval > 0:
+            self._watchdog = asyncio.create_task(self._watch())
+        logger.info(f"Пул браузеров запущен за {self.startup_seconds:.1f} с, сессий: {len(self.managers)}")
+    
+    async def warm_up(self):
+        """Фоновый запуск браузеров до первого запроса"""
+        try:
+            await self.start()
+        except Exception as e:
+            logger.error(f"Прогрев браузеров не удался: {e}")
+    
+    async def _launch(self) -> WebDriverManager:
+        """Запуск новой сессии вместо выбывшей"""
+        loop = asyncio.get_running_loop()
+        try:
+            manager = await loop.run_in_executor(self.executor, WebDriverManager)
+        except Exception as e:
+            self.launch_failures += 1
+            raise FetchError(f"Не удалось запустить браузер: {e}")
+        self.managers.append(manager)
+        return manager
+    
+    def _retire(self, manager: WebDriverManager) -> None:
+        """Закрытие сессии и фоновый запуск замены на ее место"""
+        if manager in self.managers:
+            self.managers.remove(manager)
+        self.executor.submit(manager.close)
+        task = asyncio.create_task(self._replace())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+    
+    async def _replace(self):
+        try:
+            manager = await self._launch()
+        except FetchError as e:
+            # Место остается пустым: запуск повторится при следующей аренде
+            logger.error(f"{e}")
+            manager = None
+        self.idle.put_nowait(manager)
+    
+    async def _probe(self, manager: WebDriverManager) -> bool:
+        """Быстрая проверка, что браузер отвечает; зависший процесс убивается"""
+        self.probes += 1
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self.executor, manager.is_alive), BROWSER_PROBE_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.error("Браузер не ответил на проверку, завершаю процесс")
+            manager.kill()
+            return False
+    
+    async def _check(self, manager: WebDriverManager) -> bool:
+        """Решение, вернуть ли сессию в пул; False - сессия отправлена на замену"""
+        if manager.suspect:
+            manager.suspect = False
+            if not await self._probe(manager):
+                self.crashes += 1
+                logger.warning("Сессия браузера не отвечает, заменяю")
+                self._retire(manager)
+                return False
+        
+        if manager.navigations >= self.max_navigations:
+            self.recycles += 1
+            logger.info(f"Сессия браузера выполнила {manager.navigations} переходов, перезапускаю")
+            self._retire(manager)
+            return False
+        
+        # Чтение /proc по всем процессам браузера - не в event loop
+        rss = await asyncio.to_thread(manager.rss_bytes)
+        if rss is not None and rss > self.max_rss:
+            self.recycles += 1
+            logger.info(f"Сессия браузера заняла {rss // (1024 * 1024)} МБ, перезапускаю")
+            self._retire(manager)
+            return False
+        return True
+    
+    async def _release(self, manager: Optional[WebDriverManager]) -> None:
+        if manager is None or await self._check(manager):
+            self.idle.put_nowait(manager)
+    
+    async def _watch(self):
+        """Периодическая проверка простаивающих сессий"""
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            for _ in range(self.idle.qsize()):
+                try:
+                    manager = self.idle.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if manager is not None:
+                    manager.suspect = True
+                await self._release(manager)
+    
+    @asynccontextmanager
+    async def lease(self):
+        """Аренда свободной сессии браузера"""
+        await self.start()
+        if not self.managers and self.idle.empty():
+            # Все сессии выбыли, а замены еще не поднялись - не ждем их бесконечно
+            raise FetchError("Нет работающих сессий браузера")
+        manager = await self.idle.get()
+        try:
+            if manager is None:
+                manager = await self._launch()
+            yield manager
+        except FetchError:
+            # Ошибка могла означать падение браузера - проверим сессию при возврате
+            if manager is not None:
+                manager.suspect = True
+            raise
+        finally:
+            task = asyncio.create_task(self._release(manager))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+    
+    async def get_response_body(self, url: str) -> bytes:
+        """Получение тела ответа через свободную сессию пула"""
+        async with self.lease() as manager:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, manager.get_response_body, url)
+    
+    def readiness(self) -> Dict[str, Any]:
+        """Состояние пула и счетчики сторожа для отчета о готовности"""
+        return {
+            'state': self.state,
+            'sessions': len(self.managers),
+            'startup_seconds': self.startup_seconds,
+            'recycles': self.recycles,
+            'crashes': self.crashes,
+            'launch_failures': self.launch_failures,
+            'probes': self.probes
+        }
+    
+    def close(self):
+        """Закрытие всех сессий пула"""
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        if self._start_task is not None:
+            self._start_task.cancel()
+            self._start_task = None
+        for task in self._background:
+            task.cancel()
+        for manager in self.managers:
+            try:
+                manager.close()
+            except Exception as e:
+                logger.error(f"Ошибка при закрытии WebDriver: {e}")
+        self.managers.clear()
+        self.executor.shutdown(wait=False)
+
+def build_search_result(tours: List[dict]) -> SearchResult:
+    """Группировка списка туров с понятной ошибкой при неожиданном формате"""
+    return SearchResult(build_tour_table(tours))
+
+def build_tour_table(tours: List[dict]) -> TourTable:
+    """Разбор списка туров в таблицу с понятной ошибкой при неожиданном формате"""
+    try:
+        return TourTable.from_tours(tours)
+    except (KeyError, TypeError, ValueError, OverflowError) as e:
+        # OverflowError - идентификатор или число ночей вне диапазона int32
+        logger.error(f"Ошибка при парсинге туров: {e}")
+        raise FetchError(f"Ошибка при обработке данных: {e}")
 
-class WebDriverManager:
-    """Менеджер для работы с Selenium WebDriver"""
+class TourFetcher:
+    """Получение данных о турах: прямой HTTP-запрос, браузер - запасной вариант"""
     
-    def __init__(self):
-        self.driver = None
-        self.setup_driver()
+    def __init__(self, browser_pool: BrowserPool):
+        self.http = HttpFetcher()
+        self.browser_pool = browser_pool
     
-    def setup_driver(self):
-        """Настройка Chrome WebDriver"""
+    async def fetch(self, url: str) -> bytes:
+        """Получение тела ответа API по URL"""
         try:
-            # Автоматическая установка chromedriver
-            chromedriver_autoinstaller.install()
-            
-            # Настройка опций Chrome
-            chrome_options = Options()
-            chrome_options.add_argument("--headless=new")  # Новый headless режим
-            chrome_options.add_argument("--no-sandbox")
-            chrome_options.add_argument("--disable-dev-shm-usage")
-            chrome_options.add_argument("--disable-gpu")
-            chrome_options.add_argument("--window-size=1920,1080")
-            chrome_options.add_argument("--disable-blink-features=AutomationControlled")
-            chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
-            chrome_options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
-            
-            service = Service()
-            self.driver = webdriver.Chrome(service=service, options=chrome_options)
-            self.driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-            self.driver.set_page_load_timeout(30)
-            logger.info("Chrome WebDriver успешно запущен")
-            
-        except Exception as e:
-            logger.error(f"Ошибка при запуске WebDriver: {e}")
-            raise
+            return await self.http.fetch(url)
+        except FetchBlockedError as e:
+            logger.warning(f"Прямой запрос заблокирован ({e}), переключаюсь на браузер")
+        
+        return await self.browser_pool.get_response_body(url)
+    
+    async def tours(self, query: SearchQuery) -> List[dict]:
+        """Запрос к API и разбор ответа в список туров"""
+        body = await self.fetch(query.to_url())
+        tours = decode_payload(body)['data']
+        if not isinstance(tours, list):
+            raise FetchError("Ошибка при обработке данных: неожиданный формат списка туров")
+        return tours
+    
+    async def table(self, query: SearchQuery) -> TourTable:
+        """Запрос к API и однократный разбор ответа в колоночную таблицу"""
+        return build_tour_table(await self.tours(query))
     
-    def get_page_content(self, url: str) -> str:
-        """Получение содержимого страницы"""
+    async def warm_up(self):
+        """Запуск браузеров заранее, чтобы первый заблокированный запрос не ждал Chrome"""
+        await self.browser_pool.warm_up()
+    
+    def readiness(self) -> Dict[str, Any]:
+        """Готовность браузеров"""
+        return {'browser': self.browser_pool.readiness()}
+    
+    async def close(self):
+        """Закрытие HTTP-клиента и браузеров"""
+        await self.http.close()
+        self.browser_pool.close()
+
+async def _shard_serve(conn, browser_pool_size: int):
+    """Цикл процесса-шарда: запросы читаются из канала и выполняются одновременно в одном event loop"""
+    loop = asyncio.get_running_loop()
+    fetcher = TourFetcher(BrowserPool(browser_pool_size))
+    # Отдельные потоки для чтения и записи: ожидание нового запроса не мешает отправке ответов
+    reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-recv")
+    writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-send")
+    tasks: set = set()
+    
+    async def handle(request_id: int, method: str, argument):
         try:
-            logger.info(f"Перехожу по URL: {url}")
-            self.driver.get(url)
-            
-            # Ждем загрузки страницы
-            WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.TAG_NAME, "body"))
-            )
-            
-            # Получаем весь текст страницы
-            page_content = self.driver.page_source
-            
-            logger.info(f"Успешно получено содержимое страницы, длина: {len(page_content)} символов")
-            return page_content
-            
-        except TimeoutException:
-            error_msg = "Таймаут при загрузке страницы"
-            logger.error(error_msg)
-            return error_msg
+            if method == 'table':
+                reply = (request_id, True, await fetcher.table(argument))
+            else:
+                await fetcher.warm_up()
+                reply = (request_id, True, fetcher.browser_pool.readiness())
+        except FetchError as e:
+            reply = (request_id, False, str(e))
         except Exception as e:
-            error_msg = f"Ошибка при получении содержимого страницы: {str(e)}"
-            logger.error(error_msg)
-            return error_msg
+            logger.error(f"Ошибка в процессе шарда: {e}")
+            reply = (request_id, False, f"Ошибка получения данных: {e}")
+        await loop.run_in_executor(writer, conn.send, reply)
     
-    def close(self):
-        """Закрытие драйвера"""
-        if self.driver:
-            self.driver.quit()
-            logger.info("WebDriver закрыт")
+    try:
+        while True:
+            try:
+                message = await loop.run_in_executor(reader, conn.recv)
+            except (EOFError, OSError):
+                break
+            if message is None:
+                break
+            task = asyncio.create_task(handle(*message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await fetcher.close()
+        reader.shutdown(wait=False)
+        writer.shutdown(wait=True)
+
+def _shard_main(conn, browser_pool_size: int):
+    """Точка входа процесса-шарда: постоянный event loop живет, пока открыт канал"""
+    try:
+        asyncio.run(_shard_serve(conn, browser_pool_size))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+class FetchShard:
+    """Долгоживущий процесс-шард и ожидающие его ответов запросы основного процесса"""
+    
+    __slots__ = ('process', 'conn', 'pending', 'reader', 'closing', '_seq')
+    
+    def __init__(self, browser_pool_size: int, on_broken: Callable[['FetchShard'], None],
+                 loop: asyncio.AbstractEventLoop):
+        # spawn, а не fork: дочерний процесс не наследует потоки и event loop родителя
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_shard_main, args=(child_conn, browser_pool_size), name="fetch-shard", daemon=True
+        )
+        self.process.start()
+        # Своя копия конца шарда закрывается, иначе смерть шарда не даст EOF в канале
+        child_conn.close()
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.closing = False
+        self._seq = 0
+        self.reader = threading.Thread(
+            target=self._read, args=(loop, on_broken), name="fetch-shard-reader", daemon=True
+        )
+        self.reader.start()
+    
+    def _read(self, loop: asyncio.AbstractEventLoop, on_broken: Callable[['FetchShard'], None]):
+        """Поток чтения ответов: результаты передаются в event loop по номеру запроса"""
+        try:
+            while True:
+                try:
+                    request_id, ok, payload = self.conn.recv()
+                except (EOFError, OSError):
+                    if not self.closing:
+                        loop.call_soon_threadsafe(on_broken, self)
+                    return
+                loop.call_soon_threadsafe(self._resolve, request_id, ok, payload)
+        except RuntimeError:
+            # Event loop уже закрыт - ответ некому передавать
+            pass
+    
+    def _resolve(self, request_id: int, ok: bool, payload):
+        future = self.pending.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if ok:
+            future.set_result(payload)
+        else:
+            future.set_exception(FetchError(payload))
+    
+    async def call(self, method: str, argument=None):
+        """Отправка запроса в шард; одновременно в шарде может выполняться сколько угодно запросов"""
+        self._seq += 1
+        request_id = self._seq
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self.conn.send((request_id, method, argument))
+        except (OSError, ValueError) as e:
+            self.pending.pop(request_id, None)
+            raise FetchError(f"Ошибка получения данных: шард недоступен ({e})")
+        try:
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+    
+    def fail_pending(self, error: Exception):
+        """Завершение ожидающих запросов ошибкой (шард упал)"""
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+    
+    def close(self, timeout: float = 10.0):
+        """Штатная остановка: шард закрывает браузеры и выходит (блокирующий вызов)"""
+        self.closing = True
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+class ShardedFetcher:
+    """Распределение запросов к API по долгоживущим процессам-шардам по хэшу запроса"""
+    
+    def __init__(self, shards: int = SHARD_WORKERS, browser_pool_size: int = SHARD_BROWSER_POOL_SIZE):
+        self.browser_pool_size = browser_pool_size
+        # Процессы запускаются при первом обращении из работающего event loop
+        self.shards: List[Optional[FetchShard]] = [None] * max(1, shards)
+        self.requests = [0] * len(self.shards)
+        self.restarts = 0
+        self.shard_readiness: List[Optional[Dict[str, Any]]] = [None] * len(self.shards)
+    
+    def _shard(self, index: int) -> FetchShard:
+        shard = self.shards[index]
+        if shard is None:
+            shard = FetchShard(self.browser_pool_size, self._on_broken, asyncio.get_running_loop())
+            self.shards[index] = shard
+        return shard
+    
+    def _on_broken(self, shard: FetchShard):
+        """Упавший процесс (например, из-за Chrome) заменяется новым, остальные шарды не трогаем"""
+        if shard not in self.shards:
+            return
+        index = self.shards.index(shard)
+        logger.error(f"Процесс шарда {index} аварийно завершился, перезапускаю")
+        shard.fail_pending(FetchError("Ошибка получения данных: процесс поиска аварийно завершился"))
+        shard.closing = True
+        shard.conn.close()
+        if shard.process.is_alive():
+            shard.process.kill()
+        self.shards[index] = None
+        self.shard_readiness[index] = None
+        self.restarts += 1
+        self._shard(index)
+    
+    def shard_of(self, query: SearchQuery) -> int:
+        """Номер шарда для запроса; даты не учитываются, хэш не зависит от PYTHONHASHSEED"""
+        # Отрезки дат одного маршрута (и проверки мониторинга по нему) попадают в один шард
+        route = replace(query, check_in_date_range_from=None, check_in_date_range_to=None)
+        digest = hashlib.blake2b(route.to_json().encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % len(self.shards)
+    
+    @property
+    def partitions(self) -> int:
+        return len(self.shards)
+    
+    async def table(self, query: SearchQuery) -> TourTable:
+        """Таблица туров, разобранная в процессе-шарде"""
+        index = self.shard_of(query)
+        self.requests[index] += 1
+        return await self._shard(index).call('table', query)
+    
+    async def warm_up(self):
+        """Прогрев браузеров во всех шардах"""
+        results = await asyncio.gather(
+            *(self._shard(index).call('warm_up') for index in range(len(self.shards))),
+            return_exceptions=True
+        )
+        for index, result in enumerate(results):
+            self.shard_readiness[index] = result if isinstance(result, dict) else {'state': 'failed'}
+    
+    def readiness(self) -> Dict[str, Any]:
+        """Готовность браузеров по шардам (известна после прогрева)"""
+        return {'shards': self.shard_readiness, 'restarts': self.restarts, 'requests': list(self.requests)}
+    
+    async def close(self):
+        """Остановка процессов-шардов вместе с их браузерами"""
+        await asyncio.gather(*(
+            asyncio.to_thread(shard.close) for shard in self.shards if shard is not None
+        ))
+
+def telegram_length(text: str) -> int:
+    """Длина текста так, как ее считает Telegram: в UTF-16 символах (эмодзи - два)"""
+    return len(text.encode('utf-16-le')) // 2
+
+def truncate_message(text: str, limit: int) -> str:
+    """Обрезка текста по границе строки, чтобы он поместился в limit символов Telegram"""
+    suffix = "\n…"
+    budget = limit - telegram_length(suffix)
+    cut = text[:budget]
+    while telegram_length(cut) > budget:
+        cut = cut[:-(telegram_length(cut) - budget)]
+    if "\n" in cut:
+        cut = cut[:cut.rindex("\n")]
+    return cut + suffix
 
 class TravelataBot:
     def __init__(self, token: str):
         self.token = token
         self.bot = Bot(token=token)
-        self.dp = Dispatcher(storage=MemoryStorage())
+        # Все экземпляры с одним токеном принимают обновления с одним секретом, кто бы ни вызвал setWebhook последним
+        self.webhook_secret = WEBHOOK_SECRET or hmac.new(token.encode(), b"webhook", hashlib.sha256).hexdigest()
+        self.outbox = OutboundQueue(self.bot)
+        # Общее файловое хранилище позволяет запустить несколько процессов с одним ботом
+        self.fsm_storage = SQLiteStorage(FSM_STORAGE_PATH) if FSM_STORAGE_PATH else MemoryStorage()
+        self.dp = Dispatcher(storage=self.fsm_storage)
         self.router = Router()
-        self.user_params = {}
-        self.monitoring_users = {}
-        self.web_driver_manager = WebDriverManager()
-        self.last_request_time = {}
-        self.request_delay = 2  # секунды между запросами
+        self.user_params = SessionStore()
+        self.monitoring_store = MonitoringStore()
+        # Листание может прийти в другой процесс: при общем хранилище результаты лежат и в нем
+        self.search_sessions = ResultSessions(self.fsm_storage if FSM_STORAGE_PATH else None)
+        if SHARD_WORKERS > 0:
+            # Процесс бота только общается с Telegram, поиск и разбор идут в шардах
+            self.fetcher = ShardedFetcher()
+        else:
+            self.fetcher = TourFetcher(BrowserPool())
+        self.response_cache = TTLCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIZE)
+        self.day_slices = TTLCache(RESPONSE_CACHE_TTL, DAY_SLICE_CACHE_SIZE)
+        self.single_flight = SingleFlight()
+        if SHARD_WORKERS > 0:
+            # Проверки мониторинга делятся по шардам так же, как запросы поиска
+            self.scheduler = MonitoringScheduler(
+                self.monitor_tours, partitions=self.fetcher.partitions, partition_of=self.fetcher.shard_of
+            )
+        else:
+            self.scheduler = MonitoringScheduler(self.monitor_tours)
+        # Обновление справочников включается, только если задан источник
+        self.dictionary_refresher = DictionaryRefresher(DICTIONARIES_URL) if DICTIONARIES_URL else None
+        self.throttling = ThrottlingMiddleware()
+        self.webhook_slots = asyncio.Semaphore(WEBHOOK_MAX_CONCURRENT)
+        self.webhook_tasks: set = set()
+        self.warmup_task: Optional[asyncio.Task] = None
+        self.lease_task: Optional[asyncio.Task] = None
+        self.stats_task: Optional[asyncio.Task] = None
         
         # Регистрация обработчиков
         self.setup_handlers()
         self.dp.include_router(self.router)
     
-    async def rate_limit(self, user_id: int):
-        """Ограничение частоты запросов"""
-        current_time = time.time()
-        if user_id in self.last_request_time:
-            time_passed = current_time - self.last_request_time[user_id]
-            if time_passed < self.request_delay:
-                await asyncio.sleep(self.request_delay - time_passed)
-        self.last_request_time[user_id] = current_time
-    
     def escape_markdown(self, text: str) -> str:
         """Экранирование специальных символов Markdown"""
         escape_chars = r'\_*[]()~`>#+-=|{}.!'
@@ -264,17 +2989,18 @@ class TravelataBot:
     def _create_search_summary(self, params: UserParams) -> str:
         """Создание сводки параметров поиска"""
         summary = ""
+        refs = reference_data()
         
         if params.countries:
-            country_names = [name for name, id in COUNTRIES.items() if id in params.countries]
+            country_names = refs.countries.names_of(params.countries)
             summary += f"• 🌍 Страна: {', '.join(country_names)}\n"
         
         if params.departure_city:
-            city_name = [name for name, id in DEPARTURE_CITIES.items() if id == params.departure_city]
-            summary += f"• 🛫 Вылет из: {city_name[0] if city_name else params.departure_city}\n"
+            city_name = refs.departure_cities.name_of(params.departure_city)
+            summary += f"• 🛫 Вылет из: {city_name or params.departure_city}\n"
         
         if params.resorts:
-            resort_names = [name for name, id in RESORTS_LIST.items() if id in params.resorts]
+            resort_names = refs.resorts.names_of(params.resorts)
             summary += f"• 🏖 Курорты: {', '.join(resort_names) if resort_names else 'Любые'}\n"
         
         if params.tourist_group_adults:
@@ -297,144 +3023,162 @@ class TravelataBot:
         
         return summary
     
-    def safe_send_message(self, chat_id: int, text: str, **kwargs):
+    async def safe_send_message(self, chat_id: int, text: str, **kwargs):
         """Безопасная отправка сообщения с обработкой ошибок форматирования"""
         try:
             # Пытаемся отправить с Markdown
-            return self.bot.send_message(chat_id, text, parse_mode="Markdown", **kwargs)
+            return await self.outbox.send_message(chat_id, text, parse_mode="Markdown", **kwargs)
         except Exception as e:
             if "can't parse entities" in str(e):
                 # Если ошибка форматирования, отправляем без разметки
                 logger.warning(f"Markdown ошибка, отправляю без форматирования: {e}")
                 # Убираем Markdown символы
                 clean_text = re.sub(r'[*_`\[\]()~>#+\-=|{}.!]', '', text)
-                return self.bot.send_message(chat_id, clean_text, **kwargs)
+                return await self.outbox.send_message(chat_id, clean_text, **kwargs)
             else:
                 raise
     
-    def parse_json_to_hotels_list(self, json_text: str) -> Tuple[str, bool]:
-        """Преобразование JSON текста в список отелей"""
+    def parse_json_to_hotels_list(self, result: SearchResult, page: int = 0) -> Tuple[str, bool]:
+        """Преобразование результата поиска в страницу списка отелей"""
         try:
-            # Пытаемся найти JSON в тексте страницы
-            start_idx = json_text.find('{')
-            end_idx = json_text.rfind('}') + 1
-            
-            if start_idx == -1 or end_idx == 0:
-                return "❌ Не удалось найти данные на странице. Попробуйте позже.", False
-            
-            json_str = json_text[start_idx:end_idx]
-            data = json.loads(json_str)
-            
-            if not data.get('success') or 'data' not in data:
-                return "❌ Ошибка получения данных от системы поиска", False
-            
-            tours = data['data']
-            if not tours:
+            if not result.hotels_count:
                 return "📭 По вашему запросу туров не найдено.\n\nПопробуйте изменить параметры поиска:", True
             
-            # Группировка по отелям (убираем дубликаты по hotelId)
-            hotels = {}
-            for tour in tours:
-                hotel_id = tour['hotelId']
-                hotel_name = tour['hotelName']
-                
-                if hotel_id not in hotels:
-                    hotels[hotel_id] = {
-                        'name': hotel_name,
-                        'category': tour['hotelCategoryName'],
-                        'rating': float(tour['hotelRating']),
-                        'prices': [],
-                        'min_nights': float('inf'),
-                        'max_nights': 0,
-                        'checkin_dates': set(),
-                        'tour_urls': [],
-                        'meal_types': set()
-                    }
-                
-                # Добавляем данные, избегая полных дубликатов
-                hotels[hotel_id]['prices'].append(tour['price'])
-                hotels[hotel_id]['min_nights'] = min(hotels[hotel_id]['min_nights'], tour['nights'])
-                hotels[hotel_id]['max_nights'] = max(hotels[hotel_id]['max_nights'], tour['nights'])
-                hotels[hotel_id]['checkin_dates'].add(tour['checkinDate'])
-                hotels[hotel_id]['meal_types'].add(tour['mealId'])
-                
-                # Сохраняем URL самого дешевого тура для этого отеля
-                if not hotels[hotel_id]['tour_urls'] or tour['price'] == min(hotels[hotel_id]['prices']):
-                    hotels[hotel_id]['tour_urls'].append(tour['tourPageUrl'])
-            
-            # Сортировка отелей по минимальной цене
-            sorted_hotels = sorted(
-                hotels.values(),
-                key=lambda x: min(x['prices'])
-            )
-            
-            # Формирование списка отелей БЕЗ Markdown форматирования
-            message = "🎯 РЕЗУЛЬТАТЫ ПОИСКА\n"
-            message += "══════════════════════════════\n"
-            message += f"🏨 Найдено отелей: {len(hotels)}\n"
-            message += f"📊 Всего туров: {len(tours)}\n"
-            message += "══════════════════════════════\n\n"
-            
-            for i, hotel in enumerate(sorted_hotels[:15], 1):  # Показываем топ-15 отелей
-                min_price = min(hotel['prices'])
-                max_price = max(hotel['prices'])
-                
-                # Форматирование ночей
-                nights_info = f"{hotel['min_nights']}"
-                if hotel['min_nights'] != hotel['max_nights']:
-                    nights_info = f"{hotel['min_nights']}-{hotel['max_nights']}"
-                
-                # Форматирование дат
-                dates = sorted(hotel['checkin_dates'])[:3]  # Первые 3 даты
-                dates_str = ", ".join(dates)
-                if len(hotel['checkin_dates']) > 3:
-                    dates_str += f" (+{len(hotel['checkin_dates']) - 3})"
-                
-                # Ссылка на отель (берем первый URL)
-                hotel_link = hotel['tour_urls'][0] if hotel['tour_urls'] else "#"
-                
-                message += f"{i}. {hotel['name']}\n"
-                message += f"   🏷 Категория: {hotel['category']}\n"
-                message += f"   ⭐ Рейтинг: {hotel['rating']}\n"
-                message += f"   💰 Цена: от {min_price:,} руб."
-                if min_price != max_price:
-                    message += f" до {max_price:,} руб."
-                message += f"\n"
-                message += f"   🗓 Ночи: {nights_info}\n"
-                message += f"   📅 Даты заезда: {dates_str}\n"
-                message += f"   🔗 Ссылка: {hotel_link}\n"
-                
-                # Разделитель между отелями
-                if i < min(15, len(sorted_hotels)):
-                    message += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
+            return self._render_results_page(result, page), True
             
-            if len(sorted_hotels) > 15:
-                message += f"\n... и еще {len(sorted_hotels) - 15} отелей"
-            
-            # Добавляем статистику
-            total_hotels = len(hotels)
-            avg_rating = sum(h['rating'] for h in hotels.values()) / total_hotels
-            min_price_overall = min(min(h['prices']) for h in hotels.values())
-            
-            message += f"\n\n📈 СТАТИСТИКА ПОИСКА:\n"
-            message += f"• Самый дешевый отель: {min_price_overall:,} руб.\n"
-            message += f"• Средний рейтинг отелей: ⭐{avg_rating:.2f}\n"
-            message += f"• Всего вариантов: {len(tours)} туров\n"
-            
-            return message, True
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка декодирования JSON: {e}")
-            return "❌ Ошибка: Неверный формат данных от сервера", False
         except Exception as e:
             logger.error(f"Ошибка при парсинге туров: {e}")
             return f"❌ Ошибка при обработке данных: {str(e)}", False
 
+    def _pages_count(self, result: SearchResult) -> int:
+        """Количество страниц результатов (листаются только самые дешевые отели)"""
+        return max(1, -(-min(result.hotels_count, SEARCH_SESSION_MAX_HOTELS) // HOTELS_PER_PAGE))
+
+    def _render_results_page(self, result: SearchResult, page: int) -> str:
+        """Формирование одной страницы результатов (БЕЗ Markdown форматирования)"""
+        pages = self._pages_count(result)
+        page = min(max(page, 0), pages - 1)
+        offset = page * HOTELS_PER_PAGE
+        
+        # Сводки строятся только для отелей этой страницы
+        hotels = result.hotels_page(offset, HOTELS_PER_PAGE)
+        
+        header = (
+            "🎯 РЕЗУЛЬТАТЫ ПОИСКА\n"
+            "══════════════════════════════\n"
+            f"🏨 Найдено отелей: {result.hotels_count}\n"
+            f"📊 Всего туров: {result.tours_count}\n"
+            "══════════════════════════════\n\n"
+        )
+        
+        footer = ""
+        if pages > 1:
+            footer += f"\n📄 Страница {page + 1} из {pages}"
+            if result.hotels_count > SEARCH_SESSION_MAX_HOTELS:
+                footer += f" (показаны {SEARCH_SESSION_MAX_HOTELS} самых дешевых отелей)"
+        
+        # Добавляем статистику
+        footer += (
+            f"\n\n📈 СТАТИСТИКА ПОИСКА:\n"
+            f"• Самый дешевый отель: {result.min_price():,} руб.\n"
+            f"• Средний рейтинг отелей: ⭐{result.avg_rating():.2f}\n"
+            f"• Всего вариантов: {result.tours_count} туров\n"
+        )
+        
+        separator = "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        text = header + separator.join(
+            self._format_hotel(i, hotel) for i, hotel in enumerate(hotels, offset + 1)
+        ) + footer
+        if telegram_length(text) <= TELEGRAM_MESSAGE_LIMIT:
+            return text
+        
+        # Длинные названия и ссылки не помещаются в одно сообщение - краткий формат без разделителей
+        text = header + "\n".join(
+            self._format_hotel_short(i, hotel) for i, hotel in enumerate(hotels, offset + 1)
+        ) + footer
+        if telegram_length(text) <= TELEGRAM_MESSAGE_LIMIT:
+            return text
+        return truncate_message(text, TELEGRAM_MESSAGE_LIMIT)
+
+    def _format_hotel(self, position: int, hotel: HotelAggregate) -> str:
+        """Описание одного отеля в списке"""
+        # Форматирование ночей
+        nights_info = f"{hotel.min_nights}"
+        if hotel.min_nights != hotel.max_nights:
+            nights_info = f"{hotel.min_nights}-{hotel.max_nights}"
+        
+        # Форматирование дат
+        dates = sorted(hotel.checkin_dates)[:3]  # Первые 3 даты
+        dates_str = ", ".join(dates)
+        if len(hotel.checkin_dates) > 3:
+            dates_str += f" (+{len(hotel.checkin_dates) - 3})"
+        
+        price_str = f"от {hotel.min_price:,} руб."
+        if hotel.min_price != hotel.max_price:
+            price_str += f" до {hotel.max_price:,} руб."
+        
+        # Ссылка на самый дешевый тур отеля
+        hotel_link = hotel.cheapest_url or "#"
+        
+        return (
+            f"{position}. {hotel.name}\n"
+            f"   🏷 Категория: {hotel.category}\n"
+            f"   ⭐ Рейтинг: {hotel.rating}\n"
+            f"   💰 Цена: {price_str}\n"
+            f"   🗓 Ночи: {nights_info}\n"
+            f"   📅 Даты заезда: {dates_str}\n"
+            f"   🔗 Ссылка: {hotel_link}\n"
+        )
+
+    def _format_hotel_short(self, position: int, hotel: HotelAggregate) -> str:
+        """Краткое описание отеля для страниц, не помещающихся в сообщение"""
+        return f"{position}. {hotel.name} - от {hotel.min_price:,} руб.\n{hotel.cheapest_url or '#'}\n"
+
+    def _results_keyboard(self, page: int, pages: int) -> Optional[InlineKeyboardMarkup]:
+        """Кнопки листания результатов"""
+        if pages <= 1:
+            return None
+        
+        row = []
+        if page > 0:
+            row.append(InlineKeyboardButton(text="◀️", callback_data=f"page:{page - 1}"))
+        row.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="page:current"))
+        if page < pages - 1:
+            row.append(InlineKeyboardButton(text="▶️", callback_data=f"page:{page + 1}"))
+        return InlineKeyboardMarkup(inline_keyboard=[row])
+
+    async def show_results_page(self, callback: CallbackQuery, state: FSMContext) -> None:
+        """Листание результатов поиска в одном сообщении"""
+        await callback.answer()
+        
+        page = callback.data.split(":", 1)[1]
+        if not page.isdigit():
+            return
+        
+        result = await self.search_sessions.get(callback.from_user.id, callback.message.message_id)
+        if result is None:
+            keyboard = [
+                [InlineKeyboardButton(text="🔄 Повторить поиск", callback_data="start_search")]
+            ]
+            await self.outbox.edit_message(
+                callback.message.chat.id, callback.message.message_id,
+                "⌛ Результаты поиска устарели\n\nВыполните поиск снова:",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
+            )
+            return
+        
+        pages = self._pages_count(result)
+        page = min(int(page), pages - 1)
+        await self.outbox.edit_message(
+            callback.message.chat.id, callback.message.message_id,
+            self._render_results_page(result, page),
+            reply_markup=self._results_keyboard(page, pages)
+        )
+
     async def start(self, message: Message, state: FSMContext) -> None:
         """Обработчик команды /start"""
-        await self.rate_limit(message.from_user.id)
         user_id = message.from_user.id
-        self.user_params[user_id] = UserParams()
+        self.user_params.reset(user_id)
         await state.clear()
         
         keyboard = [
@@ -443,7 +3187,8 @@ class TravelataBot:
         ]
         reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
         
-        await message.answer(
+        await self.outbox.send_message(
+            message.chat.id,
             "✨ Добро пожаловать в Travelata Parser!\n\n"
             "Я помогу найти самые выгодные туры по вашим параметрам 🤑\n"
             "Начнем с настройки параметров поиска:",
@@ -470,19 +3215,21 @@ class TravelataBot:
         ]
         reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
         
-        await callback.message.edit_text(help_text, reply_markup=reply_markup)
+        await self.outbox.edit_message(
+            callback.message.chat.id, callback.message.message_id, help_text, reply_markup=reply_markup
+        )
 
     async def set_params(self, callback: CallbackQuery, state: FSMContext) -> None:
         """Начало установки параметров"""
         await callback.answer()
-        await self.rate_limit(callback.from_user.id)
         
         keyboard = [
             [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_start")]
         ]
         reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
         
-        await callback.message.edit_text(
+        await self.outbox.edit_message(
+            callback.message.chat.id, callback.message.message_id,
             "🌍 Шаг 1/10: Выбор страны\n\n"
             "Напишите название страны в именительном падеже:\n"
             "Пример: Турция или Египет\n\n"
@@ -493,21 +3240,22 @@ class TravelataBot:
 
     async def get_country(self, message: Message, state: FSMContext) -> None:
         """Получение страны от пользователя"""
-        await self.rate_limit(message.from_user.id)
         user_id = message.from_user.id
         country_input = message.text.strip().lower()
+        countries = reference_data().countries
+        country_id = countries.get(country_input)
         
-        if country_input in COUNTRIES:
-            country_id = COUNTRIES[country_input]
-            self.user_params[user_id].countries = [country_id]
+        if country_id:
+            self.user_params.params(user_id).countries = [country_id]
             
             keyboard = [
                 [InlineKeyboardButton(text="◀️ Назад", callback_data="set_params")]
             ]
             reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
             
-            await message.answer(f"✅ Страна выбрана: {message.text}")
-            await message.answer(
+            await self.outbox.send_message(message.chat.id, f"✅ Страна выбрана: {message.text}")
+            await self.outbox.send_message(
+                message.chat.id,
                 "🛫 Шаг 2/10: Город вылета\n\n"
                 "Напишите город вылета в именительном падеже:\n"
                 "Пример: Москва или Санкт-Петербург",
@@ -516,10 +3264,11 @@ class TravelataBot:
             await state.set_state(UserStates.DEPARTURE_CITY)
         else:
             # Поиск похожих вариантов
-            suggestions = [name for name in COUNTRIES.keys() if country_input in name][:3]
+            suggestions = countries.suggest(country_input)
             suggestions_text = "\n".join(f"• {suggestion}" for suggestion in suggestions) if suggestions else "не найдено"
             
-            await message.answer(
+            await self.outbox.send_message(
+                message.chat.id,
                 f"❌ Страна не найдена\n\n"
                 f"Проверьте правильность написания.\n"
                 f"Возможные варианты:\n{suggestions_text}\n\n"
@@ -529,21 +3278,22 @@ class TravelataBot:
 
     async def get_departure_city(self, message: Message, state: FSMContext) -> None:
         """Получение города вылета"""
-        await self.rate_limit(message.from_user.id)
         user_id = message.from_user.id
         city_input = message.text.strip().lower()
+        cities = reference_data().departure_cities
+        city_id = cities.get(city_input)
         
-        if city_input in DEPARTURE_CITIES:
-            city_id = DEPARTURE_CITIES[city_input]
-            self.user_params[user_id].departure_city = city_id
+        if city_id:
+            self.user_params.params(user_id).departure_city = city_id
             
             keyboard = [
                 [InlineKeyboardButton(text="◀️ Назад", callback_data="set_params")]
             ]
             reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
             
-            await message.answer(f"✅ Город вылета: {message.text}")
-            await message.answer(
+            await self.outbox.send_message(message.chat.id, f"✅ Город вылета: {message.text}")
+            await self.outbox.send_message(
+                message.chat.id,
                 "🏖 Шаг 3/10: Выбор курортов\n\n"
                 "Напишите города/курорты через пробел:\n"
                 "Пример: Анталья Кемер Сиде\n\n"
@@ -552,10 +3302,11 @@ class TravelataBot:
             )
             await state.set_state(UserStates.RESORTS)
         else:
-            suggestions = [name for name in DEPARTURE_CITIES.keys() if city_input in name][:3]
+            suggestions = cities.suggest(city_input)
             suggestions_text = "\n".join(f"• {suggestion}" for suggestion in suggestions) if suggestions else "не найдено"
             
-            await message.answer(
+            await self.outbox.send_message(
+                message.chat.id,
                 f"❌ Город не найден\n\n"
                 f"Возможные варианты:\n{suggestions_text}\n\n"
                 f"Попробуйте еще раз:"
@@ -564,33 +3315,32 @@ class TravelataBot:
 
     async def get_resorts(self, message: Message, state: FSMContext) -> None:
         """Получение курортов"""
-        await self.rate_limit(message.from_user.id)
         user_id = message.from_user.id
         resorts_input = message.text.strip().lower()
         
         if resorts_input in ["нет", "нету", "не важно"]:
-            self.user_params[user_id].resorts = []
+            self.user_params.params(user_id).resorts = []
             resorts_text = "Не указаны"
         else:
-            resorts_list = resorts_input.split()
-            valid_resorts = []
-            invalid_resorts = []
-            
-            for resort in resorts_list:
-                if resort in RESORTS_LIST:
-                    valid_resorts.append(RESORTS_LIST[resort])
-                else:
-                    invalid_resorts.append(resort)
+            resorts = reference_data().resorts
+            # Многословные курорты ("золотые пески") распознаются целиком
+            valid_resorts, resorts_list, invalid_resorts = resorts.parse_list(resorts_input)
             
             if valid_resorts:
-                self.user_params[user_id].resorts = valid_resorts
+                self.user_params.params(user_id).resorts = valid_resorts
                 resorts_text = ", ".join(resorts_list)
                 
                 if invalid_resorts:
-                    await message.answer(f"⚠️ Не найдены курорты: {', '.join(invalid_resorts)}")
+                    await self.outbox.send_message(
+                        message.chat.id, f"⚠️ Не найдены курорты: {', '.join(invalid_resorts)}"
+                    )
             else:
-                await message.answer(
+                suggestions = [name for resort in invalid_resorts for name in resorts.suggest(resort, limit=2)]
+                suggestions_text = "\n".join(f"• {suggestion}" for suggestion in suggestions) if suggestions else "не найдено"
+                await self.outbox.send_message(
+                    message.chat.id,
                     "❌ Курорты не найдены\n\n"
+                    f"Возможные варианты:\n{suggestions_text}\n\n"
                     "Проверьте правильность написания и попробуйте еще раз:"
                 )
                 await state.set_state(UserStates.RESORTS)
@@ -601,8 +3351,9 @@ class TravelataBot:
         ]
         reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
         
-        await message.answer(f"✅ Курорты: {resorts_text}")
-        await message.answer(
+        await self.outbox.send_message(message.chat.id, f"✅ Курорты: {resorts_text}")
+        await self.outbox.send_message(
+            message.chat.id,
             "🍽 Шаг 4/10: Тип питания\n\n"
             "Доступные варианты:\n"
             "• RO - без питания\n"
@@ -619,32 +3370,35 @@ class TravelataBot:
 
     async def get_meals(self, message: Message, state: FSMContext) -> None:
         """Получение типов питания"""
-        await self.rate_limit(message.from_user.id)
         user_id = message.from_user.id
         meals_input = message.text.strip().upper()
         
         if meals_input in ["НЕ НУЖНО", "НЕТУ", "НЕТ", "ЛЮБОЙ"]:
-            self.user_params[user_id].meals = []
+            self.user_params.params(user_id).meals = []
             meals_text = "Любой"
         else:
+            meals_mapping = reference_data().meals
             meals_list = meals_input.split()
             valid_meals = []
             invalid_meals = []
             
             for meal in meals_list:
-                if meal in MEALS_MAPPING:
-                    valid_meals.append(MEALS_MAPPING[meal])
+                if meal in meals_mapping:
+                    valid_meals.append(meals_mapping[meal])
                 else:
                     invalid_meals.append(meal)
             
             if valid_meals:
-                self.user_params[user_id].meals = valid_meals
+                self.user_params.params(user_id).meals = valid_meals
                 meals_text = ", ".join(meals_list)
                 
                 if invalid_meals:
-                    await message.answer(f"⚠️ Неизвестные типы питания: {', '.join(invalid_meals)}")
+                    await self.outbox.send_message(
+                        message.chat.id, f"⚠️ Неизвестные типы питания: {', '.join(invalid_meals)}"
+                    )
             else:
-                await message.answer(
+                await self.outbox.send_message(
+                    message.chat.id,
                     "❌ Типы питания не распознаны\n\n"
                     "Проверьте правильность кодов и попробуйте еще раз:"
                 )
@@ -656,8 +3410,9 @@ class TravelataBot:
         ]
         reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
         
-        await message.answer(f"✅ Питание: {meals_text}")
-        await message.answer(
+        await self.outbox.send_message(message.chat.id, f"✅ Питание: {meals_text}")
+        await self.outbox.send_message(
+            message.chat.id,
             "👨‍👩‍👧‍👦 Шаг 5/10: Количество туристов\n\n"
             "Напишите, сколько будет взрослых людей:",
             reply_markup=reply_markup
@@ -666,20 +3421,20 @@ class TravelataBot:
 
     async def get_adults(self, message: Message, state: FSMContext) -> None:
         """Получение количества взрослых"""
-        await self.rate_limit(message.from_user.id)
         user_id = message.from_user.id
         adults_input = message.text.strip()
         
         if adults_input.isdigit() and int(adults_input) > 0:
-            self.user_params[user_id].tourist_group_adults = adults_input
+            self.user_params.params(user_id).tourist_group_adults = adults_input
             
             keyboard = [
                 [InlineKeyboardButton(text="◀️ Назад", callback_data="set_params")]
             ]
             reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
             
-            await message.answer(f"✅ Взрослые: {adults_input}")
-            await message.answer(
+            await self.outbox.send_message(message.chat.id, f"✅ Взрослые: {adults_input}")
+            await self.outbox.send_message(
+                message.chat.id,
                 "👶 Шаг 6/10: Дети\n\n"
                 "Напишите количество детей:\n"
                 "Пример: 2 или 0 если детей нет",
@@ -687,7 +3442,8 @@ class TravelataBot:
             )
             await state.set_state(UserStates.CHILDREN)
         else:
-            await message.answer(
+            await self.outbox.send_message(
+                message.chat.id,
                 "❌ Неверный формат\n\n"
                 "Введите число больше 0:"
             )
@@ -695,18 +3451,18 @@ class TravelataBot:
 
     async def get_children(self, message: Message, state: FSMContext) -> None:
         """Получение количества детей"""
-        await self.rate_limit(message.from_user.id)
         user_id = message.from_user.id
         children_input = message.text.strip().lower()
         
         if children_input.isdigit():
-            self.user_params[user_id].tourist_group_kids = children_input
+            self.user_params.params(user_id).tourist_group_kids = children_input
             children_text = children_input
         elif children_input in ["0", "нет", "нету"]:
-            self.user_params[user_id].tourist_group_kids = "0"
+            self.user_params.params(user_id).tourist_group_kids = "0"
             children_text = "0"
         else:
-            await message.answer(
+            await self.outbox.send_message(
+                message.chat.id,
                 "❌ Неверный формат\n\n"
                 "Введите число или 'нет':"
             )
@@ -718,8 +3474,9 @@ class TravelataBot:
         ]
         reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
         
-        await message.answer(f"✅ Дети: {children_text}")
-        await message.answer(
+        await self.outbox.send_message(message.chat.id, f"✅ Дети: {children_text}")
+        await self.outbox.send_message(
+            message.chat.id,
             "🍼 Шаг 7/10: Младенцы\n\n"
             "Напишите количество младенцев (до 2 лет):\n"
             "Пример: 1 или 0 если младенцев нет",
@@ -729,20 +3486,20 @@ class TravelataBot:
 
     async def get_infants(self, message: Message, state: FSMContext) -> None:
         """Получение количества младенцев"""
-        await self.rate_limit(message.from_user.id)
         user_id = message.from_user.id
         infants_input = message.text.strip()
         
         if infants_input.isdigit():
-            self.user_params[user_id].tourist_group_infants = infants_input
+            self.user_params.params(user_id).tourist_group_infants = infants_input
             
             keyboard = [
                 [InlineKeyboardButton(text="◀️ Назад", callback_data="set_params")]
             ]
             reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
             
-            await message.answer(f"✅ Младенцы: {infants_input}")
-            await message.answer(
+            await self.outbox.send_message(message.chat.id, f"✅ Младенцы: {infants_input}")
+            await self.outbox.send_message(
+                message.chat.id,
                 "🗓 Шаг 8/10: Продолжительность тура\n\n"
                 "Напишите минимальное и максимальное количество ночей:\n"
                 "Пример: 7 14 - от 7 до 14 ночей",
@@ -750,7 +3507,8 @@ class TravelataBot:
             )
             await state.set_state(UserStates.NIGHTS)
         else:
-            await message.answer(
+            await self.outbox.send_message(
+                message.chat.id,
                 "❌ Неверный формат\n\n"
                 "Введите число:"
             )
@@ -758,21 +3516,21 @@ class TravelataBot:
 
     async def get_nights(self, message: Message, state: FSMContext) -> None:
         """Получение диапазона ночей"""
-        await self.rate_limit(message.from_user.id)
         user_id = message.from_user.id
         nights_input = message.text.strip().split()
         
         if len(nights_input) == 2 and nights_input[0].isdigit() and nights_input[1].isdigit():
-            self.user_params[user_id].night_range_from = nights_input[0]
-            self.user_params[user_id].night_range_to = nights_input[1]
+            self.user_params.params(user_id).night_range_from = nights_input[0]
+            self.user_params.params(user_id).night_range_to = nights_input[1]
             
             keyboard = [
                 [InlineKeyboardButton(text="◀️ Назад", callback_data="set_params")]
             ]
             reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
             
-            await message.answer(f"✅ Ночи: от {nights_input[0]} до {nights_input[1]}")
-            await message.answer(
+            await self.outbox.send_message(message.chat.id, f"✅ Ночи: от {nights_input[0]} до {nights_input[1]}")
+            await self.outbox.send_message(
+                message.chat.id,
                 "⭐ Шаг 9/10: Категория отеля\n\n"
                 "Напишите звездность отелей через пробел:\n"
                 "Пример: 3 4 5 - отели 3*, 4* и 5*",
@@ -780,7 +3538,8 @@ class TravelataBot:
             )
             await state.set_state(UserStates.HOTEL_CATEGORY)
         else:
-            await message.answer(
+            await self.outbox.send_message(
+                message.chat.id,
                 "❌ Неверный формат\n\n"
                 "Введите два числа через пробел:\n"
                 "Пример: 7 14"
@@ -789,7 +3548,6 @@ class TravelataBot:
 
     async def get_hotel_category(self, message: Message, state: FSMContext) -> None:
         """Получение категорий отеля"""
-        await self.rate_limit(message.from_user.id)
         user_id = message.from_user.id
         categories_input = message.text.strip().split()
         
@@ -803,19 +3561,22 @@ class TravelataBot:
                 invalid_categories.append(category)
         
         if valid_categories:
-            self.user_params[user_id].hotel_categories = valid_categories
+            self.user_params.params(user_id).hotel_categories = valid_categories
             
             keyboard = [
                 [InlineKeyboardButton(text="◀️ Назад", callback_data="set_params")]
             ]
             reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
             
-            await message.answer(f"✅ Категории отелей: {', '.join(valid_categories)}*")
+            await self.outbox.send_message(message.chat.id, f"✅ Категории отелей: {', '.join(valid_categories)}*")
             
             if invalid_categories:
-                await message.answer(f"⚠️ Игнорированы: {', '.join(invalid_categories)} (допустимы значения 1-5)")
+                await self.outbox.send_message(
+                    message.chat.id, f"⚠️ Игнорированы: {', '.join(invalid_categories)} (допустимы значения 1-5)"
+                )
             
-            await message.answer(
+            await self.outbox.send_message(
+                message.chat.id,
                 "📅 Шаг 10/10: Даты заезда\n\n"
                 "Введите начальную и конечную даты в формате:\n"
                 "Пример: 2025-06-01 2025-06-15\n\n"
@@ -826,7 +3587,8 @@ class TravelataBot:
             )
             await state.set_state(UserStates.DATES)
         else:
-            await message.answer(
+            await self.outbox.send_message(
+                message.chat.id,
                 "❌ Неверные категории\n\n"
                 "Введите числа от 1 до 5 через пробел:\n"
                 "Пример: 3 4 5"
@@ -835,7 +3597,6 @@ class TravelataBot:
 
     async def get_dates(self, message: Message, state: FSMContext) -> None:
         """Получение дат заселения"""
-        await self.rate_limit(message.from_user.id)
         user_id = message.from_user.id
         dates_input = message.text.strip().split()
         
@@ -845,11 +3606,11 @@ class TravelataBot:
                 date_to = datetime.strptime(dates_input[1], "%Y-%m-%d")
                 
                 if date_from <= date_to:
-                    self.user_params[user_id].check_in_date_range_from = dates_input[0]
-                    self.user_params[user_id].check_in_date_range_to = dates_input[1]
+                    self.user_params.params(user_id).check_in_date_range_from = dates_input[0]
+                    self.user_params.params(user_id).check_in_date_range_to = dates_input[1]
                     
                     # Показываем сводку параметров
-                    params = self.user_params[user_id]
+                    params = self.user_params.params(user_id)
                     summary = self._create_search_summary(params)
                     
                     keyboard = [
@@ -858,7 +3619,8 @@ class TravelataBot:
                     ]
                     reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
                     
-                    await message.answer(
+                    await self.outbox.send_message(
+                        message.chat.id,
                         f"✅ Параметры настроены!\n\n"
                         f"{summary}\n"
                         f"Готовы начать поиск?",
@@ -866,20 +3628,23 @@ class TravelataBot:
                     )
                     await state.clear()
                 else:
-                    await message.answer(
+                    await self.outbox.send_message(
+                        message.chat.id,
                         "❌ Дата начала должна быть раньше даты окончания\n\n"
                         "Попробуйте снова:"
                     )
                     await state.set_state(UserStates.DATES)
             except ValueError:
-                await message.answer(
+                await self.outbox.send_message(
+                    message.chat.id,
                     "❌ Неверный формат даты\n\n"
                     "Используйте формат ГГГГ-ММ-ДД:\n"
                     "Пример: 2025-06-01 2025-06-15"
                 )
                 await state.set_state(UserStates.DATES)
         else:
-            await message.answer(
+            await self.outbox.send_message(
+                message.chat.id,
                 "❌ Неверный формат\n\n"
                 "Введите две даты через пробел:\n"
                 "Пример: 2025-06-01 2025-06-15"
@@ -889,89 +3654,113 @@ class TravelataBot:
     async def start_search(self, callback: CallbackQuery, state: FSMContext) -> None:
         """Начало поиска туров"""
         await callback.answer()
-        await self.rate_limit(callback.from_user.id)
         
         user_id = callback.from_user.id
         
-        if user_id not in self.user_params or not self.user_params[user_id]:
-            await callback.message.edit_text("❌ Параметры поиска не найдены. Начните с настройки.")
+        params = self.user_params.get(user_id)
+        if params is None:
+            await self.outbox.edit_message(
+                callback.message.chat.id, callback.message.message_id, "❌ Параметры поиска не найдены. Начните с настройки."
+            )
             await self.set_params(callback, state)
             return
         
-        await callback.message.edit_text("🔍 Анализирую ваши предпочтения...")
+        await self.outbox.edit_message(
+            callback.message.chat.id, callback.message.message_id, "🔍 Анализирую ваши предпочтения..."
+        )
         
         # Показываем сводку параметров
-        params = self.user_params[user_id]
         summary = self._create_search_summary(params)
-        await callback.message.answer(f"📋 Параметры поиска:\n{summary}")
-        
-        # Создание URL для API запроса
-        url = "https://api-gateway.travelata.ru/statistic/cheapestTours"
-        
-        # Построение параметров запроса
-        query_params = []
-        
-        if params.countries:
-            for country in params.countries:
-                query_params.append(f"countries[]={country}")
-        
-        if params.departure_city:
-            query_params.append(f"departureCity={params.departure_city}")
+        await self.outbox.send_message(callback.message.chat.id, f"📋 Параметры поиска:\n{summary}")
         
-        if params.night_range_from:
-            query_params.append(f"nightRange[from]={params.night_range_from}")
+        # Канонический запрос: одинаковые параметры дают один ключ кэша
+        query = SearchQuery.from_params(params)
         
-        if params.night_range_to:
-            query_params.append(f"nightRange[to]={params.night_range_to}")
+        await self.outbox.send_message(callback.message.chat.id, "🌐 Формирую запрос к системе поиска...")
         
-        if params.resorts:
-            for resort in params.resorts:
-                query_params.append(f"resorts[]={resort}")
-        
-        if params.meals:
-            for meal in params.meals:
-                query_params.append(f"meals[]={meal}")
-        
-        if params.tourist_group_adults:
-            query_params.append(f"touristGroup[adults]={params.tourist_group_adults}")
-        
-        if params.tourist_group_kids:
-            query_params.append(f"touristGroup[kids]={params.tourist_group_kids}")
+        await self.get_data_via_browser(query, callback.message.chat.id, user_id)
+
+    async def fetch_tours(self, query: SearchQuery) -> SearchResult:
+        """Получение сгруппированного результата поиска с учетом общего кэша"""
+        result = self.response_cache.get(query)
+        if result is not None:
+            return result
         
-        if params.tourist_group_infants:
-            query_params.append(f"touristGroup[infants]={params.tourist_group_infants}")
+        # Одновременные запросы с тем же ключом ждут один общий поход в API
+        return await self.single_flight.do(query, lambda: self._fetch_and_cache(query))
+
+    async def _fetch_and_cache(self, query: SearchQuery) -> SearchResult:
+        """Запрос к API, однократный разбор и группировка ответа, сохранение в кэш"""
+        days = check_in_days(query)
+        if days is not None:
+            table = await self._fetch_by_days(query, days)
+        else:
+            table = await self._fetch_planned(query)
         
-        if params.hotel_categories:
-            for category in params.hotel_categories:
-                query_params.append(f"hotelCategories[]={category}")
+        result = SearchResult(table)
+        self.response_cache.set(query, result)
+        return result
+    
+    async def _fetch_planned(self, query: SearchQuery) -> TourTable:
+        """Таблица туров по запросу, при необходимости разбитому на подзапросы"""
+        sub_queries = plan_queries(query)
+        if len(sub_queries) == 1:
+            return await self.fetcher.table(query)
         
-        if params.check_in_date_range_from:
-            query_params.append(f"checkInDateRange[from]={params.check_in_date_range_from}")
+        # Подзапросы идут параллельно: поиск длится столько, сколько самый медленный из них,
+        # и ограничение API на размер ответа действует на каждый подзапрос отдельно
+        slots = asyncio.Semaphore(SEARCH_FANOUT_CONCURRENCY)
         
-        if params.check_in_date_range_to:
-            query_params.append(f"checkInDateRange[to]={params.check_in_date_range_to}")
+        async def fetch_one(sub_query: SearchQuery) -> TourTable:
+            async with slots:
+                return await self.fetcher.table(sub_query)
         
-        full_url = f"{url}?{'&'.join(query_params)}"
+        merged = merge_tables(await asyncio.gather(*(fetch_one(sub_query) for sub_query in sub_queries)))
+        logger.info(f"Запрос разбит на {len(sub_queries)} подзапросов, туров после слияния: {len(merged)}")
+        return merged
+    
+    async def _fetch_by_days(self, query: SearchQuery, days: List[str]) -> TourTable:
+        """Туры за диапазон дат: дни из кэша плюс запросы только недостающих отрезков"""
+        # Ключ дня - запрос без дат: одинаковый для всех диапазонов, содержащих этот день
+        route = replace(query, check_in_date_range_from=None, check_in_date_range_to=None)
+        slices = {day: self.day_slices.get((route, day)) for day in days}
+        missing = {day for day, table in slices.items() if table is None}
+        runs = contiguous_runs(days, missing)
         
-        await callback.message.answer("🌐 Формирую запрос к системе поиска...")
+        async def fetch_run(run: List[str]) -> Dict[str, TourTable]:
+            run_query = replace(query, check_in_date_range_from=run[0], check_in_date_range_to=run[-1])
+            run_slices = (await self._fetch_planned(run_query)).split_by_day(run)
+            # Каждый день кэшируется и устаревает отдельно; в кэше колонки, а не словари туров
+            for day, table in run_slices.items():
+                self.day_slices.set((route, day), table)
+            return run_slices
         
-        # ВСЕГДА используем браузер для получения данных
-        await self.get_data_via_browser(full_url, callback.message.chat.id, user_id)
+        # Тот же отрезок, запрошенный другим пользователем одновременно, скачивается один раз
+        for run_slices in await asyncio.gather(*(
+            self.single_flight.do((route, run[0], run[-1]), lambda run=run: fetch_run(run))
+            for run in runs
+        )):
+            slices.update(run_slices)
+        logger.info(
+            f"Дни заезда: из кэша {len(days) - len(missing)}, запрошено {len(missing)} "
+            f"({len(runs)} запросов к API)"
+        )
+        return merge_tables([slices[day] for day in days])
 
-    async def get_data_via_browser(self, url: str, chat_id: int, user_id: int) -> None:
-        """Получение данных через браузер и преобразование в список отелей"""
+    async def get_data_via_browser(self, query: SearchQuery, chat_id: int, user_id: int) -> None:
+        """Получение данных о турах и преобразование в список отелей"""
         try:
-            await self.bot.send_message(chat_id, "🔄 Подключаюсь к системе поиска...")
+            await self.outbox.send_message(chat_id, "🔄 Подключаюсь к системе поиска...")
             
-            # Получаем содержимое страницы через Selenium
-            page_content = self.web_driver_manager.get_page_content(url)
-            
-            if "Ошибка" in page_content or "Таймаут" in page_content:
-                await self.bot.send_message(chat_id, f"❌ {page_content}")
+            # Получаем ответ API (браузер используется только если прямой запрос заблокирован)
+            try:
+                result = await self.fetch_tours(query)
+            except FetchError as e:
+                await self.outbox.send_message(chat_id, f"❌ {e}")
                 return
             
             # Преобразуем содержимое страницы в список отелей
-            hotels_message, has_tours = self.parse_json_to_hotels_list(page_content)
+            hotels_message, has_tours = self.parse_json_to_hotels_list(result)
             
             if not has_tours:
                 # Если туров нет, показываем сообщение и НЕ запускаем мониторинг
@@ -981,8 +3770,8 @@ class TravelataBot:
                 ]
                 reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
                 
-                await self.bot.send_message(chat_id, "✅ Поиск завершен")
-                await self.bot.send_message(
+                await self.outbox.send_message(chat_id, "✅ Поиск завершен")
+                await self.outbox.send_message(
                     chat_id, 
                     hotels_message, 
                     reply_markup=reply_markup
@@ -996,17 +3785,16 @@ class TravelataBot:
             ]
             reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
             
-            await self.bot.send_message(chat_id, "✅ Поиск завершен успешно!")
-            
-            # Отправляем список отелей (разбиваем на части если нужно)
-            if len(hotels_message) > 4000:
-                parts = [hotels_message[i:i+4000] for i in range(0, len(hotels_message), 4000)]
-                for part in parts:
-                    await self.bot.send_message(chat_id, part)
-            else:
-                await self.bot.send_message(chat_id, hotels_message)
+            # Первая страница результатов; остальные рендерятся по нажатию ◀️/▶️ в том же сообщении.
+            # Сессия привязана к сообщению: кнопки старой выдачи листают свой поиск, а не последний
+            results_message = await self.outbox.send_message(
+                chat_id,
+                hotels_message,
+                reply_markup=self._results_keyboard(0, self._pages_count(result))
+            )
+            await self.search_sessions.put(user_id, results_message.message_id, result)
             
-            await self.bot.send_message(
+            await self.outbox.send_message(
                 chat_id, 
                 "📊 Что дальше?\n\n"
                 "• 🔍 Мониторинг - отслеживать изменения цен\n"
@@ -1015,34 +3803,27 @@ class TravelataBot:
             )
             
             # Сохраняем данные для возможного запуска мониторинга
-            self.monitoring_users[user_id] = {
-                'url': url,
-                'current_content': page_content,
-                'chat_id': chat_id,
-                'hotels_snapshot': self._create_hotels_snapshot_from_content(page_content),
-                'has_tours': has_tours
-            }
+            self.monitoring_store.save_search(
+                user_id, chat_id, query, self._create_hotels_snapshot_from_content(result)
+            )
             
         except Exception as e:
             error_msg = f"❌ Ошибка при получении данных: {str(e)}"
-            await self.bot.send_message(chat_id, error_msg)
+            await self.outbox.send_message(chat_id, error_msg)
             logger.error(error_msg)
 
     async def start_monitoring(self, callback: CallbackQuery, state: FSMContext) -> None:
         """Запуск мониторинга после подтверждения"""
         await callback.answer()
-        await self.rate_limit(callback.from_user.id)
         
         user_id = callback.from_user.id
         
-        if user_id not in self.monitoring_users:
-            await callback.message.edit_text("❌ Данные для мониторинга не найдены. Выполните поиск сначала.")
-            return
-        
-        monitoring_data = self.monitoring_users[user_id]
-        
-        if not monitoring_data.get('has_tours', False):
-            await callback.message.edit_text("❌ Мониторинг недоступен - туры не найдены.")
+        # Подписка сохраняется только для поиска, в котором нашлись туры
+        subscription = await self.monitoring_store.load(user_id)
+        if subscription is None:
+            await self.outbox.edit_message(
+                callback.message.chat.id, callback.message.message_id, "❌ Данные для мониторинга не найдены. Выполните поиск сначала."
+            )
             return
         
         keyboard = [
@@ -1050,7 +3831,8 @@ class TravelataBot:
         ]
         reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
         
-        await callback.message.edit_text(
+        await self.outbox.edit_message(
+            callback.message.chat.id, callback.message.message_id,
             "🔍 Мониторинг активирован!\n\n"
             "Я буду проверять изменения каждые 10 минут:\n"
             "• 📈 Изменения цен\n"
@@ -1060,176 +3842,128 @@ class TravelataBot:
             reply_markup=reply_markup
         )
         
-        # Запускаем мониторинг
-        asyncio.create_task(self.monitor_tours(user_id))
+        # Ставим проверки в общий планировщик (повторное нажатие не создает дубликат)
+        self.monitoring_store.activate(user_id)
+        self.scheduler.schedule(user_id, subscription.query, MONITORING_INTERVAL)
 
-    def _create_hotels_snapshot_from_content(self, page_content: str):
-        """Создание снимка текущего состояния отелей из содержимого страницы"""
+    def _create_hotels_snapshot_from_content(self, result: SearchResult) -> Dict[int, HotelSnapshot]:
+        """Создание снимка текущего состояния отелей из результата поиска"""
+        return build_hotel_snapshots(result)
+
+    async def monitor_tours(self, user_id: int) -> Optional[float]:
+        """Умная проверка изменений в турах; возвращает задержку до следующей проверки"""
+        # Состояние читается из хранилища на каждую проверку, в памяти между проверками ничего не держим
+        subscription = await self.monitoring_store.load(user_id)
+        if subscription is None or not subscription.active:
+            return None
+        if subscription.owner != self.monitoring_store.owner:
+            # Подписку проверяет другой процесс (например, мониторинг включили заново через него)
+            return None
+        
+        delay = subscription.delay
+        chat_id = subscription.chat_id
+        changed = False
+        
         try:
-            start_idx = page_content.find('{')
-            end_idx = page_content.rfind('}') + 1
+            query = subscription.query
             
-            if start_idx == -1 or end_idx == 0:
-                return {}
+            await self.outbox.send_message(
+                chat_id, 
+                f"🔍 Проверка обновлений\n⏰ {datetime.now().strftime('%H:%M')}",
+                priority=OutboundQueue.MONITORING
+            )
             
-            json_str = page_content[start_idx:end_idx]
-            data = json.loads(json_str)
+            # Получаем новые данные
+            try:
+                new_result = await self.fetch_tours(query)
+            except FetchError as e:
+                await self.outbox.send_message(
+                    chat_id, f"❌ Ошибка при мониторинге: {e}", priority=OutboundQueue.MONITORING
+                )
+                self.monitoring_store.record_check(user_id, delay, changed)
+                return delay
             
-            if not data.get('success') or 'data' not in data:
-                return {}
+            new_snapshot = self._create_hotels_snapshot_from_content(new_result)
             
-            tours = data['data']
-            if not tours:
-                return {}
+            # Проверяем, есть ли вообще туры в новых данных
+            if not new_snapshot:
+                await self.outbox.send_message(
+                    chat_id, 
+                    "📭 Туры больше не найдены\n\nМониторинг остановлен.",
+                    priority=OutboundQueue.MONITORING
+                )
+                self.monitoring_store.delete(user_id)
+                return None
             
-            hotels = {}
-            for tour in tours:
-                hotel_id = tour['hotelId']
-                if hotel_id not in hotels:
-                    hotels[hotel_id] = {
-                        'name': tour['hotelName'],
-                        'min_price': tour['price'],
-                        'prices': [tour['price']],
-                        'tours_count': 1
-                    }
-                else:
-                    hotels[hotel_id]['prices'].append(tour['price'])
-                    hotels[hotel_id]['min_price'] = min(hotels[hotel_id]['min_price'], tour['price'])
-                    hotels[hotel_id]['tours_count'] += 1
+            old_snapshot = await self.monitoring_store.load_snapshot(user_id)
+            diff = diff_snapshots(old_snapshot, new_snapshot)
+            changes = [self._format_change(event) for event in diff.events]
+            # Перезаписываем только отели, о которых сообщили: для остальных база - последнее уведомление
+            self.monitoring_store.update_snapshot(user_id, diff.changed, diff.removed)
             
-            return hotels
-        except:
-            return {}
-
-    async def monitor_tours(self, user_id: int) -> None:
-        """Умный мониторинг изменений в турах через браузер - каждые 10 минут"""
-        delay = 600  # начальная задержка 10 минут
-        max_delay = 3600  # максимальная задержка 1 час
-        
-        while user_id in self.monitoring_users:
-            try:
-                await asyncio.sleep(delay)
+            if changes:
+                message = "📊 Обнаружены изменения:\n\n"
+                for change in changes:
+                    message += f"{change}\n\n"
                 
-                if user_id not in self.monitoring_users:
-                    break
+                # Добавляем разделитель
+                message += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
                 
-                monitoring_data = self.monitoring_users[user_id]
-                url = monitoring_data['url']
-                old_snapshot = monitoring_data['hotels_snapshot']
-                chat_id = monitoring_data['chat_id']
+                await self.outbox.send_message(chat_id, message, priority=OutboundQueue.MONITORING)
+                changed = True
                 
-                await self.bot.send_message(
+                # Сбрасываем задержку при изменениях
+                delay = MONITORING_INTERVAL
+            else:
+                # Увеличиваем задержку если нет изменений
+                delay = min(delay * 1.5, MONITORING_MAX_INTERVAL)
+                
+                await self.outbox.send_message(
                     chat_id, 
-                    f"🔍 Проверка обновлений\n⏰ {datetime.now().strftime('%H:%M')}"
+                    f"ℹ️ Изменений не обнаружено\nСледующая проверка через {int(delay // 60)} мин.",
+                    priority=OutboundQueue.MONITORING
                 )
-                
-                # Получаем новые данные через браузер
-                new_content = self.web_driver_manager.get_page_content(url)
-                
-                if "Ошибка" in new_content or "Таймаут" in new_content:
-                    await self.bot.send_message(chat_id, f"❌ Ошибка при мониторинге: {new_content}")
-                    continue
-                
-                new_snapshot = self._create_hotels_snapshot_from_content(new_content)
-                
-                # Проверяем, есть ли вообще туры в новых данных
-                if not new_snapshot:
-                    await self.bot.send_message(
-                        chat_id, 
-                        "📭 Туры больше не найдены\n\nМониторинг остановлен."
-                    )
-                    if user_id in self.monitoring_users:
-                        del self.monitoring_users[user_id]
-                    break
-                
-                changes = self._compare_hotels_snapshots(old_snapshot, new_snapshot)
-                
-                if changes:
-                    message = "📊 Обнаружены изменения:\n\n"
-                    for change in changes:
-                        message += f"{change}\n\n"
-                    
-                    # Добавляем разделитель
-                    message += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
                     
-                    await self.bot.send_message(chat_id=chat_id, text=message)
-                    
-                    # Обновляем снимок
-                    self.monitoring_users[user_id]['hotels_snapshot'] = new_snapshot
-                    self.monitoring_users[user_id]['current_content'] = new_content
-                    
-                    # Сбрасываем задержку при изменениях
-                    delay = 600
-                else:
-                    await self.bot.send_message(
-                        chat_id=chat_id, 
-                        text=f"ℹ️ Изменений не обнаружено\nСледующая проверка через {delay//60} мин."
-                    )
-                    
-                    # Увеличиваем задержку если нет изменений
-                    delay = min(delay * 1.5, max_delay)
-                        
-            except Exception as e:
-                error_message = f"❌ Ошибка при мониторинге: {str(e)}"
-                if user_id in self.monitoring_users:
-                    await self.bot.send_message(
-                        chat_id=self.monitoring_users[user_id]['chat_id'], 
-                        text=error_message
-                    )
-                logger.error(f"Ошибка при мониторинге: {e}")
-                continue
+        except Exception as e:
+            error_message = f"❌ Ошибка при мониторинге: {str(e)}"
+            await self.outbox.send_message(chat_id, error_message, priority=OutboundQueue.MONITORING)
+            logger.error(f"Ошибка при мониторинге: {e}")
+        
+        self.monitoring_store.record_check(user_id, delay, changed)
+        return delay
 
     def _compare_hotels_snapshots(self, old_snapshot, new_snapshot):
         """Сравнение двух снимков отелей и выявление изменений"""
-        changes = []
-        
-        # Проверяем изменения цен в существующих отелях
-        for hotel_id, old_info in old_snapshot.items():
-            if hotel_id in new_snapshot:
-                new_info = new_snapshot[hotel_id]
-                old_min_price = old_info['min_price']
-                new_min_price = new_info['min_price']
-                
-                # Изменение цены более чем на 10%
-                price_change_percent = ((new_min_price - old_min_price) / old_min_price) * 100
-                
-                if price_change_percent < -10:  # Цена понизилась более чем на 10%
-                    changes.append(f"💰 Понижение цены\n🏨 {old_info['name']}\n📉 Было: {old_min_price:,} руб.\n📊 Стало: {new_min_price:,} руб.\n📈 Изменение: ▼{abs(price_change_percent):.1f}%")
-                
-                elif price_change_percent > 10:  # Цена повысилась более чем на 10%
-                    changes.append(f"💸 Повышение цены\n🏨 {old_info['name']}\n📈 Было: {old_min_price:,} руб.\n📊 Стало: {new_min_price:,} руб.\n📈 Изменение: ▲{price_change_percent:.1f}%")
-                
-                # Изменение количества туров
-                old_count = old_info['tours_count']
-                new_count = new_info['tours_count']
-                if new_count > old_count:
-                    changes.append(f"🆕 Добавлены туры\n🏨 {old_info['name']}\n✅ Добавлено: +{new_count - old_count}\n📊 Всего: {new_count} туров")
-                elif new_count < old_count:
-                    changes.append(f"❌ Удалены туры\n🏨 {old_info['name']}\n❌ Удалено: -{old_count - new_count}\n📊 Осталось: {new_count} туров")
-        
-        # Новые отели
-        new_hotels = set(new_snapshot.keys()) - set(old_snapshot.keys())
-        for hotel_id in new_hotels:
-            hotel_info = new_snapshot[hotel_id]
-            changes.append(f"🏨 Новый отель\n🎯 {hotel_info['name']}\n💰 Цена от: {hotel_info['min_price']:,} руб.\n📊 Туров: {hotel_info['tours_count']}")
-        
-        # Исчезнувшие отели
-        disappeared_hotels = set(old_snapshot.keys()) - set(new_snapshot.keys())
-        for hotel_id in disappeared_hotels:
-            hotel_info = old_snapshot[hotel_id]
-            changes.append(f"🚫 Отель удален\n🎯 {hotel_info['name']}\n📊 Было туров: {hotel_info['tours_count']}")
-        
-        return changes
+        return [self._format_change(event) for event in diff_snapshots(old_snapshot, new_snapshot).events]
+
+    def _format_change(self, event: ChangeEvent) -> str:
+        """Текст уведомления об изменении"""
+        if event.kind == ChangeEvent.PRICE_DOWN:
+            percent = (event.old_price - event.new_price) / event.old_price * 100
+            return f"💰 Понижение цены\n🏨 {event.hotel_name}\n📉 Было: {event.old_price:,} руб.\n📊 Стало: {event.new_price:,} руб.\n📈 Изменение: ▼{percent:.1f}%"
+        if event.kind == ChangeEvent.PRICE_UP:
+            percent = (event.new_price - event.old_price) / event.old_price * 100
+            return f"💸 Повышение цены\n🏨 {event.hotel_name}\n📈 Было: {event.old_price:,} руб.\n📊 Стало: {event.new_price:,} руб.\n📈 Изменение: ▲{percent:.1f}%"
+        if event.kind == ChangeEvent.TOURS_REPRICED:
+            direction = "▼" if event.new_price < event.old_price else "▲"
+            percent = abs(event.new_price - event.old_price) / event.old_price * 100
+            return f"🔁 Изменились цены туров\n🏨 {event.hotel_name}\n🔄 Туров с новой ценой: {event.count}\n📊 Сильнее всего: {event.old_price:,} → {event.new_price:,} руб. ({direction}{percent:.1f}%)"
+        if event.kind == ChangeEvent.TOURS_ADDED:
+            return f"🆕 Добавлены туры\n🏨 {event.hotel_name}\n✅ Добавлено: +{event.count}\n📊 Всего: {event.total} туров"
+        if event.kind == ChangeEvent.TOURS_REMOVED:
+            return f"❌ Удалены туры\n🏨 {event.hotel_name}\n❌ Удалено: -{event.count}\n📊 Осталось: {event.total} туров"
+        if event.kind == ChangeEvent.HOTEL_ADDED:
+            return f"🏨 Новый отель\n🎯 {event.hotel_name}\n💰 Цена от: {event.new_price:,} руб.\n📊 Туров: {event.total}"
+        return f"🚫 Отель удален\n🎯 {event.hotel_name}\n📊 Было туров: {event.total}"
 
     async def stop_monitoring(self, callback: CallbackQuery, state: FSMContext) -> None:
         """Остановка мониторинга"""
         await callback.answer()
-        await self.rate_limit(callback.from_user.id)
         
         user_id = callback.from_user.id
         
-        if user_id in self.monitoring_users:
-            del self.monitoring_users[user_id]
+        self.scheduler.unschedule(user_id)
+        self.monitoring_store.delete(user_id)
         
         keyboard = [
             [InlineKeyboardButton(text="🔍 Новый поиск", callback_data="set_params")],
@@ -1237,7 +3971,8 @@ class TravelataBot:
         ]
         reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
         
-        await callback.message.edit_text(
+        await self.outbox.edit_message(
+            callback.message.chat.id, callback.message.message_id,
             "⏹ Мониторинг остановлен\n\nВыберите действие:",
             reply_markup=reply_markup
         )
@@ -1253,7 +3988,8 @@ class TravelataBot:
         ]
         reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
         
-        await callback.message.edit_text(
+        await self.outbox.edit_message(
+            callback.message.chat.id, callback.message.message_id,
             "✨ Главное меню\n\nВыберите действие:",
             reply_markup=reply_markup
         )
@@ -1261,6 +3997,14 @@ class TravelataBot:
     def setup_handlers(self) -> None:
         """Настройка обработчиков"""
         
+        # Ограничение частоты срабатывает до фильтров и чтения состояния FSM
+        self.dp.message.outer_middleware(self.throttling)
+        self.dp.callback_query.outer_middleware(self.throttling)
+        if FSM_STORAGE_PATH:
+            shared_sessions = SharedSessionMiddleware(self.user_params, self.fsm_storage)
+            self.dp.message.outer_middleware(shared_sessions)
+            self.dp.callback_query.outer_middleware(shared_sessions)
+        
         # Обработчик команды /start
         self.router.message.register(self.start, Command("start"))
         
@@ -1271,6 +4015,7 @@ class TravelataBot:
         self.router.callback_query.register(self.start_monitoring, F.data == "start_monitoring")
         self.router.callback_query.register(self.stop_monitoring, F.data == "stop_monitoring")
         self.router.callback_query.register(self.back_to_start, F.data == "back_to_start")
+        self.router.callback_query.register(self.show_results_page, F.data.startswith("page:"))
         
         # Обработчики состояний
         self.router.message.register(self.get_country, UserStates.COUNTRY)
@@ -1284,13 +4029,163 @@ class TravelataBot:
         self.router.message.register(self.get_hotel_category, UserStates.HOTEL_CATEGORY)
         self.router.message.register(self.get_dates, UserStates.DATES)
 
+    async def resume_monitoring(self) -> None:
+        """Возобновление мониторинга подписок, доставшихся этому процессу"""
+        subscriptions = await self.monitoring_store.claim_subscriptions()
+        now = time.time()
+        resumed = 0
+        for subscription in subscriptions:
+            if subscription.user_id in self.scheduler.entries:
+                continue
+            remaining = max(0.0, (subscription.next_check_at or now) - now)
+            self.scheduler.schedule(subscription.user_id, subscription.query, remaining)
+            resumed += 1
+        if resumed:
+            logger.info(f"Возобновлен мониторинг для {resumed} пользователей")
+    
+    async def _renew_monitoring(self) -> None:
+        """Продление аренды своих подписок, подбор подписок остановившихся процессов и чистка старых поисков"""
+        while True:
+            await asyncio.sleep(MONITORING_LEASE_RENEW)
+            try:
+                await self.resume_monitoring()
+                purged = await self.monitoring_store.purge_offers()
+                if purged:
+                    logger.info(f"Удалено сохраненных поисков без мониторинга: {purged}")
+            except Exception as e:
+                logger.error(f"Ошибка при продлении подписок мониторинга: {e}")
+
+    def build_webhook_app(self) -> web.Application:
+        """HTTP-приложение, принимающее обновления от Telegram"""
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_webhook)
+        # Ответ на проверки доступности платформы
+        app.router.add_get("/", lambda request: web.Response(text="ok"))
+        app.router.add_get("/ready", self.handle_ready)
+        app.router.add_get("/metrics", self.handle_metrics)
+        return app
+    
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики кэшей, объединения запросов, ограничений и очереди отправки"""
+        stats = {
+            'response_cache': self.response_cache.stats(),
+            'day_slices': self.day_slices.stats(),
+            'single_flight_shared': self.single_flight.shared,
+            'throttled': self.throttling.throttled,
+            'outbox': self.outbox.stats(),
+            'search_sessions': {**self.search_sessions.local.stats(), 'shared_hits': self.search_sessions.shared_hits},
+            'user_sessions': self.user_params.stats(),
+            'monitoring': {'scheduled': len(self.scheduler), 'checks': self.scheduler.checks_done},
+            **self.fetcher.readiness()
+        }
+        if isinstance(self.fsm_storage, SQLiteStorage):
+            stats['fsm_storage'] = {'batches': self.fsm_storage.batches, 'operations': self.fsm_storage.operations}
+        return stats
+    
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+    
+    async def _log_stats(self) -> None:
+        """Периодическая запись счетчиков в лог (в режиме polling другого способа их увидеть нет)"""
+        while True:
+            await asyncio.sleep(STATS_LOG_INTERVAL)
+            logger.info(f"Счетчики: {json.dumps(self.stats(), ensure_ascii=False)}")
+    
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        """Отчет о готовности: бот отвечает сразу, браузеры - по мере запуска"""
+        return web.json_response({'bot': 'ready', **self.fetcher.readiness()})
+    
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        """Прием обновления: проверка секрета и передача диспетчеру"""
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # Сравнение байтов: заголовок с не-ASCII символами - отказ, а не ошибка сервера
+        if not hmac.compare_digest(secret.encode("utf-8", "surrogateescape"), self.webhook_secret.encode()):
+            return web.Response(status=401)
+        
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError as e:
+            logger.warning(f"Некорректное обновление от webhook: {e}")
+            return web.Response(status=400)
+        
+        if len(self.webhook_tasks) >= WEBHOOK_MAX_PENDING:
+            # Очередь переполнена: Telegram повторит доставку позже
+            logger.warning("Слишком много необработанных обновлений, webhook отвечает 503")
+            return web.Response(status=503)
+        
+        # Отвечаем сразу после приема: обработка (и ожидание свободного слота) идет в фоне
+        task = asyncio.create_task(self._process_update(update))
+        self.webhook_tasks.add(task)
+        task.add_done_callback(self.webhook_tasks.discard)
+        return web.Response()
+    
+    async def _process_update(self, update: Update) -> None:
+        async with self.webhook_slots:
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+    
+    async def run_webhook(self) -> None:
+        """Работа через webhook: встроенный HTTP-сервер вместо long polling"""
+        runner = web.AppRunner(self.build_webhook_app())
+        await runner.setup()
+        site = web.TCPSite(runner, "0.0.0.0", WEBHOOK_PORT)
+        await site.start()
+        
+        await self.dp.emit_startup(bot=self.bot)
+        await self.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=self.webhook_secret,
+            max_connections=WEBHOOK_MAX_CONCURRENT,
+            allowed_updates=self.dp.resolve_used_update_types()
+        )
+        logger.info(f"Webhook запущен на порту {WEBHOOK_PORT}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            # Webhook не удаляем: обновления за время перезапуска Telegram доставит позже
+            await runner.cleanup()
+            if self.webhook_tasks:
+                await asyncio.gather(*self.webhook_tasks, return_exceptions=True)
+            await self.dp.emit_shutdown(bot=self.bot)
+            await self.bot.session.close()
+    
     async def run(self):
         """Запуск бота"""
         try:
-            await self.dp.start_polling(self.bot)
+            await self.scheduler.start()
+            if self.dictionary_refresher:
+                self.dictionary_refresher.start()
+            await self.resume_monitoring()
+            self.lease_task = asyncio.create_task(self._renew_monitoring())
+            if STATS_LOG_INTERVAL > 0:
+                self.stats_task = asyncio.create_task(self._log_stats())
+            if BROWSER_WARMUP:
+                # Браузеры поднимаются в фоне и не задерживают ответы пользователям
+                self.warmup_task = asyncio.create_task(self.fetcher.warm_up())
+            logger.info(f"Бот готов к работе через {time.monotonic() - _process_started:.2f} с после запуска")
+            if BOT_MODE == "webhook" and WEBHOOK_URL:
+                await self.run_webhook()
+            else:
+                if BOT_MODE == "webhook":
+                    logger.warning("WEBHOOK_URL не задан, работаю через polling")
+                # getUpdates не работает, пока у бота установлен webhook
+                await self.bot.delete_webhook()
+                await self.dp.start_polling(self.bot)
         finally:
-            # Закрываем WebDriver при завершении работы
-            self.web_driver_manager.close()
+            # Останавливаем мониторинг и обновление справочников, закрываем хранилище, HTTP-клиент и WebDriver при завершении работы
+            logger.info(f"Счетчики: {json.dumps(self.stats(), ensure_ascii=False)}")
+            for task in (self.lease_task, self.stats_task):
+                if task is not None:
+                    task.cancel()
+            await self.scheduler.stop()
+            if self.dictionary_refresher:
+                await self.dictionary_refresher.stop()
+            await self.outbox.stop()
+            await self.monitoring_store.close()
+            await self.fsm_storage.close()
+            await self.fetcher.close()
 
 async def main():
     """Основная функция"""
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# Базы мониторинга создаются во временном каталоге, а не рядом с ботом
+os.environ.setdefault("MONITORING_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="travelata-tests-"), "monitoring.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TEST_TOKEN = "123456:" + "A" * 35
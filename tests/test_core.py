@@ -0,0 +1,184 @@
+from main import (
+    HotelGroups, PagedResult, SearchQuery, SearchResult, TokenBucket, TourTable, TTLCache, ChangeEvent,
+    build_hotel_snapshots, check_in_days, contiguous_runs, diff_snapshots, merge_tables, plan_queries
+)
+
+
+def tour(hotel_id, price, date="2025-06-01", nights=7, meal=2, url=None, name=None, rating="4.5"):
+    return {
+        "hotelId": hotel_id, "hotelName": name or f"Hotel {hotel_id}", "hotelCategoryName": "4*",
+        "hotelRating": rating, "price": price, "nights": nights, "checkinDate": date, "mealId": meal,
+        "tourPageUrl": url or f"https://example.com/{hotel_id}/{price}/{date}"
+    }
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expiry_and_lru(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("main.time.monotonic", clock)
+    cache = TTLCache(ttl=10, max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # "b" - самая давняя по использованию
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+    clock.now += 11
+    assert cache.get("a") is None
+    assert cache.purge() == 1
+    assert len(cache) == 0
+    assert cache.stats()["evictions"] == 2
+
+
+def test_ttl_cache_byte_limit_keeps_newest():
+    cache = TTLCache(ttl=60, max_size=100, max_bytes=10, size_of=len)
+    cache.set("a", "xxxx")
+    cache.set("b", "yyyy")
+    cache.set("c", "zzzz")
+    assert cache.get("a") is None
+    assert cache.bytes == 8
+    cache.set("d", "w" * 50)  # одна запись больше предела все равно сохраняется
+    assert len(cache) == 1 and cache.get("d")
+    cache.pop("d")
+    assert cache.bytes == 0
+
+
+def test_token_bucket_refill():
+    bucket = TokenBucket(rate=2, capacity=2)
+    start = bucket.updated
+    assert bucket.try_acquire(start)
+    assert bucket.try_acquire(start)
+    assert not bucket.try_acquire(start)
+    assert bucket.try_acquire(start + 0.5)
+    # Резерв в долг: ждать столько, сколько нужно до появления токена
+    assert bucket.reserve(start + 0.5) == 0.5
+
+
+def test_plan_queries_fans_out_by_dimension():
+    query = SearchQuery(countries=("1",), resorts=("5", "6"), meals=("1", "2"))
+    sub_queries = plan_queries(query, max_queries=8)
+    assert len(sub_queries) == 4
+    assert {(q.resorts, q.meals) for q in sub_queries} == {
+        (("5",), ("1",)), (("5",), ("2",)), (("6",), ("1",)), (("6",), ("2",))
+    }
+    # Измерение, превышающее предел, не разбивается
+    assert [q.meals for q in plan_queries(query, max_queries=3)] == [("1", "2"), ("1", "2")]
+    assert plan_queries(SearchQuery(countries=("1",))) == [SearchQuery(countries=("1",))]
+
+
+def test_check_in_days_and_runs():
+    query = SearchQuery(countries=("1",), check_in_date_range_from="2025-06-29", check_in_date_range_to="2025-07-02")
+    days = check_in_days(query)
+    assert days == ["2025-06-29", "2025-06-30", "2025-07-01", "2025-07-02"]
+    assert contiguous_runs(days, {"2025-06-29", "2025-07-01", "2025-07-02"}) == [
+        ["2025-06-29"], ["2025-07-01", "2025-07-02"]
+    ]
+    assert check_in_days(SearchQuery(countries=("1",))) is None
+
+
+def test_merge_tables_dedupes_only_across_sources():
+    first = TourTable.from_tours([
+        tour(1, 200, url="a1"), tour(1, 200, url="a2"), tour(2, 50, url="a3")
+    ])
+    second = TourTable.from_tours([tour(1, 150, url="b1"), tour(2, 50, url="b2"), tour(3, 70, url="b3")])
+
+    merged = merge_tables([first, second])
+    # Отель 1: дешевле во втором ответе; отель 2: при равной цене остается первый ответ
+    assert merged.urls == ["a3", "b3", "b1"]
+    assert merged.price.tolist() == [50, 70, 150]
+
+    # Повторы внутри одного ответа сохраняются - "Всего туров" совпадает с ответом API
+    assert len(merge_tables([first])) == 3
+
+
+def test_split_by_day_accepts_timestamps():
+    table = TourTable.from_tours([
+        tour(1, 300, "2025-06-01T00:00:00"), tour(2, 100, "2025-06-02"), tour(1, 200, "2025-06-01")
+    ])
+    slices = table.split_by_day(["2025-06-01", "2025-06-02", "2025-06-03"])
+    assert slices["2025-06-01"].price.tolist() == [300, 200]
+    assert slices["2025-06-02"].hotel_id.tolist() == [2]
+    assert len(slices["2025-06-03"]) == 0
+    assert len(merge_tables(list(slices.values()))) == 3
+
+
+def test_hotel_groups_aggregates_and_paging():
+    tours = [
+        tour(1, 500, "2025-06-01", nights=7, meal=1),
+        tour(2, 300, "2025-06-02", nights=10),
+        tour(1, 400, "2025-06-03", nights=9, meal=3),
+        tour(3, 300, "2025-06-01"),
+    ]
+    result = SearchResult.from_tours(tours)
+    assert isinstance(result.groups, HotelGroups)
+    assert result.hotels_count == 3 and result.tours_count == 4
+    assert result.min_price() == 300
+
+    hotels = result.hotels_page(0, 10)
+    # По возрастанию цены, при равной - в порядке появления
+    assert [hotel.hotel_id for hotel in hotels] == [2, 3, 1]
+    first = hotels[2]
+    assert (first.min_price, first.max_price) == (400, 500)
+    assert (first.min_nights, first.max_nights) == (7, 9)
+    assert first.checkin_dates == {"2025-06-01", "2025-06-03"}
+    assert first.meal_ids == {1, 3}
+    assert first.tours_count == 2
+    assert first.cheapest_url == tours[2]["tourPageUrl"]
+    assert [hotel.hotel_id for hotel in result.hotels_page(1, 1)] == [3]
+
+
+def test_paged_result_roundtrip():
+    result = SearchResult.from_tours([tour(hotel_id, 100 + hotel_id) for hotel_id in range(30)])
+    paged = PagedResult.from_result(result, max_hotels=20)
+    assert paged.hotels_count == 30 and len(paged.hotels) == 20
+
+    restored = PagedResult.from_bytes(paged.to_bytes())
+    assert restored.tours_count == 30 and restored.min_price() == 100
+    assert [hotel.hotel_id for hotel in restored.hotels_page(10, 5)] == list(range(10, 15))
+    assert restored.hotels[0].checkin_dates == {"2025-06-01"}
+
+
+def snapshots(tours):
+    return build_hotel_snapshots(SearchResult.from_tours(tours))
+
+
+def test_diff_snapshots_reports_hotel_and_price_changes():
+    old = snapshots([tour(1, 1000), tour(2, 500), tour(3, 700)])
+    new = snapshots([tour(1, 800), tour(2, 500), tour(4, 900)])
+    diff = diff_snapshots(old, new, price_threshold=10)
+
+    kinds = {(event.kind, event.hotel_id) for event in diff.events}
+    assert (ChangeEvent.PRICE_DOWN, 1) in kinds
+    assert (ChangeEvent.HOTEL_ADDED, 4) in kinds
+    assert (ChangeEvent.HOTEL_REMOVED, 3) in kinds
+    assert all(event.hotel_id != 2 for event in diff.events)
+    assert set(diff.changed) == {1, 4}
+    assert diff.removed == [3]
+
+
+def test_diff_snapshots_accumulates_drift_below_threshold():
+    base = snapshots([tour(1, 1000)])
+    step = snapshots([tour(1, 950)])
+    diff = diff_snapshots(base, step, price_threshold=10)
+    assert diff.events == [] and diff.changed == {}
+
+    # База не сдвинулась - два шага по 5% в сумме превышают порог
+    diff = diff_snapshots(base, snapshots([tour(1, 890)]), price_threshold=10)
+    assert [event.kind for event in diff.events] == [ChangeEvent.PRICE_DOWN, ChangeEvent.TOURS_REPRICED]
+    assert set(diff.changed) == {1}
+
+
+def test_diff_snapshots_tour_level_changes():
+    old = snapshots([tour(1, 1000, "2025-06-01"), tour(1, 1200, "2025-06-02")])
+    new = snapshots([tour(1, 1000, "2025-06-01"), tour(1, 1300, "2025-06-03")])
+    events = {event.kind: event for event in diff_snapshots(old, new).events}
+    assert events[ChangeEvent.TOURS_ADDED].count == 1
+    assert events[ChangeEvent.TOURS_REMOVED].count == 1
@@ -0,0 +1,133 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import main
+from main import DictionaryRefresher, FetchError, ReferenceData, ReferenceIndex
+
+
+def payload(version, resorts=None):
+    return {
+        "version": version,
+        "countries": {"Абхазия": "1", "Турция": "92"},
+        "departure_cities": {"Москва": "2"},
+        "resorts": resorts or {"Гагра": "1", "Новый Афон": "3", "Новый Уренгой": "77"},
+        "meals": {"AI": "5"}
+    }
+
+
+class FixtureServer:
+    """Источник справочников с ETag: на совпадающий If-None-Match отвечает 304"""
+
+    def __init__(self, body):
+        self.body = body
+        self.status = 200
+        self.requests = []
+
+    @property
+    def etag(self):
+        return f'"v{self.body["version"]}"'
+
+    async def handle(self, request):
+        self.requests.append(request)
+        if self.status != 200:
+            return web.Response(status=self.status)
+        if request.headers.get("If-None-Match") == self.etag:
+            return web.Response(status=304)
+        return web.json_response(self.body, headers={"ETag": self.etag})
+
+
+@pytest.fixture
+def restore_reference_data():
+    current = main.reference_data()
+    yield current
+    main.replace_reference_data(current)
+
+
+def run_with_fixture(body, scenario, tmp_path):
+    async def go():
+        fixture = FixtureServer(body)
+        app = web.Application()
+        app.router.add_get("/dictionaries.json", fixture.handle)
+        server = TestServer(app)
+        await server.start_server()
+        refresher = DictionaryRefresher(
+            str(server.make_url("/dictionaries.json")), path=str(tmp_path / "dictionaries.json")
+        )
+        try:
+            await scenario(fixture, refresher)
+        finally:
+            await refresher.stop()
+            await server.close()
+    asyncio.run(go())
+
+
+def test_refresh_swaps_data_and_uses_conditional_requests(tmp_path, restore_reference_data):
+    newer = restore_reference_data.version + 1
+
+    async def scenario(fixture, refresher):
+        assert await refresher.refresh()
+        assert main.reference_data().version == newer
+        assert main.reference_data().resorts.get("новый уренгой") == "77"
+        assert json.loads((tmp_path / "dictionaries.json").read_bytes())["version"] == newer
+
+        # Без изменений сервер отвечает 304, справочники остаются прежними
+        assert not await refresher.refresh()
+        assert fixture.requests[-1].headers["If-None-Match"] == fixture.etag
+        assert refresher.not_modified == 1 and refresher.updates == 1
+
+    run_with_fixture(payload(newer), scenario, tmp_path)
+
+
+def test_refresh_ignores_older_versions(tmp_path, restore_reference_data):
+    async def scenario(fixture, refresher):
+        assert not await refresher.refresh()
+        assert main.reference_data() is restore_reference_data
+        assert not (tmp_path / "dictionaries.json").exists()
+
+    run_with_fixture(payload(restore_reference_data.version), scenario, tmp_path)
+
+
+def test_refresh_failure_keeps_current_data(tmp_path, restore_reference_data):
+    async def scenario(fixture, refresher):
+        fixture.status = 500
+        with pytest.raises(FetchError):
+            await refresher.refresh()
+        assert main.reference_data() is restore_reference_data
+
+    run_with_fixture(payload(restore_reference_data.version + 1), scenario, tmp_path)
+
+
+def test_invalid_payload_is_rejected():
+    body = payload(5)
+    del body["meals"]
+    with pytest.raises(ValueError):
+        ReferenceData.from_payload(body)
+
+
+def test_bundled_dictionaries_load():
+    data = main.load_reference_data()
+    assert data.version >= 1
+    assert data.resorts.get("Гагра") == "1"
+
+
+def test_parse_list_prefers_longest_names():
+    index = ReferenceIndex(payload(1)["resorts"])
+    ids, found, unknown = index.parse_list("Гагра, новый  афон; Новый Уренгой\nНовый Сухум")
+    assert ids == ["1", "3", "77"]
+    assert found == ["гагра", "новый афон", "новый уренгой"]
+    assert unknown == ["новый сухум"]
+
+    # Несколько названий без разделителей тоже разбираются
+    ids, _, unknown = index.parse_list("гагра новый афон ёлки")
+    assert ids == ["1", "3"] and unknown == ["елки"]
+
+
+def test_suggest_and_reverse_lookup():
+    index = ReferenceIndex(payload(1)["countries"])
+    assert index.suggest("турци")[0] == "Турция"
+    assert index.name_of("92") == "Турция"
+    assert index.names_of(["1", "missing"]) == ["Абхазия"]
@@ -0,0 +1,162 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import main
+from main import FetchBlockedError, FetchError, HttpFetcher, SearchQuery, ShardedFetcher, TourFetcher
+
+PAYLOAD = {
+    "success": True,
+    "data": [{
+        "hotelId": 7, "hotelName": "Stub", "hotelCategoryName": "5*", "hotelRating": "4.8", "price": 12345,
+        "nights": 7, "checkinDate": "2025-06-01", "mealId": 2, "tourPageUrl": "https://example.com/7"
+    }]
+}
+
+
+class StubApi:
+    """Локальный stub API: ответ задается режимом, запоминаются заголовки и соединения"""
+
+    def __init__(self):
+        self.mode = "json"
+        self.delay = 0.0
+        self.requests = []
+        self.peers = set()
+
+    async def handle(self, request):
+        self.requests.append(request)
+        self.peers.add(request.transport.get_extra_info("peername"))
+        await asyncio.sleep(self.delay)
+        if self.mode == "gzip":
+            return web.Response(
+                body=gzip.compress(json.dumps(PAYLOAD).encode()),
+                headers={"Content-Type": "application/json", "Content-Encoding": "gzip"}
+            )
+        if self.mode == "blocked":
+            return web.Response(status=403)
+        if self.mode == "captcha":
+            return web.Response(text="<html>captcha</html>", content_type="text/html")
+        if self.mode == "error":
+            return web.Response(status=502)
+        return web.json_response(PAYLOAD)
+
+
+def run_with_stub(scenario):
+    async def go():
+        stub = StubApi()
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", stub.handle)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            await scenario(stub, str(server.make_url("/statistic/cheapestTours")))
+        finally:
+            await server.close()
+    asyncio.run(go())
+
+
+def test_fetch_reuses_connections_and_accepts_gzip():
+    async def scenario(stub, url):
+        fetcher = HttpFetcher()
+        try:
+            bodies = [await fetcher.fetch(url) for _ in range(3)]
+            stub.mode = "gzip"
+            bodies.append(await fetcher.fetch(url))
+        finally:
+            await fetcher.close()
+        assert all(json.loads(body) == PAYLOAD for body in bodies)
+        assert len(stub.peers) == 1  # keep-alive: все запросы по одному соединению
+        assert "gzip" in stub.requests[0].headers["Accept-Encoding"]
+    run_with_stub(scenario)
+
+
+@pytest.mark.parametrize("mode", ["blocked", "captcha"])
+def test_blocked_responses(mode):
+    async def scenario(stub, url):
+        stub.mode = mode
+        fetcher = HttpFetcher()
+        try:
+            with pytest.raises(FetchBlockedError):
+                await fetcher.fetch(url)
+        finally:
+            await fetcher.close()
+    run_with_stub(scenario)
+
+
+def test_server_error_is_not_treated_as_blocked():
+    async def scenario(stub, url):
+        stub.mode = "error"
+        fetcher = HttpFetcher()
+        try:
+            with pytest.raises(FetchError) as info:
+                await fetcher.fetch(url)
+        finally:
+            await fetcher.close()
+        assert not isinstance(info.value, FetchBlockedError)
+    run_with_stub(scenario)
+
+
+class FakeBrowserPool:
+    def __init__(self):
+        self.urls = []
+
+    async def get_response_body(self, url):
+        self.urls.append(url)
+        return json.dumps(PAYLOAD).encode()
+
+    def close(self):
+        pass
+
+
+def test_browser_is_used_only_when_blocked():
+    async def scenario(stub, url):
+        browser = FakeBrowserPool()
+        fetcher = TourFetcher(browser)
+        query = SearchQuery(countries=("1",))
+        base = url.rsplit(main.CHEAPEST_TOURS_PATH, 1)[0]
+        original = main.TRAVELATA_API_URL
+        main.TRAVELATA_API_URL = base
+        try:
+            table = await fetcher.table(query)
+            assert table.hotel_id.tolist() == [7] and browser.urls == []
+
+            stub.mode = "blocked"
+            table = await fetcher.table(query)
+            assert table.price.tolist() == [12345]
+            assert browser.urls == [query.to_url()]
+        finally:
+            main.TRAVELATA_API_URL = original
+            await fetcher.close()
+    run_with_stub(scenario)
+
+
+def test_shard_runs_requests_concurrently(monkeypatch):
+    async def scenario(stub, url):
+        stub.delay = 0.5
+        # Адрес stub-сервера читается процессом шарда при импорте
+        monkeypatch.setenv("TRAVELATA_API_URL", url.rsplit(main.CHEAPEST_TOURS_PATH, 1)[0])
+        fetcher = ShardedFetcher(shards=1, browser_pool_size=1)
+        try:
+            queries = [SearchQuery(countries=(str(i),)) for i in range(4)]
+            await fetcher.table(queries[0])  # запуск процесса
+
+            started = asyncio.get_running_loop().time()
+            tables = await asyncio.gather(*(fetcher.table(query) for query in queries))
+            elapsed = asyncio.get_running_loop().time() - started
+            assert [len(table) for table in tables] == [1, 1, 1, 1]
+            assert elapsed < 4 * stub.delay
+
+            # Упавший шард: ожидающие запросы получают FetchError, шард перезапускается
+            pending = asyncio.gather(*(fetcher.table(query) for query in queries), return_exceptions=True)
+            await asyncio.sleep(0.2)
+            fetcher.shards[0].process.kill()
+            assert all(isinstance(result, FetchError) for result in await pending)
+            assert fetcher.restarts == 1
+            assert len(await fetcher.table(queries[0])) == 1
+        finally:
+            await fetcher.close()
+    run_with_stub(scenario)
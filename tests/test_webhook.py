@@ -0,0 +1,123 @@
+import asyncio
+from datetime import datetime
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, SendMessage
+from aiogram.types import Chat, Message
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+from conftest import TEST_TOKEN
+
+
+class FakeTelegramSession(BaseSession):
+    """Сессия бота без сети: запоминает вызовы API и отвечает как Telegram"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message(
+                message_id=len(self.calls),
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def start_update(update_id: int = 1, chat_id: int = 42) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": 10,
+            "date": int(datetime.now().timestamp()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}]
+        }
+    }
+
+
+def run_with_client(scenario):
+    async def go():
+        bot = main.TravelataBot(TEST_TOKEN)
+        session = FakeTelegramSession()
+        bot.bot.session = session
+        client = TestClient(TestServer(bot.build_webhook_app()))
+        await client.start_server()
+        try:
+            await scenario(bot, session, client)
+        finally:
+            await client.close()
+            await bot.outbox.stop()
+            await bot.monitoring_store.close()
+    asyncio.run(go())
+
+
+def test_start_command_reply_goes_through_fake_telegram():
+    async def scenario(bot, session, client):
+        response = await client.post(
+            main.WEBHOOK_PATH, json=start_update(),
+            headers={"X-Telegram-Bot-Api-Secret-Token": bot.webhook_secret}
+        )
+        assert response.status == 200
+        await asyncio.gather(*bot.webhook_tasks)
+        sent = [call for call in session.calls if isinstance(call, SendMessage)]
+        assert len(sent) == 1
+        assert sent[0].chat_id == 42
+        assert "Добро пожаловать" in sent[0].text
+    run_with_client(scenario)
+
+
+def test_wrong_secret_is_rejected():
+    async def scenario(bot, session, client):
+        response = await client.post(
+            main.WEBHOOK_PATH, json=start_update(), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+        )
+        assert response.status == 401
+        response = await client.post(
+            main.WEBHOOK_PATH, json=start_update(), headers={"X-Telegram-Bot-Api-Secret-Token": "секрет"}
+        )
+        assert response.status == 401
+        assert not bot.webhook_tasks
+        assert session.calls == []
+    run_with_client(scenario)
+
+
+def test_response_does_not_wait_for_a_free_slot():
+    async def scenario(bot, session, client):
+        # Все слоты заняты: обновление все равно принимается сразу, обработка ждет в фоне
+        bot.webhook_slots = asyncio.Semaphore(0)
+        response = await asyncio.wait_for(client.post(
+            main.WEBHOOK_PATH, json=start_update(),
+            headers={"X-Telegram-Bot-Api-Secret-Token": bot.webhook_secret}
+        ), timeout=5)
+        assert response.status == 200
+        assert len(bot.webhook_tasks) == 1
+        assert session.calls == []
+
+        bot.webhook_slots.release()
+        await asyncio.gather(*bot.webhook_tasks)
+        assert any(isinstance(call, SendMessage) for call in session.calls)
+    run_with_client(scenario)
+
+
+def test_malformed_update_is_bad_request():
+    async def scenario(bot, session, client):
+        response = await client.post(
+            main.WEBHOOK_PATH, json={"update_id": "not a number"},
+            headers={"X-Telegram-Bot-Api-Secret-Token": bot.webhook_secret}
+        )
+        assert response.status == 400
+    run_with_client(scenario)